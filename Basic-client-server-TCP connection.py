@@ -4,28 +4,39 @@
 import socket
 import threading
 
+from async_logger import AsyncLogger
+from receive_buffer import ReceiveBuffer
+
+# Handlers queue log records; a background thread writes them in batches
+log = AsyncLogger()
+
 def handle_client(client_socket, address):
     """Handle individual client connection"""
-    print(f"Connection established with {address}")
+    log.info("Connection established with {}", address)
+    
+    # One buffer per connection; a character split across reads is decoded once complete
+    inbox = ReceiveBuffer(4096)
     
     try:
         while True:
             # Receive message from client
-            message = client_socket.recv(1024).decode('utf-8')
-            if not message:
+            if not inbox.recv_into(client_socket, 1024):
                 break
+            message, _ = inbox.read_text()
+            if not message:
+                continue
             
-            print(f"Received from {address}: {message}")
+            log.debug("Received from {}: {}", address, message)
             
             # For Step 1, we just receive messages
             if message.lower() == 'quit':
                 break
                 
     except ConnectionResetError:
-        print(f"Client {address} disconnected unexpectedly")
+        log.warning("Client {} disconnected unexpectedly", address)
     finally:
         client_socket.close()
-        print(f"Connection with {address} closed")
+        log.info("Connection with {} closed", address)
 
 def start_server():
     # Create TCP socket
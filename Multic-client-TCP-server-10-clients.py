@@ -1,92 +1,364 @@
 
 # SERVER CODE (step2_server.py)
+import codecs
+import errno
+import selectors
 import socket
+import sys
 import threading
 import time
 
+from async_logger import AsyncLogger
+from graceful import AcceptLoop, GracefulShutdown, default_handoff_path, shutdown_read
+from idle_reaper import IdleReaper, shutdown_socket
+from receive_buffer import ReceiveBuffer
+from socket_io import SocketOptions, raise_fd_limit
+from worker_pool import AdmissionPool
+
 class MultiClientServer:
-    def __init__(self, host='localhost', port=12345, max_clients=10):
+    def __init__(self, host='localhost', port=12345, max_clients=10, queue_size=None, queue_timeout=5.0,
+                 logger=None, socket_options=None, idle_timeout=300.0, read_timeout=30.0,
+                 drain_timeout=30.0, handoff_path=None):
         self.host = host
         self.port = port
         self.max_clients = max_clients
+        # TCP_NODELAY, SO_SNDBUF/SO_RCVBUF, keepalive and the listen backlog
+        self.socket_options = socket_options or SocketOptions()
+        # Silent or half-open clients are closed so their slots go back to live ones
+        self.reaper = IdleReaper(idle_timeout, read_timeout)
+        # SIGTERM, or handing the listener to a new process, drains clients instead of dropping them
+        self.graceful = GracefulShutdown(drain_timeout, handoff_path)
         self.active_clients = 0
         self.client_lock = threading.Lock()
+        # Clients beyond max_clients wait up to queue_timeout seconds for a free worker
+        self.queue_size = max_clients * 2 if queue_size is None else queue_size
+        self.queue_timeout = queue_timeout
+        self.pool = None
+        # Per-message logging goes through a batched background writer
+        self.log = logger or AsyncLogger()
         
-    def handle_client(self, client_socket, address, client_id):
-        """Handle individual client connection"""
+    def client_connected(self, client_id, address):
+        """Count a newly admitted client"""
         with self.client_lock:
             self.active_clients += 1
             current_clients = self.active_clients
         
-        print(f"Client {client_id} ({address}) connected. Active clients: {current_clients}")
+        self.log.info("Client {} ({}) connected. Active clients: {}", client_id, address, current_clients)
+
+    def process_message(self, client_id, message):
+        """Log a client message; returns False when the client asked to quit"""
+        self.log.debug("Client {}: {}", client_id, message)
+        return message.lower() != 'quit'
+
+    def client_disconnected(self, client_id):
+        """Release the slot held by a client"""
+        with self.client_lock:
+            self.active_clients -= 1
+            remaining_clients = self.active_clients
+        self.log.info("Client {} disconnected. Active clients: {}", client_id, remaining_clients)
+
+    def reject_client(self, client_socket, address):
+        self.log.warning("Maximum clients ({}) reached. Rejecting client {}", self.max_clients, address)
+        try:
+            client_socket.sendall("Server full. Try again later.".encode('utf-8'))
+        except OSError:
+            pass
+        client_socket.close()
+
+    def turn_away_client(self, client_socket, address):
+        """Close a connection that was still waiting for a worker when the drain began"""
+        self.log.info("Server shutting down. Turning away queued client {}", address)
+        try:
+            client_socket.sendall("Server shutting down. Try again later.".encode('utf-8'))
+        except OSError:
+            pass
+        client_socket.close()
+
+    def admission_metrics(self):
+        """Queue depth and wait times of the admission queue"""
+        return self.pool.metrics() if self.pool else {}
+
+    def reaper_stats(self):
+        """Tracked connections and how many were closed for idling"""
+        return self.reaper.stats()
+
+    def expire_client(self, client_id, close):
+        """Reaper callback: close a connection that timed out"""
+        self.log.warning("Client {} timed out; closing connection", client_id)
+        close()
+
+    def announce_drain(self):
+        print("\nServer stopped accepting" + (" (handed off)" if self.graceful.handed_off else ""))
+        print(f"Draining {self.active_clients} clients (up to {self.graceful.drain_timeout}s)...")
+
+    def report_drain(self, finished):
+        if finished:
+            print("All clients finished")
+        else:
+            print(f"Drain timeout: closing {self.graceful.cut} clients")
+
+    def handle_client(self, client_socket, address, client_id):
+        """Handle individual client connection"""
+        self.client_connected(client_id, address)
+        # Shutting the socket down wakes this thread out of recv with EOF
+        timer = self.reaper.track(lambda: self.expire_client(client_id, lambda: shutdown_socket(client_socket)))
+        # While draining, a read-side shutdown ends the connection once the client is between messages
+        self.graceful.track(timer, lambda: shutdown_read(client_socket))
         
         try:
+            self.socket_options.apply_client(client_socket)
+            inbox = ReceiveBuffer(4096)
             while True:
                 # Receive message from client
-                message = client_socket.recv(1024).decode('utf-8')
-                if not message:
+                if not inbox.recv_into(client_socket, 1024):
                     break
+                message, _ = inbox.read_text()
+                timer.touch(partial=bool(inbox))
+                if not message:
+                    continue  # Only part of a character so far
                 
-                print(f"Client {client_id}: {message}")
-                
-                if message.lower() == 'quit':
+                if not self.process_message(client_id, message):
                     break
                     
         except ConnectionResetError:
-            print(f"Client {client_id} disconnected unexpectedly")
+            self.log.warning("Client {} disconnected unexpectedly", client_id)
         except Exception as e:
-            print(f"Error handling client {client_id}: {e}")
+            self.log.error("Error handling client {}: {}", client_id, e)
         finally:
+            self.reaper.untrack(timer)
+            self.graceful.untrack(timer)
             client_socket.close()
-            with self.client_lock:
-                self.active_clients -= 1
-                remaining_clients = self.active_clients
-            print(f"Client {client_id} disconnected. Active clients: {remaining_clients}")
+            self.client_disconnected(client_id)
 
-    def start_server(self):
+    def create_server_socket(self):
+        """The listener handed over by a running server with our handoff path, or a new one"""
+        server_socket = self.graceful.inherit_listener()
+        if server_socket is not None:
+            print("Took over the listening socket from the running server")
+            return server_socket
+        
         # Create TCP socket
         server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.socket_options.apply_listener(server_socket)
         
         # Bind to host and port
         server_socket.bind((self.host, self.port))
         
         # Listen with larger backlog to handle multiple simultaneous connections
-        server_socket.listen(self.max_clients)
+        server_socket.listen(self.socket_options.listen_backlog(self.max_clients))
+        return server_socket
+
+    def start_server(self):
+        server_socket = self.create_server_socket()
         print(f"Server listening on {self.host}:{self.port}")
         print(f"Maximum clients supported: {self.max_clients}")
         
+        # A fixed pool of max_clients workers bounds active_clients by construction
+        self.pool = AdmissionPool(
+            self.handle_client, self.reject_client,
+            workers=self.max_clients, queue_size=self.queue_size, queue_timeout=self.queue_timeout
+        )
+        self.pool.start()
+        self.reaper.start()
+        accepts = AcceptLoop(server_socket)
+        self.graceful.start(server_socket, accepts.stop)
+        
         client_counter = 0
         
         try:
             while True:
-                # Accept client connection
-                client_socket, address = server_socket.accept()
+                # Accept client connection; None once SIGTERM or a handoff stopped the server
+                accepted = accepts.accept()
+                if accepted is None:
+                    break
+                client_socket, address = accepted
                 client_counter += 1
                 
-                # Check if we've reached max clients
-                with self.client_lock:
-                    if self.active_clients >= self.max_clients:
-                        print(f"Maximum clients ({self.max_clients}) reached. Rejecting client {address}")
-                        client_socket.send("Server full. Try again later.".encode('utf-8'))
-                        client_socket.close()
-                        continue
+                # Hand the client to the pool; it waits briefly if every worker is busy
+                self.pool.submit(client_socket, address, client_counter)
                 
-                # Handle client in a separate thread
-                client_thread = threading.Thread(
-                    target=self.handle_client, 
-                    args=(client_socket, address, client_counter)
-                )
-                client_thread.daemon = True
-                client_thread.start()
+        except KeyboardInterrupt:
+            print("\nServer shutting down...")
+        finally:
+            accepts.close()
+            # After a handoff this only closes our copy; the new process keeps listening
+            server_socket.close()
+        
+        if self.graceful.draining:
+            # Queued clients were never tracked, so the drain would not wait for them
+            self.pool.stop(self.turn_away_client)
+            self.announce_drain()
+            self.report_drain(self.graceful.drain())
+
+class ReactorConnection:
+    """Per-client state kept by the reactor instead of a blocked thread"""
+    __slots__ = ('sock', 'address', 'client_id', 'buffer', 'view', 'decoder', 'timer')
+
+    def __init__(self, sock, address, client_id, buffer_size=1024):
+        self.sock = sock
+        self.address = address
+        self.client_id = client_id
+        self.buffer = bytearray(buffer_size)
+        self.view = memoryview(self.buffer)
+        # Keeps a multi-byte character that was split across two reads
+        self.decoder = codecs.getincrementaldecoder('utf-8')()
+        self.timer = None
+
+class ReactorMultiClientServer(MultiClientServer):
+    """Non-blocking selectors engine (epoll on Linux) serving every client from one thread"""
+    # Seconds the listener sits out after accept() fails for lack of descriptors or memory
+    ACCEPT_BACKOFF = 0.5
+
+    def __init__(self, host='localhost', port=12345, max_clients=10, logger=None, socket_options=None,
+                 idle_timeout=300.0, read_timeout=30.0, drain_timeout=30.0, handoff_path=None):
+        super().__init__(host, port, max_clients, logger=logger, socket_options=socket_options,
+                         idle_timeout=idle_timeout, read_timeout=read_timeout,
+                         drain_timeout=drain_timeout, handoff_path=handoff_path)
+        self.selector = selectors.DefaultSelector()
+        self.connections = {}
+        # Set while the listener is out of the selector after a failed accept()
+        self.accept_paused_until = None
+
+    def accept_clients(self, server_socket):
+        """Accept every pending connection on the listening socket"""
+        while True:
+            try:
+                client_socket, address = server_socket.accept()
+            except (BlockingIOError, InterruptedError):
+                return
+            except ConnectionAbortedError:
+                # The client gave up while still in the backlog; the next one may be fine
+                self.log.debug("Connection aborted before accept")
+                continue
+            except OSError as e:
+                # EMFILE/ENFILE/ENOBUFS: the connection stays queued, and a level-triggered
+                # listener would wake us for it on every pass, so stop watching it for a while
+                level = self.log.warning if e.errno in (errno.EMFILE, errno.ENFILE) else self.log.error
+                level("accept() failed, pausing for {}s: {}", self.ACCEPT_BACKOFF, e)
+                self.selector.unregister(server_socket)
+                self.accept_paused_until = time.monotonic() + self.ACCEPT_BACKOFF
+                return
+            self.client_counter += 1
+            
+            # Check if we've reached max clients
+            if self.active_clients >= self.max_clients:
+                self.reject_client(client_socket, address)
+                continue
+            
+            client_socket.setblocking(False)
+            self.socket_options.apply_client(client_socket)
+            conn = ReactorConnection(client_socket, address, self.client_counter)
+            # Reaped from the event loop below, so the callback can close the connection directly
+            conn.timer = self.reaper.track(lambda conn=conn: self.expire_client(conn.client_id,
+                                                                                lambda: self.close_client(conn)))
+            # The read-side shutdown shows up as EOF in service_client, which then closes the connection
+            self.graceful.track(conn.timer, lambda conn=conn: shutdown_read(conn.sock))
+            self.connections[client_socket.fileno()] = conn
+            self.selector.register(client_socket, selectors.EVENT_READ, conn)
+            self.client_connected(conn.client_id, address)
+
+    def service_client(self, conn):
+        """Read whatever the client sent and run it through the message hook"""
+        try:
+            nbytes = conn.sock.recv_into(conn.buffer)
+        except (BlockingIOError, InterruptedError):
+            return
+        except ConnectionResetError:
+            self.log.warning("Client {} disconnected unexpectedly", conn.client_id)
+            self.close_client(conn)
+            return
+        except OSError as e:
+            # ETIMEDOUT from keepalive and the like end this client, not the event loop
+            self.log.warning("Client {} connection error: {}", conn.client_id, e)
+            self.close_client(conn)
+            return
+        
+        if not nbytes:
+            self.close_client(conn)
+            return
+        
+        try:
+            message = conn.decoder.decode(conn.view[:nbytes])
+            conn.timer.touch(partial=not message)
+            # An empty string means we only have part of a character so far
+            if message and not self.process_message(conn.client_id, message):
+                self.close_client(conn)
+        except Exception as e:
+            self.log.error("Error handling client {}: {}", conn.client_id, e)
+            self.close_client(conn)
+
+    def close_client(self, conn):
+        self.reaper.untrack(conn.timer)
+        self.graceful.untrack(conn.timer)
+        self.selector.unregister(conn.sock)
+        del self.connections[conn.sock.fileno()]
+        conn.sock.close()
+        self.client_disconnected(conn.client_id)
+
+    def start_server(self):
+        raise_fd_limit()
+        
+        server_socket = self.create_server_socket()
+        server_socket.setblocking(False)
+        
+        self.selector.register(server_socket, selectors.EVENT_READ, None)
+        # Called from a signal handler or the handoff thread, so the loop below does the actual work
+        self.graceful.start(server_socket, lambda: None)
+        accepting = True
+        print(f"Reactor server listening on {self.host}:{self.port} ({type(self.selector).__name__})")
+        print(f"Maximum clients supported: {self.max_clients}")
+        
+        self.client_counter = 0
+        
+        try:
+            # Event loop: the listening socket carries no data, clients carry their connection
+            while True:
+                # Wakes at least once per reaper tick even when no client sends anything
+                for key, _ in self.selector.select(self.reaper.tick):
+                    if key.data is None:
+                        self.accept_clients(key.fileobj)
+                    else:
+                        self.service_client(key.data)
+                self.reaper.reap()
+                
+                paused = self.accept_paused_until is not None
+                if paused and accepting and time.monotonic() >= self.accept_paused_until:
+                    self.accept_paused_until = None
+                    paused = False
+                    self.selector.register(server_socket, selectors.EVENT_READ, None)
+                
+                if self.graceful.draining:
+                    if accepting:
+                        accepting = False
+                        if not paused:
+                            self.selector.unregister(server_socket)
+                        server_socket.close()
+                        self.announce_drain()
+                    # Drained once every connection has closed, or cut off at the deadline
+                    if not self.graceful.close_idle() or self.graceful.overdue():
+                        self.report_drain(self.graceful.finish())
+                        break
                 
         except KeyboardInterrupt:
             print("\nServer shutting down...")
         finally:
+            for conn in list(self.connections.values()):
+                self.close_client(conn)
+            self.selector.close()
             server_socket.close()
 
 if __name__ == "__main__":
-    server = MultiClientServer()
+    # Usage: python "Multic-client-TCP-server-10-clients.py" [threaded|reactor] [max_clients]
+    # Starting a second server takes over the port from the first, which then drains and exits
+    engine = sys.argv[1] if len(sys.argv) > 1 else "threaded"
+    max_clients = int(sys.argv[2]) if len(sys.argv) > 2 else 10
+    handoff_path = default_handoff_path('multi-client-server', 12345)
+    
+    if engine == "reactor":
+        server = ReactorMultiClientServer(max_clients=max_clients, handoff_path=handoff_path)
+    else:
+        server = MultiClientServer(max_clients=max_clients, handoff_path=handoff_path)
     server.start_server()
 
 
@@ -1,150 +1,880 @@
 
 # SERVER CODE (step3_server.py)
+import asyncio
+import itertools
+import os
 import socket
+import sys
 import threading
 import time
-from datetime import datetime
+
+from async_logger import AsyncLogger
+from binary_protocol import (ACK_BODY, BINARY_ACK, BINARY_FEATURE, BINARY_HEADER, BINARY_REQUEST, OP_ACK, OP_ECHO,
+                             OP_PUBLISH, OP_QUIT, OP_SUBSCRIBE, OP_UNSUBSCRIBE, OpcodeTable, unpack_topic,
+                             write_error)
+from compression import PROTO_ERROR, CompressionError, CompressionOptions
+from framing import FRAMED_ACK, FRAMED_FEATURE, FRAMED_REQUEST, write_frame
+from graceful import AcceptLoop, GracefulShutdown, default_handoff_path, shutdown_read
+from idle_reaper import IdleReaper, shutdown_socket
+from instrumentation import ConnectionMetrics, Instruments, MetricsEndpoint
+from journal import BINARY, TEXT, Journal
+from prefork import GlobalSlots, PreforkSupervisor, SharedCounters
+from pubsub import CONFLATE, AsyncFanoutWriter, FanoutWriter, PubSub
+from receive_buffer import ReceiveBuffer
+from response_templates import ReplyBuffer, ReplyTemplate, TimestampCache
+from server_stats import ServerStats
+from socket_io import OutputBuffer, SocketOptions, raise_fd_limit
+from worker_pool import AdmissionPool
+
+# Optional protocol features advertised in the welcome banner
+SERVER_FEATURES = [FRAMED_FEATURE, BINARY_FEATURE]
+
+# Replies are encoded once here; only the fields are filled in per message
+REPLY = ReplyTemplate("Server received: '%b' (Message #%d) at %b")
+GOODBYE = ReplyTemplate("Goodbye Client %d! Connection closing.")
+WELCOME = ReplyTemplate("Welcome Client %d! You are connected to the server. Features: %b")
+REJECT_REPLY = b"Server full. Please try again later."
+SHUTDOWN_REPLY = b"Server shutting down. Please try again later."
+FRAMED_ACK_REPLY = FRAMED_ACK.encode('utf-8')
+BINARY_ACK_REPLY = BINARY_ACK.encode('utf-8')
+# Sent instead of the reply when the journal refused the message, which is then not processed
+JOURNAL_FULL = "journal full, message not processed"
+JOURNAL_FULL_REPLY = f"{PROTO_ERROR} {JOURNAL_FULL}".encode('utf-8')
+
+# Lets a framed connection check for more pipelined requests before flushing replies
+MSG_DONTWAIT = getattr(socket, 'MSG_DONTWAIT', 0)
 
 class ResponseServer:
-    def __init__(self, host='localhost', port=12345, max_clients=10):
+    def __init__(self, host='localhost', port=12345, max_clients=10, reuse_port=False,
+                 queue_size=None, queue_timeout=5.0, logger=None, socket_options=None, compression=None,
+                 idle_timeout=300.0, read_timeout=30.0, drain_timeout=30.0, handoff_path=None, rate_limit=None,
+                 metrics_port=None, tracer=None, sample_every=16, push_queue=1024, slow_consumer=CONFLATE,
+                 journal=None):
         self.host = host
         self.port = port
         self.max_clients = max_clients
+        self.reuse_port = reuse_port
+        # TCP_NODELAY, TCP_CORK, SO_SNDBUF/SO_RCVBUF, keepalive and the listen backlog
+        self.socket_options = socket_options or SocketOptions()
+        # Silent or half-open clients are closed so their slots go back to live ones
+        self.reaper = IdleReaper(idle_timeout, read_timeout)
+        # SIGTERM, or handing the listener to a new process, drains clients instead of dropping them
+        self.graceful = GracefulShutdown(drain_timeout, handoff_path)
         self.active_clients = 0
         self.client_lock = threading.Lock()
-        self.message_count = 0
+        # next() on itertools.count is atomic, so message numbers need no lock
+        self.message_numbers = itertools.count(1)
+        self.server_stats = ServerStats()
+        self.messages = self.server_stats.counter('messages')
+        self.connections = self.server_stats.counter('connections')
+        self.rejected = self.server_stats.counter('rejected')
+        self.message_sizes = self.server_stats.histogram('message_size', 'bytes')
+        self.handle_times = self.server_stats.histogram('handle_time', 'us')
+        self.server_stats.gauge('active_clients', lambda: self.active_clients)
+        self.server_stats.gauge('admission', self.admission_metrics)
+        self.server_stats.gauge('reaper', self.reaper.stats)
+        self.server_stats.gauge('graceful', self.graceful.stats)
+        # Optional RateLimiter: a client over its budget has its next read delayed, which
+        # pushes back through TCP flow control instead of dropping anything
+        self.rate_limit = rate_limit
+        self.throttled = self.server_stats.counter('throttled')
+        self.server_stats.gauge('rate_limit', lambda: self.rate_limit.stats() if self.rate_limit else {})
+        self.server_stats.gauge('logger', lambda: self.log.stats())
+        # Added when a compressed connection closes
+        self.compression_saved = self.server_stats.counter('compression_bytes_saved')
+        self.compression_cpu = self.server_stats.counter('compression_cpu_us')
+        # Stage timers (one message in sample_every), per-connection counters and tracer hooks;
+        # with metrics_port set they are served, with everything above, for Prometheus to scrape
+        self.instruments = Instruments(self.server_stats, sample_every, tracer)
+        self.metrics_port = metrics_port
+        self.metrics_endpoint = None
+        # Clients beyond max_clients wait up to queue_timeout seconds for a free worker
+        self.queue_size = max_clients * 2 if queue_size is None else queue_size
+        self.queue_timeout = queue_timeout
+        self.pool = None
+        # Per-message logging goes through a batched background writer
+        self.log = logger or AsyncLogger()
+        self.timestamps = TimestampCache()
+        self.reply = REPLY
+        # Codecs and shared dictionaries offered to framed clients
+        self.compression_options = compression or CompressionOptions()
+        self.features = ' '.join(SERVER_FEATURES + self.compression_options.offer()).encode('utf-8')
+        # Binary mode handlers by opcode; applications register theirs from FIRST_APPLICATION_OPCODE up
+        self.opcodes = OpcodeTable()
+        self.opcodes.register(OP_ECHO, self.binary_echo, 'echo')
+        self.opcodes.register(OP_ACK, self.binary_ack, 'ack')
+        self.opcodes.register(OP_QUIT, self.binary_quit, 'quit')
+        # Topic pushes to binary-mode clients, each with a bounded queue of push_queue updates;
+        # slow_consumer decides what happens when one fills up (pubsub.CONFLATE or DISCONNECT)
+        self.pubsub = PubSub(push_queue, slow_consumer)
+        self.server_stats.gauge('pubsub', self.pubsub.stats)
+        self.opcodes.register(OP_SUBSCRIBE, self.binary_subscribe, 'subscribe')
+        self.opcodes.register(OP_UNSUBSCRIBE, self.binary_unsubscribe, 'unsubscribe')
+        self.opcodes.register(OP_PUBLISH, self.binary_publish, 'publish')
+        # Optional Journal: every message received is queued for a durable audit record,
+        # which its writer thread group-commits to disk off the hot path
+        self.journal = journal
+        self.server_stats.gauge('journal', lambda: self.journal.stats() if self.journal else {})
         
-    def handle_client(self, client_socket, address, client_id):
-        """Handle individual client connection with responses"""
+    def admit_client(self):
+        """Reserve a client slot; returns False when the server is full"""
         with self.client_lock:
+            if self.active_clients >= self.max_clients:
+                return False
             self.active_clients += 1
-            current_clients = self.active_clients
+            return True
+
+    def release_client(self):
+        """Free a slot taken by admit_client; returns the remaining client count"""
+        with self.client_lock:
+            self.active_clients -= 1
+            return self.active_clients
+
+    def reject_client(self, client_socket, address):
+        self.rejected.add()
+        self.log.warning("Maximum clients reached. Rejecting client {}", address)
+        try:
+            client_socket.sendall(REJECT_REPLY)
+        except OSError:
+            pass
+        client_socket.close()
+
+    def turn_away_client(self, client_socket, address):
+        """Close a connection that was still waiting for a worker when the drain began"""
+        self.log.info("Server shutting down. Turning away queued client {}", address)
+        try:
+            client_socket.sendall(SHUTDOWN_REPLY)
+        except OSError:
+            pass
+        client_socket.close()
+
+    def admission_metrics(self):
+        """Queue depth and wait times of the admission queue"""
+        return self.pool.metrics() if self.pool else {}
+
+    def expire_client(self, client_id, close):
+        """Reaper callback: close a connection that timed out"""
+        self.log.warning("Client {} timed out; closing connection", client_id)
+        close()
+
+    def throttle_delay(self, address, messages=1):
+        """Charge messages to the client's token bucket; returns how long to wait before reading again"""
+        if self.rate_limit is None:
+            return 0.0
+        delay = self.rate_limit.reserve(address[0], messages)
+        if delay:
+            self.throttled.add()
+        return delay
+
+    def announce_drain(self):
+        print("\nServer stopped accepting" + (" (handed off)" if self.graceful.handed_off else ""))
+        print(f"Draining {self.active_clients} clients (up to {self.graceful.drain_timeout}s)...")
+
+    def report_drain(self, finished):
+        if finished:
+            print("All clients finished")
+        else:
+            print(f"Drain timeout: closing {self.graceful.cut} clients")
+
+    @property
+    def message_count(self):
+        return self.messages.value
+
+    def next_message_number(self):
+        self.messages.add()
+        return next(self.message_numbers)
+
+    def record_message(self, size, started_ns):
+        """Message size and receive-to-reply time, recorded without taking a lock"""
+        self.message_sizes.record(size)
+        self.handle_times.record((time.perf_counter_ns() - started_ns) // 1000)
+
+    def stats_snapshot(self):
+        """Counters, gauges and histograms as a dict"""
+        return self.server_stats.snapshot()
+
+    def stats_json(self):
+        return self.server_stats.to_json()
+
+    def stats_prometheus(self):
+        return self.server_stats.to_prometheus('response_server')
+
+    def start_metrics_endpoint(self):
+        if self.metrics_port is not None:
+            self.metrics_endpoint = MetricsEndpoint(self.stats_prometheus, port=self.metrics_port).start()
+            print(f"Metrics at http://127.0.0.1:{self.metrics_endpoint.port}/metrics")
+
+    def welcome_message(self, client_id):
+        return WELCOME.render(client_id, self.features)
+
+    def journal_append(self, client_id, data, kind=TEXT):
+        """Queue a message for the journal; False if it refused the message"""
+        return self.journal.append(client_id, data, kind)
+
+    def build_response(self, client_id, message, raw=None):
+        """Log a message and build its encoded reply; returns (reply, keep_open)"""
+        self.log.debug("Client {}: {}", client_id, message)
+        
+        # Echo the bytes as received rather than re-encoding the decoded text
+        if raw is None:
+            raw = message.encode('utf-8')
+        if self.journal is not None and not self.journal_append(client_id, raw):
+            return JOURNAL_FULL_REPLY, True
+        message_number = self.next_message_number()
         
-        print(f"Client {client_id} ({address}) connected. Active clients: {current_clients}")
+        # Length first: almost no message is four characters long, so most skip the lower()
+        if len(message) == 4 and message.lower() == 'quit':
+            return GOODBYE.render(client_id), False
         
-        # Send welcome message
-        welcome_msg = f"Welcome Client {client_id}! You are connected to the server."
-        client_socket.send(welcome_msg.encode('utf-8'))
+        return self.reply.render(raw, message_number, self.timestamps.encoded()), True
+
+    def framed_compression(self, message):
+        """The compression a framing request asked for (None if none); raises CompressionError"""
+        return self.compression_options.accept(message[len(FRAMED_REQUEST):], exact=True, stream=True)
+
+    def record_compression(self, client_id, compression):
+        stats = compression.stats()
+        self.compression_saved.add(stats['bytes_saved'])
+        self.compression_cpu.add((compression.compress_ns + compression.decompress_ns) // 1000)
+        self.log.info("Client {} compression: {}", client_id, stats)
+
+    def build_framed_replies(self, client_id, payloads, out, compression=None):
+        """Append one framed reply per payload to out; returns (sizes, keep_open)"""
+        sizes = []
+        keep_open = True
+        for payload in payloads:
+            if compression is not None:
+                payload = compression.decode(payload)
+            response, keep_open = self.build_response(client_id, str(payload, 'utf-8'), payload)
+            write_frame(out, compression.encode(response) if compression is not None else response)
+            sizes.append(len(payload))
+            if not keep_open:
+                break
+        return sizes, keep_open
+
+    def binary_echo(self, client_id, payload):
+        # Queued replies outlive the receive buffer the payload points into
+        return bytes(payload), True
+
+    def binary_ack(self, client_id, payload):
+        return ACK_BODY.pack(next(self.message_numbers) & 0xFFFFFFFF), True
+
+    def binary_quit(self, client_id, payload):
+        return b'', False
+
+    def binary_subscribe(self, client_id, payload):
+        self.pubsub.subscribe(client_id, str(payload, 'utf-8'))
+        return b'', True
+
+    def binary_unsubscribe(self, client_id, payload):
+        self.pubsub.unsubscribe(client_id, str(payload, 'utf-8'))
+        return b'', True
+
+    def binary_publish(self, client_id, payload):
+        topic, body = unpack_topic(payload)
+        return ACK_BODY.pack(self.publish(topic, body)), True
+
+    def publish(self, topic, payload):
+        """Push payload to every binary-mode client subscribed to topic; returns how many"""
+        return self.pubsub.publish(topic, payload)
+
+    def broadcast(self, payload, topic=''):
+        """Push payload to every binary-mode client, subscribed or not; returns how many"""
+        return self.pubsub.broadcast(payload, topic)
+
+    def build_binary_replies(self, client_id, messages, out):
+        """Dispatch binary messages by opcode, appending each reply to out; returns (sizes, keep_open)"""
+        sizes = []
+        keep_open = True
+        dispatch = self.opcodes.dispatch
+        journal = self.journal
+        for opcode, flags, request_id, payload in messages:
+            if journal is not None and not self.journal_append(client_id, bytes((opcode,)) + payload, BINARY):
+                write_error(out, opcode, request_id, JOURNAL_FULL)
+            else:
+                keep_open = dispatch(client_id, opcode, request_id, payload, out)
+            sizes.append(BINARY_HEADER.size + len(payload))
+            if not keep_open:
+                break
+        if sizes:
+            self.messages.add(len(sizes))
+            self.log.debug("Client {}: {} binary messages", client_id, len(sizes))
+        return sizes, keep_open
+
+    def switch_protocol(self, message):
+        """'framed' or 'binary' if message asks to leave text mode, else None"""
+        if message == FRAMED_REQUEST or message.startswith(FRAMED_REQUEST + ' '):
+            return 'framed'
+        if message == BINARY_REQUEST:
+            return 'binary'
+        return None
+
+    def handle_client(self, client_socket, address, client_id):
+        """Handle individual client connection with responses"""
+        # The slot was already taken by admit_client before the handler runs
+        self.connections.add()
+        self.log.info("Client {} ({}) connected. Active clients: {}", client_id, address, self.active_clients)
+        compression = None
+        # Shutting the socket down wakes this thread out of recv (or a stuck sendall) with EOF
+        timer = self.reaper.track(lambda: self.expire_client(client_id, lambda: shutdown_socket(client_socket)))
+        # While draining, a read-side shutdown ends the connection after its current reply
+        self.graceful.track(timer, lambda: shutdown_read(client_socket))
+        connection = self.instruments.open(client_id, address)
+        if self.journal is not None:
+            self.journal.connected(client_id, address)
+        subscriber = None
         
         try:
+            self.socket_options.apply_client(client_socket)
+            
+            # Send welcome message
+            welcome = self.welcome_message(client_id)
+            client_socket.sendall(welcome)
+            connection.sent(len(welcome), 0)
+            
+            # Read into one buffer for the life of the connection
+            inbox = ReceiveBuffer()
             while True:
-                # Receive message from client
-                message = client_socket.recv(1024).decode('utf-8')
-                if not message:
+                # Receive message from client; sampled messages are timed stage by stage
+                nbytes = self.instruments.recv_into(connection, inbox, client_socket, 1024)
+                if not nbytes:
                     break
+                started = time.perf_counter_ns()
+                message, raw = inbox.read_text()
+                timer.touch(partial=bool(inbox))
+                if not message:
+                    continue  # Only the first bytes of a character so far
+                if connection.mark:
+                    connection.lap('decode')
                 
-                self.message_count += 1
-                timestamp = datetime.now().strftime("%H:%M:%S")
-                print(f"[{timestamp}] Client {client_id}: {message}")
-                
-                if message.lower() == 'quit':
-                    goodbye_msg = f"Goodbye Client {client_id}! Connection closing."
-                    client_socket.send(goodbye_msg.encode('utf-8'))
+                # Client switched to length-prefixed frames, compressed if it asked for that too,
+                # or to binary messages
+                protocol = self.switch_protocol(message)
+                if protocol == 'framed':
+                    try:
+                        compression = self.framed_compression(message)
+                    except CompressionError as e:
+                        client_socket.sendall(f"{PROTO_ERROR} {e}".encode('utf-8'))
+                        break
+                    client_socket.sendall(FRAMED_ACK_REPLY)
+                    self.serve_framed(client_socket, client_id, inbox, compression, timer, address, connection)
+                    break
+                if protocol == 'binary':
+                    client_socket.sendall(BINARY_ACK_REPLY)
+                    # Pushes only make sense where messages have boundaries, so only binary clients get them
+                    subscriber = self.pubsub.register(client_id, client_socket, lambda: shutdown_socket(client_socket),
+                                                      timer)
+                    self.serve_framed(client_socket, client_id, inbox, None, timer, address, connection, True)
                     break
                 
                 # Send response back to client
-                response = f"Server received: '{message}' (Message #{self.message_count}) at {timestamp}"
-                client_socket.send(response.encode('utf-8'))
+                response, keep_open = self.build_response(client_id, message, raw)
+                if connection.mark:
+                    connection.lap('build')
+                # A single reply goes out at once; sendall also resumes after a short write
+                client_socket.sendall(response)
+                connection.sent(len(response))
+                if connection.mark:
+                    connection.lap('send')
+                self.record_message(nbytes, started)
+                if not keep_open:
+                    break
+                delay = self.throttle_delay(address)
+                if delay:
+                    time.sleep(delay)
                     
         except ConnectionResetError:
-            print(f"Client {client_id} disconnected unexpectedly")
+            self.log.warning("Client {} disconnected unexpectedly", client_id)
         except Exception as e:
-            print(f"Error handling client {client_id}: {e}")
+            self.log.error("Error handling client {}: {}", client_id, e)
         finally:
+            self.reaper.untrack(timer)
+            self.graceful.untrack(timer)
+            self.instruments.close(connection)
+            if subscriber is not None:
+                # Before the close, so the push writer never sends on a reused descriptor
+                with subscriber.send_lock:
+                    self.pubsub.unregister(subscriber)
             client_socket.close()
-            with self.client_lock:
-                self.active_clients -= 1
-                remaining_clients = self.active_clients
-            print(f"Client {client_id} disconnected. Active clients: {remaining_clients}")
+            if compression is not None:
+                self.record_compression(client_id, compression)
+            remaining_clients = self.release_client()
+            self.log.info("Client {} disconnected. Active clients: {}", client_id, remaining_clients)
 
-    def start_server(self):
+    def serve_framed(self, client_socket, client_id, inbox=None, compression=None, timer=None, address=None,
+                     connection=None, binary=False):
+        """Framed (or binary) mode: one read may carry many pipelined requests, answered in order"""
+        inbox = inbox or ReceiveBuffer()
+        # Pushes to this client are written by another thread, so replies take turns with them
+        out = OutputBuffer(client_socket, self.socket_options, guard=self.pubsub.get(client_id) if binary else None)
+        # Called on its own, the connection is counted here but not listed among the open ones
+        connection = connection or ConnectionMetrics(self.instruments, client_id, address)
+        unflushed = []  # (sizes, started) of batches whose replies are still in out
+        while True:
+            if out and (not MSG_DONTWAIT or out.full()):
+                self.flush_replies(out, unflushed, connection)
+            try:
+                # While replies are queued, only read requests that have already arrived
+                nbytes = self.instruments.recv_into(connection, inbox, client_socket,
+                                                    flags=MSG_DONTWAIT if out else 0)
+            except BlockingIOError:
+                # The client is waiting on us: send everything queued in one sendmsg
+                self.flush_replies(out, unflushed, connection)
+                continue
+            if not nbytes:
+                self.flush_replies(out, unflushed, connection)
+                return
+            started = time.perf_counter_ns()
+            
+            # Frames are decoded as they are answered, so decode and build are one stage here
+            if binary:
+                sizes, keep_open = self.build_binary_replies(client_id, inbox.messages(), out)
+            else:
+                sizes, keep_open = self.build_framed_replies(client_id, inbox.frames(), out, compression)
+            if connection.mark:
+                connection.lap('build')
+            if timer is not None:
+                # A partly received frame puts the connection on the read timeout
+                timer.touch(partial=bool(inbox))
+            unflushed.append((sizes, started))
+            if not keep_open:
+                self.flush_replies(out, unflushed, connection)
+                return
+            delay = self.throttle_delay(address, len(sizes)) if address is not None else 0.0
+            if delay:
+                # Answer what was already read before making the client wait
+                self.flush_replies(out, unflushed, connection)
+                time.sleep(delay)
+
+    def flush_replies(self, out, unflushed, connection=None):
+        nbytes = len(out)
+        # A flush carries many replies, so it is sampled on its own rather than with one message
+        if connection is not None and connection.sample():
+            out.flush()
+            connection.lap('send')
+        else:
+            out.flush()
+        # Every request in a batch waited for the flush that carried its reply
+        messages = 0
+        for sizes, started in unflushed:
+            messages += len(sizes)
+            for size in sizes:
+                self.record_message(size, started)
+        if connection is not None:
+            connection.sent(nbytes, messages)
+        unflushed.clear()
+
+    def create_server_socket(self):
         server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if self.reuse_port:
+            # Several processes share the port and the kernel balances connections
+            server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        
+        self.socket_options.apply_listener(server_socket)
         
         server_socket.bind((self.host, self.port))
-        server_socket.listen(self.max_clients)
+        server_socket.listen(self.socket_options.listen_backlog(self.max_clients))
+        return server_socket
+
+    def start_server(self):
+        # A server already running with our handoff path passes us its listener and drains
+        server_socket = self.graceful.inherit_listener()
+        if server_socket is not None:
+            print("Took over the listening socket from the running server")
+        else:
+            server_socket = self.create_server_socket()
         
         print(f"Response Server listening on {self.host}:{self.port}")
         print(f"Maximum clients supported: {self.max_clients}")
         
+        # One worker per client slot; the slot is taken by the worker itself, so there is
+        # no window between checking active_clients and counting the new client
+        self.pool = AdmissionPool(
+            self.handle_client, self.reject_client,
+            workers=self.max_clients, queue_size=self.queue_size,
+            queue_timeout=self.queue_timeout, admit=self.admit_client
+        )
+        self.pool.start()
+        self.reaper.start()
+        FanoutWriter(self.pubsub).start()
+        self.start_metrics_endpoint()
+        accepts = AcceptLoop(server_socket, self.instruments.accepted)
+        self.graceful.start(server_socket, accepts.stop)
+        
         client_counter = 0
         
         try:
             while True:
-                client_socket, address = server_socket.accept()
+                accepted = accepts.accept()
+                if accepted is None:
+                    break  # SIGTERM or handoff
+                client_socket, address = accepted
                 client_counter += 1
                 
-                with self.client_lock:
-                    if self.active_clients >= self.max_clients:
-                        print(f"Maximum clients reached. Rejecting client {address}")
-                        reject_msg = "Server full. Please try again later."
-                        client_socket.send(reject_msg.encode('utf-8'))
-                        client_socket.close()
-                        continue
-                
-                client_thread = threading.Thread(
-                    target=self.handle_client, 
-                    args=(client_socket, address, client_counter)
-                )
-                client_thread.daemon = True
-                client_thread.start()
+                # Waits for a free worker; rejected only if the queue is full or the wait times out
+                self.pool.submit(client_socket, address, client_counter)
                 
         except KeyboardInterrupt:
             print("\nServer shutting down...")
         finally:
+            accepts.close()
+            # After a handoff this only closes our copy; the new process keeps listening
             server_socket.close()
+        
+        if self.graceful.draining:
+            # Queued clients were never tracked, so the drain would not wait for them
+            self.pool.stop(self.turn_away_client)
+            self.announce_drain()
+            self.report_drain(self.graceful.drain())
+
+class AsyncResponseServer(ResponseServer):
+    """Same protocol as ResponseServer, but one event loop instead of one thread per client"""
+    def __init__(self, host='localhost', port=12345, max_clients=10, reuse_port=False, logger=None,
+                 socket_options=None, compression=None, idle_timeout=300.0, read_timeout=30.0,
+                 drain_timeout=30.0, handoff_path=None, rate_limit=None, metrics_port=None, tracer=None,
+                 sample_every=16, push_queue=1024, slow_consumer=CONFLATE, journal=None):
+        super().__init__(host, port, max_clients, reuse_port, logger=logger, socket_options=socket_options,
+                         compression=compression, idle_timeout=idle_timeout, read_timeout=read_timeout,
+                         drain_timeout=drain_timeout, handoff_path=handoff_path, rate_limit=rate_limit,
+                         metrics_port=metrics_port, tracer=tracer, sample_every=sample_every,
+                         push_queue=push_queue, slow_consumer=slow_consumer, journal=journal)
+        self.client_counter = 0
+
+    def journal_append(self, client_id, data, kind=TEXT):
+        # On the event loop, which must never wait for the disk: a full journal refuses instead
+        return self.journal.append(client_id, data, kind, block=False)
+
+    async def handle_client(self, reader, writer):
+        """Handle individual client connection with responses"""
+        # Everything runs on the loop thread, so no lock is needed for the counters
+        self.client_counter += 1
+        client_id = self.client_counter
+        address = writer.get_extra_info('peername')
+
+        if not self.admit_client():
+            self.rejected.add()
+            self.log.warning("Maximum clients reached. Rejecting client {}", address)
+            writer.write(REJECT_REPLY)
+            await self.close_writer(writer)
+            return
+
+        self.connections.add()
+        self.log.info("Client {} ({}) connected. Active clients: {}", client_id, address, self.active_clients)
+        compression = None
+        # The reaper runs on this loop, so aborting the transport is safe; the read below then sees EOF
+        timer = self.reaper.track(lambda: self.expire_client(client_id, writer.transport.abort))
+        # The stream reports EOF after what was already received, and the writer finishes first
+        self.graceful.track(timer, lambda: shutdown_read(writer.get_extra_info('socket')))
+        connection = self.instruments.open(client_id, address)
+        if self.journal is not None and not self.journal.connected(client_id, address, block=False):
+            self.log.warning("Journal full: client {} ({}) not recorded", client_id, address)
+        subscriber = None
+
+        try:
+            # asyncio turns TCP_NODELAY on by itself; this applies whatever was configured instead
+            self.socket_options.apply_client(writer.get_extra_info('socket'))
+
+            # Send welcome message
+            welcome = self.welcome_message(client_id)
+            writer.write(welcome)
+            connection.sent(len(welcome), 0)
+
+            # StreamReader already hands us bytes, so the buffer here is for split characters and frames
+            inbox = ReceiveBuffer(4096)
+            while True:
+                # Receive message from client; the loop does the recv, so timing starts after it
+                data = await reader.read(1024)
+                if not data:
+                    break
+                started = time.perf_counter_ns()
+                connection.bytes_in += len(data)
+                connection.sample()
+                inbox.write(data)
+                message, raw = inbox.read_text()
+                timer.touch(partial=bool(inbox))
+                if not message:
+                    continue
+                if connection.mark:
+                    connection.lap('decode')
+
+                # Client switched to length-prefixed frames, compressed if it asked for that too,
+                # or to binary messages
+                protocol = self.switch_protocol(message)
+                if protocol == 'framed':
+                    try:
+                        compression = self.framed_compression(message)
+                    except CompressionError as e:
+                        writer.write(f"{PROTO_ERROR} {e}".encode('utf-8'))
+                        break
+                    writer.write(FRAMED_ACK_REPLY)
+                    await self.serve_framed(reader, writer, client_id, compression, timer, address, connection)
+                    break
+                if protocol == 'binary':
+                    writer.write(BINARY_ACK_REPLY)
+                    # Pushes are written on this loop too, between whole replies. A slow consumer is
+                    # closed from whichever thread published, and transports are not thread-safe
+                    loop = asyncio.get_running_loop()
+                    subscriber = self.pubsub.register(client_id, writer.transport,
+                                                      lambda: loop.call_soon_threadsafe(writer.transport.abort), timer)
+                    await self.serve_framed(reader, writer, client_id, None, timer, address, connection, True)
+                    break
+
+                # Send response back to client
+                response, keep_open = self.build_response(client_id, message, raw)
+                if connection.mark:
+                    connection.lap('build')
+                writer.write(response)
+                await writer.drain()
+                connection.sent(len(response))
+                if connection.mark:
+                    connection.lap('send')
+                self.record_message(len(data), started)
+                if not keep_open:
+                    break
+                delay = self.throttle_delay(address)
+                if delay:
+                    await asyncio.sleep(delay)
+
+        except ConnectionResetError:
+            self.log.warning("Client {} disconnected unexpectedly", client_id)
+        except Exception as e:
+            self.log.error("Error handling client {}: {}", client_id, e)
+        finally:
+            self.reaper.untrack(timer)
+            self.graceful.untrack(timer)
+            self.instruments.close(connection)
+            if subscriber is not None:
+                self.pubsub.unregister(subscriber)
+            await self.close_writer(writer)
+            if compression is not None:
+                self.record_compression(client_id, compression)
+            remaining_clients = self.release_client()
+            self.log.info("Client {} disconnected. Active clients: {}", client_id, remaining_clients)
+
+    async def serve_framed(self, reader, writer, client_id, compression=None, timer=None, address=None,
+                           connection=None, binary=False):
+        """Framed (or binary) mode: one read may carry many pipelined requests, answered in order"""
+        inbox = ReceiveBuffer()
+        out = ReplyBuffer()
+        # Called on its own, the connection is counted here but not listed among the open ones
+        connection = connection or ConnectionMetrics(self.instruments, client_id, address)
+        while True:
+            data = await reader.read(65536)
+            if not data:
+                return
+            started = time.perf_counter_ns()
+            connection.bytes_in += len(data)
+            connection.sample()
+            inbox.write(data)
+
+            out.reset()
+            if binary:
+                sizes, keep_open = self.build_binary_replies(client_id, inbox.messages(), out)
+            else:
+                sizes, keep_open = self.build_framed_replies(client_id, inbox.frames(), out, compression)
+            if connection.mark:
+                connection.lap('build')
+            if timer is not None:
+                timer.touch(partial=bool(inbox))
+
+            if out:
+                # The transport may hold on to what it cannot send yet, so it gets a copy
+                # rather than a view into a buffer the next batch will overwrite
+                writer.write(bytes(out.getvalue()))
+                await writer.drain()
+                connection.sent(len(out), len(sizes))
+                if connection.mark:
+                    connection.lap('send')
+            for size in sizes:
+                self.record_message(size, started)
+            if not keep_open:
+                return
+            delay = self.throttle_delay(address, len(sizes)) if address is not None else 0.0
+            if delay:
+                await asyncio.sleep(delay)
+
+    async def close_writer(self, writer):
+        """Close a client stream, ignoring errors from peers that already went away"""
+        writer.close()
+        try:
+            await writer.wait_closed()
+        except (ConnectionError, OSError):
+            pass
+
+    async def serve(self):
+        # The listener is built like the threaded one's so the same socket options apply;
+        # asyncio calls listen() again with this backlog
+        listener = self.graceful.inherit_listener()
+        if listener is not None:
+            print("Took over the listening socket from the running server")
+        else:
+            listener = self.create_server_socket()
+        server = await asyncio.start_server(
+            self.handle_client, sock=listener,
+            backlog=self.socket_options.listen_backlog(self.max_clients)
+        )
+
+        print(f"Async Response Server listening on {self.host}:{self.port}")
+        print(f"Maximum clients supported: {self.max_clients}")
+        self.start_metrics_endpoint()
+
+        # SIGTERM and the handoff thread both end up here, on the loop
+        loop = asyncio.get_running_loop()
+        AsyncFanoutWriter(self.pubsub, loop)
+        stopping = asyncio.Event()
+        self.graceful.start(listener, lambda: loop.call_soon_threadsafe(stopping.set))
+
+        # One task advances the wheel for every connection, instead of a timer per connection
+        reaper = asyncio.create_task(self.reaper.run_async())
+        try:
+            async with server:
+                await stopping.wait()
+                # Stops accepting; the connections already open keep being served
+                server.close()
+                self.announce_drain()
+                self.report_drain(await self.graceful.drain_async())
+        finally:
+            reaper.cancel()
+
+    def start_server(self):
+        raise_fd_limit()
+        try:
+            asyncio.run(self.serve())
+        except KeyboardInterrupt:
+            print("\nServer shutting down...")
+
+class PreforkWorkerServer(ResponseServer):
+    """ResponseServer running inside one prefork worker process"""
+    def __init__(self, worker_id, slots, counters, host='localhost', port=12345, max_clients=10,
+                 socket_options=None, drain_timeout=30.0):
+        super().__init__(host, port, max_clients, reuse_port=True, socket_options=socket_options,
+                         drain_timeout=drain_timeout)
+        self.worker_id = worker_id
+        self.slots = slots
+        self.counters = counters
+        # Each worker numbers its own messages, so the label says whose count it is: "Message #w2-17"
+        self.reply = ReplyTemplate(f"Server received: '%b' (Message #w{worker_id}-%d) at %b")
+
+    def admit_client(self):
+        # max_clients is global, so the slot comes from the shared pool
+        if not self.slots.acquire(self.worker_id):
+            return False
+        with self.client_lock:
+            self.active_clients += 1
+        return True
+
+    def release_client(self):
+        self.slots.release(self.worker_id)
+        return super().release_client()
+
+    def next_message_number(self):
+        self.counters.add(self.worker_id, 'message_count')
+        return super().next_message_number()
+
+class PreforkResponseServer:
+    """Runs one ResponseServer per worker process, all sharing the port via SO_REUSEPORT"""
+    def __init__(self, host='localhost', port=12345, max_clients=10, workers=None, socket_options=None,
+                 drain_timeout=30.0):
+        self.host = host
+        self.port = port
+        self.max_clients = max_clients
+        self.socket_options = socket_options
+        self.drain_timeout = drain_timeout
+        self.workers = workers or os.cpu_count() or 1
+        self.slots = GlobalSlots(max_clients, self.workers)
+        self.counters = SharedCounters(self.workers, ['message_count'])
+        # Workers drain on the supervisor's SIGTERM; a new generation binds alongside with SO_REUSEPORT
+        self.supervisor = PreforkSupervisor(
+            self.run_worker, self.workers, counters=self.counters, slots=self.slots,
+            drain_timeout=drain_timeout
+        )
+
+    def run_worker(self, worker_id):
+        server = PreforkWorkerServer(
+            worker_id, self.slots, self.counters, self.host, self.port, self.max_clients,
+            socket_options=self.socket_options, drain_timeout=self.drain_timeout
+        )
+        server.start_server()
+
+    def stats(self):
+        """Global view of message_count and active_clients across all workers"""
+        return self.supervisor.stats()
+
+    def start_server(self):
+        print(f"Prefork Response Server starting {self.workers} workers on {self.host}:{self.port}")
+        self.supervisor.run()
 
 if __name__ == "__main__":
-    server = ResponseServer()
+    # Usage: python "TCP Server that Sends Response Messages.py" [threaded|async|prefork] [max_clients] [workers]
+    #        [--journal DIR]
+    # Starting a second threaded or async server takes over the port from the first, which then
+    # drains and exits: a restart without refused connections. SIGTERM alone just drains.
+    # --journal keeps a durable record of every message received (threaded and async only).
+    journal = None
+    if '--journal' in sys.argv:
+        index = sys.argv.index('--journal')
+        journal = Journal(sys.argv[index + 1])
+        del sys.argv[index:index + 2]
+    engine = sys.argv[1] if len(sys.argv) > 1 else "threaded"
+    max_clients = int(sys.argv[2]) if len(sys.argv) > 2 else 10
+    handoff_path = default_handoff_path('response-server', 12345)
+
+    if engine == "async":
+        server = AsyncResponseServer(max_clients=max_clients, handoff_path=handoff_path, journal=journal)
+    elif engine == "prefork":
+        workers = int(sys.argv[3]) if len(sys.argv) > 3 else None
+        server = PreforkResponseServer(max_clients=max_clients, workers=workers)
+    else:
+        server = ResponseServer(max_clients=max_clients, handoff_path=handoff_path, journal=journal)
     server.start_server()
 
 
 # CLIENT CODE (step3_client.py)
-import socket
-import threading
 import sys
 
+from response_client import ClientPool
+
 class ResponseClient:
-    def __init__(self, client_name="Client"):
+    def __init__(self, client_name="Client", host='localhost', port=12345):
         self.client_name = client_name
-        self.client_socket = None
+        self.host = host
+        self.port = port
+        # One pooled connection, reopened with backoff if the server drops it
+        self.pool = ClientPool(max_per_host=1)
         self.connected = False
         
-    def receive_messages(self):
-        """Thread to receive messages from server"""
-        while self.connected:
-            try:
-                response = self.client_socket.recv(1024).decode('utf-8')
-                if response:
-                    print(f"\n[SERVER RESPONSE]: {response}")
-                    print(f"{self.client_name} - Enter message (or 'quit' to exit): ", end="", flush=True)
-            except:
-                break
+    def show_response(self, future):
+        """Print a reply as soon as it arrives, without blocking the input prompt"""
+        try:
+            response = future.result()
+        except ConnectionError as e:
+            response = f"(no reply: {e})"
+        print(f"\n[SERVER RESPONSE]: {response}")
+        if self.connected:
+            print(f"{self.client_name} - Enter message (or 'quit' to exit): ", end="", flush=True)
     
     def start_client(self):
-        self.client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        
         try:
-            self.client_socket.connect(('localhost', 12345))
+            connection = self.pool.connection(self.host, self.port)
             self.connected = True
             print(f"{self.client_name}: Connected to server")
-            
-            # Start thread to receive server responses
-            receive_thread = threading.Thread(target=self.receive_messages)
-            receive_thread.daemon = True
-            receive_thread.start()
+            print(f"\n[SERVER RESPONSE]: {connection.welcome}")
             
             while self.connected:
                 message = input(f"{self.client_name} - Enter message (or 'quit' to exit): ")
                 
                 if not self.connected:
                     break
-                    
-                self.client_socket.send(message.encode('utf-8'))
+                
+                reply = self.pool.request(message, self.host, self.port)
                 
                 if message.lower() == 'quit':
                     self.connected = False
+                    # Wait for the goodbye before closing
+                    reply.result(timeout=5)
                     break
+                reply.add_done_callback(self.show_response)
                     
         except ConnectionRefusedError:
             print(f"{self.client_name}: Could not connect to server")
@@ -152,8 +882,7 @@ class ResponseClient:
             print(f"{self.client_name}: Error - {e}")
         finally:
             self.connected = False
-            if self.client_socket:
-                self.client_socket.close()
+            self.pool.close()
             print(f"{self.client_name}: Connection closed")
 
 if __name__ == "__main__":
@@ -163,47 +892,48 @@ if __name__ == "__main__":
 
 
 # MULTI-CLIENT TESTER (step3_multi_test.py)
-import socket
+import sys
 import threading
 import time
 import random
 
-def test_client_with_responses(client_id, num_messages=5):
-    """Test client that expects responses from server"""
-    client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+from binary_protocol import ACK_BODY, OP_ACK, OP_ECHO, OP_QUIT, BinaryClient
+from compression import CompressionOptions
+from pubsub import fanout_latency
+from response_client import ClientPool
+
+def test_client_with_responses(client_id, num_messages=5, pool=None):
+    """Test client that expects responses from server; pass a pool to share its connections"""
+    own_pool = pool is None
+    pool = pool or ClientPool(max_per_host=1)
     
     try:
-        client_socket.connect(('localhost', 12345))
+        connection = pool.connection()
         print(f"Client {client_id}: Connected")
-        
-        # Receive welcome message
-        welcome = client_socket.recv(1024).decode('utf-8')
-        print(f"Client {client_id} received: {welcome}")
+        print(f"Client {client_id} received: {connection.welcome}")
         
         # Send messages and receive responses
         for i in range(num_messages):
             message = f"Test message {i+1} from client {client_id}"
-            client_socket.send(message.encode('utf-8'))
-            
-            # Receive response
-            response = client_socket.recv(1024).decode('utf-8')
+            response = pool.call(message, timeout=10)
             print(f"Client {client_id} received response: {response}")
             
             time.sleep(random.uniform(0.5, 2))
         
-        # Send quit and receive goodbye
-        client_socket.send("quit".encode('utf-8'))
-        goodbye = client_socket.recv(1024).decode('utf-8')
-        print(f"Client {client_id} received: {goodbye}")
+        # Send quit and receive goodbye; a shared connection stays open for the others
+        if own_pool:
+            goodbye = pool.call("quit", timeout=10)
+            print(f"Client {client_id} received: {goodbye}")
         
     except Exception as e:
         print(f"Client {client_id} error: {e}")
     finally:
-        client_socket.close()
+        if own_pool:
+            pool.close()
         print(f"Client {client_id}: Disconnected")
 
 def test_multiple_response_clients(num_clients=5):
-    """Test multiple clients with server responses"""
+    """Test multiple clients with server responses, one connection each"""
     print(f"Testing {num_clients} clients with server responses...")
     
     threads = []
@@ -218,5 +948,109 @@ def test_multiple_response_clients(num_clients=5):
     
     print("All response client tests completed")
 
+def test_pooled_response_clients(num_clients=5):
+    """Test multiple clients sharing two pooled connections"""
+    print(f"Testing {num_clients} clients over a pool of 2 connections...")
+    
+    with ClientPool(max_per_host=2) as pool:
+        threads = []
+        for i in range(num_clients):
+            thread = threading.Thread(target=test_client_with_responses, args=(i+1, 5, pool))
+            threads.append(thread)
+            thread.start()
+            time.sleep(0.2)  # Stagger connections
+        
+        for thread in threads:
+            thread.join()
+        print(f"Pool: {pool.stats()}")
+    
+    print("All pooled client tests completed")
+
+def test_pipelined_client(client_id, num_messages=1000, compress=False):
+    """Framed client that sends every request before reading any reply"""
+    compression = CompressionOptions(threshold=64) if compress else None
+    with ClientPool(max_per_host=1, max_in_flight=num_messages + 1, compression=compression) as pool:
+        try:
+            connection = pool.connection()
+            if not connection.framed:
+                print(f"Client {client_id}: server does not support framing")
+                return
+            
+            start_time = time.time()
+            replies = [connection.request(f"Test message {i+1} from client {client_id}")
+                       for i in range(num_messages)]
+            replies.append(connection.request("quit"))
+            
+            # Futures resolve in request order
+            replies = [reply.result(timeout=30) for reply in replies]
+            elapsed = time.time() - start_time
+            
+            print(f"Client {client_id}: {len(replies)}/{num_messages + 1} replies in {elapsed:.3f}s")
+            print(f"Client {client_id} last reply: {replies[-1]}")
+            if connection.compression:
+                print(f"Client {client_id} compression: {connection.compression.stats()}")
+            
+        except Exception as e:
+            print(f"Client {client_id} error: {e}")
+
+def test_binary_client(client_id, num_messages=1000):
+    """Binary mode client: acks and echoes by opcode, all sent before any reply is read"""
+    try:
+        client = BinaryClient()
+    except (OSError, ConnectionError) as e:
+        print(f"Client {client_id} error: {e}")
+        return
+    try:
+        start_time = time.time()
+        requests = [(OP_ACK if i % 2 else OP_ECHO, f"Test message {i+1} from client {client_id}".encode('utf-8'))
+                    for i in range(num_messages)]
+        client.send_many(requests + [(OP_QUIT, b'')])
+        replies = client.receive(num_messages + 1)
+        elapsed = time.time() - start_time
+        
+        print(f"Client {client_id}: {len(replies)}/{num_messages + 1} replies in {elapsed:.3f}s")
+        opcode, flags, request_id, payload = replies[-2]
+        if opcode == OP_ACK:
+            print(f"Client {client_id} last ack: message #{ACK_BODY.unpack(payload)[0]}")
+        else:
+            print(f"Client {client_id} last echo: {payload.decode('utf-8')}")
+    except Exception as e:
+        print(f"Client {client_id} error: {e}")
+    finally:
+        client.close()
+
+def test_fanout(num_subscribers=100, num_updates=100, interval=0.01):
+    """Fan-out latency: one client publishes timestamped updates, num_subscribers receive them"""
+    # Needs a server started with max_clients above num_subscribers
+    subscribers = []
+    try:
+        for _ in range(num_subscribers):
+            client = BinaryClient()
+            client.subscribe('bench')
+            subscribers.append(client)
+        for client in subscribers:
+            client.receive(1)
+        publisher = BinaryClient()
+        subscribers.append(publisher)
+        print(f"Fan-out to {num_subscribers} subscribers: "
+              f"{fanout_latency(publisher.publish, subscribers[:-1], num_updates, interval)}")
+    except Exception as e:
+        print(f"Fan-out test error: {e}")
+    finally:
+        for client in subscribers:
+            client.close()
+
 if __name__ == "__main__":
-    test_multiple_response_clients()
+    # Pass "pipelined" to exercise the framed mode instead, "compressed" for framed plus compression,
+    # "binary" for the binary protocol, "pooled" for clients sharing pooled connections,
+    # or "fanout [subscribers]" for pub/sub fan-out latency
+    if len(sys.argv) > 1 and sys.argv[1] in ("pipelined", "compressed"):
+        test_pipelined_client(1, compress=sys.argv[1] == "compressed")
+    elif len(sys.argv) > 1 and sys.argv[1] == "binary":
+        test_binary_client(1)
+    elif len(sys.argv) > 1 and sys.argv[1] == "pooled":
+        test_pooled_response_clients()
+    elif len(sys.argv) > 1 and sys.argv[1] == "fanout":
+        test_fanout(int(sys.argv[2]) if len(sys.argv) > 2 else 100)
+    else:
+        test_multiple_response_clients()
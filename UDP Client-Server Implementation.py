@@ -1,63 +1,817 @@
 
 # UDP SERVER CODE (step4_udp_server.py)
+import itertools
+import os
+import queue
 import socket
+import struct
+import sys
 import threading
 import time
-from datetime import datetime
-from collections import defaultdict
+from collections import OrderedDict, deque
+
+from async_logger import AsyncLogger
+from binary_protocol import OP_ACK, OP_ECHO, OP_QUIT, UDP_ACK_BODY, OpcodeTable, decode_message, encode_message, is_binary
+from compression import (COMPRESS_ACK, COMPRESS_REQUEST, MAX_DATAGRAM_SIZE, PROTO_ERROR, CompressedSender,
+                         CompressionError, CompressionOptions, is_compressed)
+from instrumentation import InstrumentedSender, Instruments, MetricsEndpoint
+from journal import BINARY, Journal
+from prefork import PreforkSupervisor, SharedCounters
+from rate_limit import FairQueue
+from reliable_udp import (DATA, DUPLICATE, DUPLICATE_ACK, NACK, OUT_OF_WINDOW, ReceiveWindow, decode_header,
+                          encode_ack, is_reliable)
+from response_templates import ReplyTemplate, TimestampCache
+from server_stats import ServerStats
+from udp_batching import MAX_UDP_PAYLOAD, is_batch, pack_batches, split_batch
+
+# Replies are encoded once here; only the fields are filled in per datagram
+UDP_REPLY = ReplyTemplate("UDP Server received: '%b' (Session #%d, Total #%d) at %b")
+UDP_GOODBYE = ReplyTemplate("Goodbye %b! Session ended.")
+NOT_NEGOTIATED_REPLY = f"{PROTO_ERROR} compression not negotiated".encode('utf-8')
+# A reply must fit in one datagram with room for the reliable ACK, batch or compression framing,
+# so the echo of a near-maximal datagram is cut short
+MAX_REPLY = MAX_UDP_PAYLOAD - 64
+
+class SessionRecord:
+    """Per-client state; __slots__ keeps it to four fields and no instance dict"""
+    __slots__ = ('count', 'last_seen', 'window', 'compression')
+
+    def __init__(self, last_seen):
+        self.count = 0
+        self.last_seen = last_seen
+        # Sequence numbers already processed, only for clients using reliable mode
+        self.window = None
+        # CompressionSession, only for clients that negotiated compression
+        self.compression = None
+
+class SessionTable:
+    """Bounded per-client message counts with idle expiry, O(1) amortised per packet"""
+    def __init__(self, max_sessions=100000, idle_ttl=300.0, clock=time.monotonic):
+        self.max_sessions = max_sessions
+        self.idle_ttl = idle_ttl
+        self.clock = clock
+        # Least recently seen client first, so LRU eviction and idle expiry both pop from the front
+        self.sessions = OrderedDict()
+        self.evictions = 0
+        self.expirations = 0
+
+    def touch(self, client_address):
+        """Count one message from a client; returns its session message count"""
+        record = self.record(client_address)
+        record.count += 1
+        return record.count
+
+    def record(self, client_address):
+        """The client's SessionRecord, created if needed and marked as just seen"""
+        now = self.clock()
+        # Expire first so a stale entry never costs a live one its slot
+        self.expire(now)
+        
+        sessions = self.sessions
+        record = sessions.get(client_address)
+        if record is None:
+            record = sessions[client_address] = SessionRecord(now)
+            if len(sessions) > self.max_sessions:
+                sessions.popitem(last=False)
+                self.evictions += 1
+        else:
+            sessions.move_to_end(client_address)
+            record.last_seen = now
+        return record
+
+    def expire(self, now=None):
+        """Drop sessions idle for longer than the TTL"""
+        cutoff = (self.clock() if now is None else now) - self.idle_ttl
+        sessions = self.sessions
+        # Stops at the first live session, so each entry is only ever looked at once here
+        while sessions:
+            record = sessions[next(iter(sessions))]
+            if record.last_seen > cutoff:
+                break
+            sessions.popitem(last=False)
+            self.expirations += 1
+
+    def get(self, client_address):
+        """The client's SessionRecord, or None; unlike record() this does not count as activity"""
+        return self.sessions.get(client_address)
+
+    def remove(self, client_address):
+        self.sessions.pop(client_address, None)
+
+    def stats(self):
+        return {
+            'sessions': len(self.sessions),
+            'max_sessions': self.max_sessions,
+            'evictions': self.evictions,
+            'expirations': self.expirations,
+        }
+
+    def __contains__(self, client_address):
+        return client_address in self.sessions
+
+    def __getitem__(self, client_address):
+        return self.sessions[client_address].count
+
+    def __len__(self):
+        return len(self.sessions)
+
+class ReplyCache:
+    """Recent ACKs keyed by (client address, sequence number), with LRU eviction and a TTL"""
+    def __init__(self, max_entries=65536, ttl=30.0, clock=time.monotonic):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.clock = clock
+        # key -> (stored_at, ack datagram), least recently used first
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def get(self, key):
+        """The ACK sent for this request, or None; a hit counts towards the hit rate"""
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        if entry[0] <= self.clock() - self.ttl:
+            del self.entries[key]
+            self.expirations += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return entry[1]
+
+    def put(self, key, datagram):
+        now = self.clock()
+        self.expire(now)
+        entries = self.entries
+        entries[key] = (now, datagram)
+        if len(entries) > self.max_entries:
+            entries.popitem(last=False)
+            self.evictions += 1
+
+    def expire(self, now=None):
+        cutoff = (self.clock() if now is None else now) - self.ttl
+        entries = self.entries
+        # Hits move entries to the back out of age order, so this stops at the first live one it meets
+        while entries:
+            stored_at, _ = entries[next(iter(entries))]
+            if stored_at > cutoff:
+                break
+            entries.popitem(last=False)
+            self.expirations += 1
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'entries': len(self.entries),
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': round(self.hits / lookups, 4) if lookups else 0.0,
+            'evictions': self.evictions,
+            'expirations': self.expirations,
+        }
 
 class UDPServer:
-    def __init__(self, host='localhost', port=12345):
+    def __init__(self, host='localhost', port=12345, reuse_port=False, max_sessions=100000, session_ttl=300.0,
+                 logger=None, reply_cache_size=65536, reply_cache_ttl=30.0, compression=None, rate_limit=None,
+                 metrics_port=None, tracer=None, sample_every=16, journal=None):
         self.host = host
         self.port = port
-        self.client_sessions = defaultdict(int)  # Track message count per client
-        self.total_messages = 0
+        self.reuse_port = reuse_port
+        # Track message count per client; bounded so crashed or roaming clients age out
+        self.client_sessions = SessionTable(max_sessions, session_ttl)
+        # The receive loop is the only thread touching the session table, so the hot path
+        # takes no lock; subclasses with several processing threads use self.lock
         self.lock = threading.Lock()
+        self.message_numbers = itertools.count(1)
+        self.server_stats = ServerStats()
+        self.datagrams = self.server_stats.counter('datagrams')
+        self.duplicates = self.server_stats.counter('duplicates')
+        self.out_of_window = self.server_stats.counter('out_of_window')
+        self.batches = self.server_stats.counter('batches')
+        # Datagrams that do not decode are counted and dropped; one bad sender never stops the loop
+        self.malformed = self.server_stats.counter('malformed')
+        # Replies the socket refused; the datagram is lost, the receive loop carries on
+        self.send_errors = self.server_stats.counter('send_errors')
+        # Reliable-mode retransmissions get their original ACK back instead of being processed again
+        self.reply_cache = ReplyCache(reply_cache_size, reply_cache_ttl)
+        self.server_stats.gauge('reply_cache', self.reply_cache.stats)
+        self.message_sizes = self.server_stats.histogram('message_size', 'bytes')
+        self.handle_times = self.server_stats.histogram('handle_time', 'us')
+        self.batch_sizes = self.server_stats.histogram('batch_size', 'messages')
+        self.server_stats.gauge('sessions', self.client_sessions.stats)
+        # Per-datagram logging goes through a batched background writer
+        self.log = logger or AsyncLogger()
+        self.server_stats.gauge('logger', self.log.stats)
+        self.timestamps = TimestampCache()
+        self.reply = UDP_REPLY
+        # Codecs and shared dictionaries offered to clients that ask for compression
+        self.compression_options = compression or CompressionOptions()
+        # Optional RateLimiter: datagrams over a client's (or subnet's) budget are dropped unread
+        self.rate_limit = rate_limit
+        self.throttled = self.server_stats.counter('throttled')
+        self.server_stats.gauge('rate_limit', lambda: self.rate_limit.stats() if self.rate_limit else {})
+        # Stage timers for one datagram in sample_every, with byte counters per socket
+        self.instruments = Instruments(self.server_stats, sample_every, tracer, ('recv', 'decode', 'build', 'send'))
+        self.metrics_port = metrics_port
+        self.metrics_endpoint = None
+        # Binary datagram handlers by opcode; applications register theirs from FIRST_APPLICATION_OPCODE up
+        self.opcodes = OpcodeTable()
+        self.opcodes.register(OP_ECHO, self.binary_echo, 'echo')
+        self.opcodes.register(OP_ACK, self.binary_ack, 'ack')
+        self.opcodes.register(OP_QUIT, self.binary_quit, 'quit')
+        # Optional Journal: every message received is queued for a durable audit record,
+        # which its writer thread group-commits to disk off the hot path
+        self.journal = journal
+        self.server_stats.gauge('journal', lambda: self.journal.stats() if self.journal else {})
         
-    def start_server(self):
+    def create_server_socket(self):
         # Create UDP socket
         server_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        if self.reuse_port:
+            # Several processes share the port and the kernel spreads datagrams
+            server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
         server_socket.bind((self.host, self.port))
+        return server_socket
+
+    @property
+    def total_messages(self):
+        return self.datagrams.value
+
+    def record_message(self, client_address):
+        """Count a datagram; returns (session_count, total_count)"""
+        session_count = self.client_sessions.touch(client_address)
+        self.datagrams.add()
+        return session_count, next(self.message_numbers)
+
+    def end_session(self, client_address):
+        record = self.client_sessions.get(client_address)
+        if record is not None and record.compression is not None:
+            self.log.info("Client {} compression: {}", client_address, record.compression.stats())
+        self.client_sessions.remove(client_address)
+
+    def session_compression(self, client_address):
+        record = self.client_sessions.get(client_address)
+        return record.compression if record is not None else None
+
+    def set_session_compression(self, client_address, compression):
+        self.client_sessions.record(client_address).compression = compression
+
+    def accept_sequence(self, client_address, sequence):
+        """Reliable mode: ReceiveWindow's verdict on this client's sequence number"""
+        record = self.client_sessions.record(client_address)
+        if record.window is None:
+            record.window = ReceiveWindow()
+        return record.window.accept(sequence)
+
+    def cached_reply(self, key):
+        return self.reply_cache.get(key)
+
+    def store_reply(self, key, datagram):
+        self.reply_cache.put(key, datagram)
+
+    def cache_miss(self):
+        self.reply_cache.misses += 1
+
+    def stats_snapshot(self):
+        """Counters, gauges and histograms as a dict"""
+        return self.server_stats.snapshot()
+
+    def stats_json(self):
+        return self.server_stats.to_json()
+
+    def stats_prometheus(self):
+        return self.server_stats.to_prometheus('udp_server')
+
+    def start_metrics_endpoint(self):
+        if self.metrics_port is not None:
+            self.metrics_endpoint = MetricsEndpoint(self.stats_prometheus, port=self.metrics_port).start()
+            print(f"Metrics at http://127.0.0.1:{self.metrics_endpoint.port}/metrics")
+
+    def admit_datagram(self, client_address):
+        """Charge a datagram to its sender's token bucket; False if the sender is over its limit"""
+        if self.rate_limit is None or self.rate_limit.allow(client_address[0]):
+            return True
+        self.throttled.add()
+        return False
+
+    def handle_datagram(self, server_socket, data, client_address):
+        """Reply to one datagram"""
+        if not self.admit_datagram(client_address):
+            return
+        self.message_sizes.record(len(data))
+        self.dispatch(server_socket, data, client_address)
+
+    def drop_datagram(self, client_address, error):
+        self.malformed.add()
+        self.log.warning("Dropping datagram from {}: {}", client_address, error)
+
+    def dispatch(self, server_socket, data, client_address):
+        """Route a datagram by its first byte: compressed, reliable, batched, binary or plain text"""
+        compression = self.session_compression(client_address)
+        if is_compressed(data):
+            if compression is None:
+                # The session expired (or was never set up), so the client has to negotiate again
+                server_socket.sendto(NOT_NEGOTIATED_REPLY, client_address)
+                return
+            try:
+                data = compression.unpack_datagram(data)
+            except CompressionError as e:
+                self.drop_datagram(client_address, e)
+                return
+        if compression is not None:
+            # Replies are compressed for a client that negotiated it, whatever it sent
+            server_socket = CompressedSender(server_socket, compression)
+        
+        if is_reliable(data):
+            self.handle_reliable(server_socket, data, client_address)
+        elif is_batch(data):
+            self.handle_batch(server_socket, data, client_address)
+        elif is_binary(data):
+            self.handle_binary(server_socket, data, client_address)
+        else:
+            try:
+                message = str(data, 'utf-8')
+            except UnicodeDecodeError as e:
+                self.drop_datagram(client_address, e)
+                return
+            self.handle_text(server_socket, message, client_address, data)
+
+    def handle_text(self, server_socket, message, client_address, raw=None):
+        if message.startswith(COMPRESS_REQUEST):
+            self.negotiate_compression(server_socket, message, client_address)
+        else:
+            self.handle_message(server_socket, message, client_address, raw)
+
+    def negotiate_compression(self, server_socket, message, client_address):
+        """Session setup: pick the first codec and dictionary the client offered that we support"""
+        try:
+            compression = self.compression_options.accept(message[len(COMPRESS_REQUEST):],
+                                                          max_size=MAX_DATAGRAM_SIZE)
+        except CompressionError as e:
+            server_socket.sendto(f"{PROTO_ERROR} {e}".encode('utf-8'), client_address)
+            return
+        self.set_session_compression(client_address, compression)
+        self.log.info("Client {} compression: {}", client_address, compression.describe() if compression else 'off')
+        
+        reply = COMPRESS_ACK if compression is None else f"{COMPRESS_ACK} {compression.describe()}"
+        server_socket.sendto(reply.encode('utf-8'), client_address)
+
+    def build_replies(self, message, client_address, raw=None):
+        """Count one message and build its replies: the response, plus a goodbye on quit"""
+        session_count, total_count = self.record_message(client_address)
+        
+        self.log.debug("From {}: {}\n  Session messages: {}, Total messages: {}",
+                       client_address, message, session_count, total_count)
+        
+        if raw is None:
+            raw = message.encode('utf-8')
+        if self.journal is not None:
+            self.journal.append(client_address, raw)
+        stamp = self.timestamps.encoded()
+        reply = self.reply.render(raw, session_count, total_count, stamp)
+        if len(reply) > MAX_REPLY:
+            reply = self.reply.render(raw[:len(raw) - (len(reply) - MAX_REPLY)], session_count, total_count, stamp)
+        replies = [reply]
+        
+        # Handle quit message; checking the length first spares most messages the lower()
+        if len(message) == 4 and message.lower() == 'quit':
+            replies.append(UDP_GOODBYE.render(str(client_address).encode('utf-8')))
+            self.end_session(client_address)
+            self.log.info("Client {} session ended", client_address)
+        return replies
+
+    def handle_message(self, server_socket, message, client_address, raw=None):
+        """Reply to one decoded message; raw is the datagram as received, if still available"""
+        started = time.perf_counter_ns()
+        
+        # Send response back to client
+        for reply in self.build_replies(message, client_address, raw):
+            server_socket.sendto(reply, client_address)
+        
+        self.handle_times.record((time.perf_counter_ns() - started) // 1000)
+
+    def binary_echo(self, context, payload):
+        return payload, True
+
+    def binary_ack(self, context, payload):
+        _, session_count, total_count = context
+        return UDP_ACK_BODY.pack(session_count & 0xFFFFFFFF, total_count & 0xFFFFFFFF), True
+
+    def binary_quit(self, context, payload):
+        client_address = context[0]
+        self.end_session(client_address)
+        self.log.info("Client {} session ended", client_address)
+        return b'', False
+
+    def handle_binary(self, server_socket, data, client_address):
+        """Binary datagram: one message, dispatched by opcode and answered with one binary reply"""
+        started = time.perf_counter_ns()
+        try:
+            opcode, _, request_id, payload = decode_message(data)
+        except ValueError as e:
+            self.drop_datagram(client_address, e)
+            return
+        session_count, total_count = self.record_message(client_address)
+        if self.journal is not None:
+            self.journal.append(client_address, bytes((opcode,)) + payload, BINARY)
+        self.log.debug("From {}: binary {} ({} bytes)", client_address, self.opcodes.name(opcode), len(payload))
+        
+        flags, reply, _ = self.opcodes.call((client_address, session_count, total_count), opcode, payload)
+        server_socket.sendto(encode_message(opcode, request_id, reply, flags), client_address)
+        self.handle_times.record((time.perf_counter_ns() - started) // 1000)
+
+    def handle_batch(self, server_socket, data, client_address):
+        """Batched datagram: process every message in order and send all the replies back batched"""
+        started = time.perf_counter_ns()
+        replies = []
+        items = split_batch(data)
+        for item in items:
+            try:
+                message = str(item, 'utf-8')
+            except UnicodeDecodeError as e:
+                # The rest of the batch is still served; the bad item shows up in the stats
+                self.malformed.add()
+                self.log.debug("Dropping batch item from {}: {}", client_address, e)
+                continue
+            replies.extend(self.build_replies(message, client_address, item))
+        self.batches.add()
+        self.batch_sizes.record(len(items))
+        
+        # Normally one datagram; only split past the largest UDP payload
+        for datagram in pack_batches(replies):
+            server_socket.sendto(datagram, client_address)
+        self.handle_times.record((time.perf_counter_ns() - started) // 1000)
+
+    def handle_reliable(self, server_socket, data, client_address):
+        """Reliable mode: process each sequence number once; the ACK carries the replies"""
+        started = time.perf_counter_ns()
+        try:
+            kind, sequence, body = decode_header(data)
+            message = str(body, 'utf-8') if kind == DATA else None
+        except (ValueError, struct.error) as e:
+            self.drop_datagram(client_address, e)
+            return
+        if kind != DATA:
+            return
+        
+        # Checked before the session, which a quit has already ended
+        key = (client_address, sequence)
+        cached = self.cached_reply(key)
+        if cached is not None:
+            # A retransmission whose first copy got through: resend the original ACK as is
+            self.duplicates.add()
+            server_socket.sendto(cached, client_address)
+            return
+        
+        verdict = self.accept_sequence(client_address, sequence)
+        if verdict == OUT_OF_WINDOW:
+            # Never processed, and not a duplicate either: tell the client instead of pretending
+            self.out_of_window.add()
+            server_socket.sendto(encode_ack(sequence, (), NACK), client_address)
+            return
+        if verdict == DUPLICATE:
+            # Processed before, but the reply has left the cache: ACK without the replies
+            self.duplicates.add()
+            self.cache_miss()
+            server_socket.sendto(encode_ack(sequence, (), DUPLICATE_ACK), client_address)
+            return
+        
+        replies = self.build_replies(message, client_address, body)
+        ack = encode_ack(sequence, replies)
+        self.store_reply(key, ack)
+        server_socket.sendto(ack, client_address)
+        self.handle_times.record((time.perf_counter_ns() - started) // 1000)
+
+    def start_server(self):
+        server_socket = self.create_server_socket()
         
         print(f"UDP Server listening on {self.host}:{self.port}")
         print("Ready to receive UDP packets from multiple clients...")
+        self.start_metrics_endpoint()
+        # One socket, one thread: its counters stand in for a connection's
+        metrics = self.instruments.open('socket', (self.host, self.port))
+        sender = InstrumentedSender(server_socket, metrics)
         
         try:
             while True:
-                # Receive data and client address
-                data, client_address = server_socket.recvfrom(1024)
-                message = data.decode('utf-8')
-                
-                with self.lock:
-                    self.client_sessions[client_address] += 1
-                    self.total_messages += 1
-                    session_count = self.client_sessions[client_address]
-                    total_count = self.total_messages
-                
-                timestamp = datetime.now().strftime("%H:%M:%S")
-                print(f"[{timestamp}] From {client_address}: {message}")
-                print(f"  Session messages: {session_count}, Total messages: {total_count}")
-                
-                # Send response back to client
-                response = f"UDP Server received: '{message}' (Session #{session_count}, Total #{total_count}) at {timestamp}"
-                server_socket.sendto(response.encode('utf-8'), client_address)
-                
-                # Handle quit message
-                if message.lower() == 'quit':
-                    goodbye = f"Goodbye {client_address}! Session ended."
-                    server_socket.sendto(goodbye.encode('utf-8'), client_address)
-                    with self.lock:
-                        if client_address in self.client_sessions:
-                            del self.client_sessions[client_address]
-                    print(f"Client {client_address} session ended")
+                # Receive data and client address; a batched datagram can fill a whole MTU
+                data, client_address = self.instruments.recvfrom(metrics, server_socket, 65535)
+                try:
+                    self.handle_datagram(sender, data, client_address)
+                except OSError as e:
+                    self.send_errors.add()
+                    self.log.error("Error replying to {}: {}", client_address, e)
                 
         except KeyboardInterrupt:
             print("\nUDP Server shutting down...")
         finally:
+            self.instruments.close(metrics)
             server_socket.close()
 
+class PreforkUDPWorker(UDPServer):
+    """UDPServer running inside one prefork worker process"""
+    def __init__(self, worker_id, counters, host='localhost', port=12345):
+        super().__init__(host, port, reuse_port=True)
+        self.worker_id = worker_id
+        self.counters = counters
+        # The total is this worker's own; the label says so: "Total #w2-17"
+        self.reply = ReplyTemplate(f"UDP Server received: '%b' (Session #%d, Total #w{worker_id}-%d) at %b")
+
+    def record_message(self, client_address):
+        # The kernel hashes a client's address to one socket, so its session stays on this worker
+        session_count, total_count = super().record_message(client_address)
+        self.counters.add(self.worker_id, 'total_messages')
+        self.counters.set(self.worker_id, 'client_sessions', len(self.client_sessions))
+        return session_count, total_count
+
+    def end_session(self, client_address):
+        super().end_session(client_address)
+        self.counters.set(self.worker_id, 'client_sessions', len(self.client_sessions))
+
+class PreforkUDPServer:
+    """Runs one UDPServer per worker process, all sharing the port via SO_REUSEPORT"""
+    def __init__(self, host='localhost', port=12345, workers=None):
+        self.host = host
+        self.port = port
+        self.workers = workers or os.cpu_count() or 1
+        self.counters = SharedCounters(self.workers, ['total_messages', 'client_sessions'])
+        self.supervisor = PreforkSupervisor(self.run_worker, self.workers, counters=self.counters)
+
+    def run_worker(self, worker_id):
+        server = PreforkUDPWorker(worker_id, self.counters, self.host, self.port)
+        server.start_server()
+
+    def stats(self):
+        """Global view of total_messages and client_sessions across all workers"""
+        return self.supervisor.stats()
+
+    def start_server(self):
+        print(f"Prefork UDP Server starting {self.workers} workers on {self.host}:{self.port}")
+        self.supervisor.run()
+
+class BufferPool:
+    """Preallocated receive buffers that are handed out and returned, never reallocated"""
+    def __init__(self, count=1024, size=2048):
+        self.size = size
+        self.buffers = [bytearray(size) for _ in range(count)]
+        self.views = [memoryview(buffer) for buffer in self.buffers]
+        # deque.append/pop are atomic, so receivers and workers can share it without a lock
+        self.free = deque(range(count))
+
+    def acquire(self):
+        """Returns a free buffer index, or None when every buffer is in use"""
+        try:
+            return self.free.pop()
+        except IndexError:
+            return None
+
+    def release(self, index):
+        self.free.append(index)
+
+class ReceiverStats:
+    """Counters owned by a single receive thread, summed by HighRateUDPServer.stats()"""
+    __slots__ = ('received', 'queue_drops', 'pool_overruns', 'truncated')
+
+    def __init__(self):
+        self.received = 0
+        self.queue_drops = 0
+        self.pool_overruns = 0
+        self.truncated = 0
+
+def kernel_udp_drops():
+    """Host-wide UDP receive-buffer drops reported by the kernel (Linux only)"""
+    try:
+        with open('/proc/net/snmp') as snmp:
+            header, values = [line.split() for line in snmp if line.startswith('Udp:')][:2]
+        return int(values[header.index('RcvbufErrors')])
+    except (OSError, ValueError):
+        return None
+
+class HighRateUDPServer(UDPServer):
+    """High-rate ingest mode: recvfrom_into pooled buffers, processing on separate threads"""
+    def __init__(self, host='localhost', port=12345, sockets=1, workers=1,
+                 pool_size=1024, buffer_size=2048, queue_size=4096, rcvbuf=4 * 1024 * 1024,
+                 report_interval=10.0, rate_limit=None, per_client_queue=None, metrics_port=None, tracer=None,
+                 sample_every=16, journal=None):
+        # More than one socket on the same port needs SO_REUSEPORT
+        super().__init__(host, port, reuse_port=sockets > 1, rate_limit=rate_limit, metrics_port=metrics_port,
+                         tracer=tracer, sample_every=sample_every, journal=journal)
+        self.num_sockets = sockets
+        self.num_workers = workers
+        self.rcvbuf = rcvbuf
+        self.report_interval = report_interval
+        self.pool = BufferPool(pool_size, buffer_size)
+        # Bounded handoff: receivers never wait on slow processing, they drop and count.
+        # Each client host gets its own FIFO, served in deficit round-robin order by bytes,
+        # so a flood only delays the flooder's own datagrams. Queued datagrams hold pool buffers,
+        # so no client may hold more than a quarter of those either
+        per_client_queue = per_client_queue or max(1, min(queue_size, pool_size) // 4)
+        self.work_queue = FairQueue(queue_size, per_client_queue, quantum=buffer_size)
+        self.receiver_stats = []
+        self.processed = 0
+        self.sockets = []
+        # Queue depth and loss counters go out with every other statistic
+        self.server_stats.gauge('ingest', self.stats)
+
+    def create_server_socket(self):
+        server_socket = super().create_server_socket()
+        server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, self.rcvbuf)
+        return server_socket
+
+    def record_message(self, client_address):
+        # Several processing threads share the session table, which reorders itself on every touch
+        if self.num_workers == 1:
+            return super().record_message(client_address)
+        with self.lock:
+            return super().record_message(client_address)
+
+    def end_session(self, client_address):
+        with self.lock:
+            super().end_session(client_address)
+
+    def accept_sequence(self, client_address, sequence):
+        if self.num_workers == 1:
+            return super().accept_sequence(client_address, sequence)
+        with self.lock:
+            return super().accept_sequence(client_address, sequence)
+
+    def cached_reply(self, key):
+        if self.num_workers == 1:
+            return super().cached_reply(key)
+        with self.lock:
+            return super().cached_reply(key)
+
+    def store_reply(self, key, datagram):
+        if self.num_workers == 1:
+            return super().store_reply(key, datagram)
+        with self.lock:
+            return super().store_reply(key, datagram)
+
+    def cache_miss(self):
+        with self.lock:
+            super().cache_miss()
+
+    def set_session_compression(self, client_address, compression):
+        with self.lock:
+            super().set_session_compression(client_address, compression)
+
+    def receive_loop(self, server_socket, stats):
+        """Only moves datagrams from the kernel into pooled buffers and onto the queue"""
+        pool = self.pool
+        put = self.work_queue.put_nowait
+        buffer_size = pool.size
+        scratch = bytearray(buffer_size)
+        # MSG_TRUNC makes the kernel report the real size of an oversized datagram
+        flags = getattr(socket, 'MSG_TRUNC', 0)
+        
+        while True:
+            index = pool.acquire()
+            if index is None:
+                # Workers still hold every buffer; keep draining the kernel queue so it does not overflow
+                try:
+                    server_socket.recvfrom_into(scratch, buffer_size, flags)
+                except OSError:
+                    return
+                stats.pool_overruns += 1
+                continue
+            
+            try:
+                nbytes, client_address = server_socket.recvfrom_into(pool.buffers[index], buffer_size, flags)
+            except OSError:
+                pool.release(index)
+                return
+            stats.received += 1
+            
+            if nbytes > buffer_size:
+                stats.truncated += 1
+                pool.release(index)
+                continue
+            
+            # Throttled before queueing, so an over-limit client cannot take queue slots either
+            if not self.admit_datagram(client_address):
+                pool.release(index)
+                continue
+            
+            try:
+                put(client_address[0], (index, nbytes, client_address, server_socket), nbytes)
+            except queue.Full:
+                stats.queue_drops += 1
+                pool.release(index)
+
+    def process_loop(self):
+        pool = self.pool
+        get = self.work_queue.get
+        # Receivers only count and queue, so stage timing starts when a worker takes a datagram
+        metrics = self.instruments.open(threading.current_thread().name)
+        senders = {}
+        while True:
+            index, nbytes, client_address, server_socket = get()
+            metrics.sample()
+            metrics.bytes_in += nbytes
+            metrics.messages += 1
+            sender = senders.get(server_socket)
+            if sender is None:
+                sender = senders[server_socket] = InstrumentedSender(server_socket, metrics)
+            data = message = None
+            try:
+                view = pool.views[index][:nbytes]
+                if is_reliable(view) or is_batch(view) or is_compressed(view) or is_binary(view):
+                    # Parsed once the buffer is back in the pool, so take a copy
+                    data = bytes(view)
+                else:
+                    # Decode straight from the pooled buffer, then hand the buffer back
+                    message = str(view, 'utf-8')
+            except UnicodeDecodeError as e:
+                self.drop_datagram(client_address, e)
+            finally:
+                pool.release(index)
+            
+            if data is None and message is None:
+                continue
+            if metrics.mark:
+                metrics.lap('decode')
+            self.processed += 1
+            self.message_sizes.record(nbytes)
+            try:
+                if data is not None:
+                    self.dispatch(sender, data, client_address)
+                    continue
+                compression = self.session_compression(client_address)
+                if compression is not None:
+                    sender = CompressedSender(sender, compression)
+                self.handle_text(sender, message, client_address)
+            except OSError as e:
+                self.send_errors.add()
+                self.log.error("Error replying to {}: {}", client_address, e)
+
+    def stats(self):
+        """Server-side loss counters summed over every receive thread"""
+        snapshot = {
+            'received': sum(stats.received for stats in self.receiver_stats),
+            'processed': self.processed,
+            'queue_drops': sum(stats.queue_drops for stats in self.receiver_stats),
+            'pool_overruns': sum(stats.pool_overruns for stats in self.receiver_stats),
+            'truncated': sum(stats.truncated for stats in self.receiver_stats),
+            'queue_depth': self.work_queue.qsize(),
+            'queued_clients': self.work_queue.clients(),
+            'throttled': self.throttled.value,
+            'malformed': self.malformed.value,
+            'send_errors': self.send_errors.value,
+            'free_buffers': len(self.pool.free),
+            'kernel_rcvbuf_errors': kernel_udp_drops(),
+        }
+        snapshot.update(self.client_sessions.stats())
+        if self.sockets:
+            # Linux reports double the requested size to account for bookkeeping
+            snapshot['rcvbuf'] = self.sockets[0].getsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF)
+        return snapshot
+
+    def start_server(self):
+        self.sockets = [self.create_server_socket() for _ in range(self.num_sockets)]
+        
+        print(f"High-rate UDP Server listening on {self.host}:{self.port}")
+        print(f"Sockets: {self.num_sockets}, workers: {self.num_workers}, "
+              f"buffers: {len(self.pool.buffers)} x {self.pool.size} bytes")
+        self.start_metrics_endpoint()
+        
+        for server_socket in self.sockets:
+            stats = ReceiverStats()
+            self.receiver_stats.append(stats)
+            threading.Thread(target=self.receive_loop, args=(server_socket, stats), daemon=True).start()
+        for _ in range(self.num_workers):
+            threading.Thread(target=self.process_loop, daemon=True).start()
+        
+        try:
+            while True:
+                time.sleep(self.report_interval)
+                print(f"Ingest stats: {self.stats()}")
+                
+        except KeyboardInterrupt:
+            print("\nUDP Server shutting down...")
+        finally:
+            for server_socket in self.sockets:
+                server_socket.close()
+
 if __name__ == "__main__":
-    server = UDPServer()
+    # Usage: python "UDP Client-Server Implementation.py" [single|prefork|ingest] [workers|sockets] [--journal DIR]
+    # --journal keeps a durable record of every message received (single and ingest only)
+    journal = None
+    if '--journal' in sys.argv:
+        index = sys.argv.index('--journal')
+        journal = Journal(sys.argv[index + 1])
+        del sys.argv[index:index + 2]
+    mode = sys.argv[1] if len(sys.argv) > 1 else "single"
+    
+    if mode == "prefork":
+        workers = int(sys.argv[2]) if len(sys.argv) > 2 else None
+        server = PreforkUDPServer(workers=workers)
+    elif mode == "ingest":
+        sockets = int(sys.argv[2]) if len(sys.argv) > 2 else 1
+        server = HighRateUDPServer(sockets=sockets, journal=journal)
+    else:
+        server = UDPServer(journal=journal)
     server.start_server()
 
 
@@ -66,39 +820,87 @@ import socket
 import sys
 import time
 
+from compression import CompressionError, CompressionOptions, MAX_DATAGRAM_SIZE, negotiate_datagram
+from reliable_udp import ReliableUDPClient
+
 class UDPClient:
-    def __init__(self, client_name="UDPClient"):
+    def __init__(self, client_name="UDPClient", reliable=False, compress=False):
         self.client_name = client_name
         self.server_host = 'localhost'
         self.server_port = 12345
+        # Reliable mode retransmits lost messages instead of giving up after a timeout
+        self.reliable = reliable
+        # Compressed mode sets up a compression session with the server first
+        self.compress = compress
+        
+    def start_reliable_client(self):
+        print(f"{self.client_name}: Starting reliable UDP client")
+        print(f"Connecting to UDP server at {self.server_host}:{self.server_port}")
+        
+        with ReliableUDPClient(self.server_host, self.server_port) as client:
+            try:
+                while True:
+                    message = input(f"{self.client_name} - Enter message (or 'quit' to exit): ")
+                    
+                    try:
+                        # Response, plus the goodbye after 'quit'
+                        for response in client.call(message):
+                            print(f"[SERVER RESPONSE]: {response}")
+                    except TimeoutError as e:
+                        print(f"No response received from server ({e})")
+                    
+                    if message.lower() == 'quit':
+                        break
+                        
+            except Exception as e:
+                print(f"{self.client_name}: Error - {e}")
+        print(f"{self.client_name}: UDP connection closed")
         
     def start_client(self):
+        if self.reliable:
+            self.start_reliable_client()
+            return
+        
         # Create UDP socket
         client_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
         client_socket.settimeout(5)  # 5 second timeout for receiving
         
         print(f"{self.client_name}: Starting UDP client")
         print(f"Connecting to UDP server at {self.server_host}:{self.server_port}")
+        server_address = (self.server_host, self.server_port)
+        compression = None
         
         try:
+            if self.compress:
+                try:
+                    compression = negotiate_datagram(client_socket, server_address, CompressionOptions())
+                    print(f"{self.client_name}: Compression {compression.describe() if compression else 'off'}")
+                except (CompressionError, socket.timeout) as e:
+                    print(f"{self.client_name}: Compression not available ({e})")
+            
             while True:
                 message = input(f"{self.client_name} - Enter message (or 'quit' to exit): ")
+                data = message.encode('utf-8')
                 
                 # Send message to server
-                client_socket.sendto(message.encode('utf-8'), (self.server_host, self.server_port))
+                client_socket.sendto(compression.pack_datagram(data) if compression else data, server_address)
                 
                 try:
                     # Receive response from server
-                    response, server_address = client_socket.recvfrom(1024)
-                    print(f"[SERVER RESPONSE]: {response.decode('utf-8')}")
+                    response, server_address = client_socket.recvfrom(MAX_DATAGRAM_SIZE)
+                    if compression:
+                        response = compression.unpack_datagram(response)
+                    print(f"[SERVER RESPONSE]: {bytes(response).decode('utf-8')}")
                 except socket.timeout:
                     print("No response received from server (timeout)")
                 
                 if message.lower() == 'quit':
                     try:
                         # Try to receive goodbye message
-                        goodbye, _ = client_socket.recvfrom(1024)
-                        print(f"[SERVER]: {goodbye.decode('utf-8')}")
+                        goodbye, _ = client_socket.recvfrom(MAX_DATAGRAM_SIZE)
+                        if compression:
+                            goodbye = compression.unpack_datagram(goodbye)
+                        print(f"[SERVER]: {bytes(goodbye).decode('utf-8')}")
                     except socket.timeout:
                         pass
                     break
@@ -106,12 +908,16 @@ class UDPClient:
         except Exception as e:
             print(f"{self.client_name}: Error - {e}")
         finally:
+            if compression:
+                print(f"{self.client_name}: Compression stats {compression.stats()}")
             client_socket.close()
             print(f"{self.client_name}: UDP connection closed")
 
 if __name__ == "__main__":
+    # Usage: python "UDP Client-Server Implementation.py" [client_name] [reliable|compress]
     client_name = sys.argv[1] if len(sys.argv) > 1 else "UDPClient"
-    client = UDPClient(client_name)
+    mode = sys.argv[2] if len(sys.argv) > 2 else None
+    client = UDPClient(client_name, reliable=mode == "reliable", compress=mode == "compress")
     client.start_client()
 
 
@@ -121,6 +927,94 @@ import threading
 import time
 import random
 
+from binary_protocol import OP_ACK, OP_QUIT, REPLY, UDP_ACK_BODY, decode_message, encode_message
+from udp_batching import BatchingUDPClient
+
+def batched_udp_test_client(client_id, num_messages=5, delay_range=(0, 0.001)):
+    """Telemetry-style sender: messages are packed into a few datagrams, replies come back batched"""
+    print(f"UDP Client {client_id}: Starting batched test")
+    
+    with BatchingUDPClient('localhost', 12345) as client:
+        try:
+            for i in range(num_messages):
+                client.send(f"UDP message {i+1} from client {client_id}")
+                time.sleep(random.uniform(*delay_range))
+            client.send("quit")
+            client.flush()
+            
+            # One reply per message, plus the goodbye
+            while client.replies < num_messages + 2:
+                for response in client.receive(3):
+                    print(f"UDP Client {client_id}: Received - {response}")
+                    
+        except socket.timeout:
+            print(f"UDP Client {client_id}: {num_messages + 2 - client.replies} replies missing")
+        except Exception as e:
+            print(f"UDP Client {client_id}: Error - {e}")
+        finally:
+            print(f"UDP Client {client_id}: Test completed ({client.stats()})")
+
+def reliable_udp_test_client(client_id, num_messages=5, delay_range=(0.1, 1.0)):
+    """Same exchange as udp_test_client, retransmitting lost datagrams instead of giving up"""
+    print(f"UDP Client {client_id}: Starting reliable test")
+    
+    with ReliableUDPClient('localhost', 12345) as client:
+        try:
+            for i in range(num_messages):
+                message = f"UDP message {i+1} from client {client_id}"
+                try:
+                    response = client.call(message)[0]
+                    print(f"UDP Client {client_id}: Received - {response}")
+                except (TimeoutError, IndexError):
+                    print(f"UDP Client {client_id}: No response for message {i+1}")
+                
+                time.sleep(random.uniform(*delay_range))
+            
+            # The goodbye arrives in the same ACK as the quit response
+            replies = client.call("quit")
+            print(f"UDP Client {client_id}: {replies[-1] if replies else 'No goodbye message received'}")
+            
+        except Exception as e:
+            print(f"UDP Client {client_id}: Error - {e}")
+        finally:
+            print(f"UDP Client {client_id}: Test completed ({client.stats()})")
+
+def binary_udp_test_client(client_id, num_messages=5, delay_range=(0.1, 1.0)):
+    """Same exchange as udp_test_client in binary datagrams: an ack with the counts instead of a sentence"""
+    client_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    client_socket.settimeout(3)
+    server_address = ('localhost', 12345)
+    
+    try:
+        print(f"UDP Client {client_id}: Starting binary test")
+        for i in range(num_messages):
+            payload = f"UDP message {i+1} from client {client_id}".encode('utf-8')
+            client_socket.sendto(encode_message(OP_ACK, i + 1, payload), server_address)
+            try:
+                opcode, flags, request_id, body = decode_message(client_socket.recvfrom(1024)[0])
+                if flags != REPLY:
+                    print(f"UDP Client {client_id}: Error - {bytes(body).decode('utf-8')}")
+                else:
+                    session_count, total_count = UDP_ACK_BODY.unpack(body)
+                    print(f"UDP Client {client_id}: Ack #{request_id} (Session #{session_count}, Total #{total_count})")
+            except socket.timeout:
+                print(f"UDP Client {client_id}: No response for message {i+1}")
+            
+            time.sleep(random.uniform(*delay_range))
+        
+        client_socket.sendto(encode_message(OP_QUIT, num_messages + 1), server_address)
+        try:
+            client_socket.recvfrom(1024)
+            print(f"UDP Client {client_id}: Session ended")
+        except socket.timeout:
+            print(f"UDP Client {client_id}: No goodbye message received")
+            
+    except Exception as e:
+        print(f"UDP Client {client_id}: Error - {e}")
+    finally:
+        client_socket.close()
+        print(f"UDP Client {client_id}: Test completed")
+
 def udp_test_client(client_id, num_messages=5, delay_range=(0.1, 1.0)):
     """Test UDP client that sends multiple messages"""
     client_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
@@ -161,7 +1055,7 @@ def udp_test_client(client_id, num_messages=5, delay_range=(0.1, 1.0)):
         client_socket.close()
         print(f"UDP Client {client_id}: Test completed")
 
-def simultaneous_udp_test(num_clients=10):
+def simultaneous_udp_test(num_clients=10, client=udp_test_client):
     """Test multiple UDP clients connecting simultaneously"""
     print(f"Testing {num_clients} simultaneous UDP clients...")
     
@@ -169,7 +1063,7 @@ def simultaneous_udp_test(num_clients=10):
     
     # Create all clients at nearly the same time
     for i in range(num_clients):
-        thread = threading.Thread(target=udp_test_client, args=(i+1, 3))
+        thread = threading.Thread(target=client, args=(i+1, 3))
         threads.append(thread)
     
     # Start all threads simultaneously
@@ -205,111 +1099,52 @@ if __name__ == "__main__":
     print("Choose test type:")
     print("1. Simultaneous UDP clients")
     print("2. Staggered UDP clients")
+    print("3. Simultaneous reliable UDP clients")
+    print("4. Simultaneous batching UDP clients")
+    print("5. Simultaneous binary UDP clients")
     
-    choice = input("Enter choice (1 or 2): ").strip()
+    choice = input("Enter choice (1-5): ").strip()
     
     if choice == "1":
         simultaneous_udp_test()
     elif choice == "2":
         staggered_udp_test()
+    elif choice == "3":
+        simultaneous_udp_test(client=reliable_udp_test_client)
+    elif choice == "4":
+        simultaneous_udp_test(client=batched_udp_test_client)
+    elif choice == "5":
+        simultaneous_udp_test(client=binary_udp_test_client)
     else:
         print("Invalid choice. Running simultaneous test by default.")
         simultaneous_udp_test()
 
 
 # UDP vs TCP COMPARISON TEST (step4_comparison_test.py)
-import socket
-import threading
+import json
 import time
 
-def tcp_client_test(client_id, messages=3):
-    """TCP client for comparison"""
-    try:
-        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        sock.connect(('localhost', 12346))  # Different port for TCP
-        
-        start_time = time.time()
-        for i in range(messages):
-            message = f"TCP message {i+1} from client {client_id}"
-            sock.send(message.encode('utf-8'))
-            response = sock.recv(1024).decode('utf-8')
-            
-        sock.send("quit".encode('utf-8'))
-        end_time = time.time()
-        
-        print(f"TCP Client {client_id}: Completed in {end_time - start_time:.3f}s")
-        sock.close()
-        
-    except Exception as e:
-        print(f"TCP Client {client_id}: Error - {e}")
-
-def udp_client_test(client_id, messages=3):
-    """UDP client for comparison"""
-    try:
-        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        sock.settimeout(2)
-        
-        start_time = time.time()
-        for i in range(messages):
-            message = f"UDP message {i+1} from client {client_id}"
-            sock.sendto(message.encode('utf-8'), ('localhost', 12345))
-            try:
-                response, _ = sock.recvfrom(1024)
-            except socket.timeout:
-                pass
-                
-        sock.sendto("quit".encode('utf-8'), ('localhost', 12345))
-        end_time = time.time()
-        
-        print(f"UDP Client {client_id}: Completed in {end_time - start_time:.3f}s")
-        sock.close()
-        
-    except Exception as e:
-        print(f"UDP Client {client_id}: Error - {e}")
+from load_generator import run_load
 
-def compare_tcp_udp(num_clients=5):
-    """Compare TCP vs UDP performance with multiple clients"""
+def compare_tcp_udp(num_clients=5, rate=None, duration=5.0, message_size=64):
+    """Compare TCP vs UDP latency percentiles and throughput under the same load"""
     print("Comparing TCP vs UDP with multiple clients...")
     print("Note: Make sure both TCP and UDP servers are running!")
     
-    # Test UDP clients
-    print(f"\nTesting {num_clients} UDP clients...")
-    udp_threads = []
-    udp_start = time.time()
-    
-    for i in range(num_clients):
-        thread = threading.Thread(target=udp_client_test, args=(i+1,))
-        udp_threads.append(thread)
-        thread.start()
+    # Closed loop (one request in flight per client) unless a fixed arrival rate is given
+    options = dict(clients=num_clients, rate=rate, duration=duration, sizes=[message_size])
     
-    for thread in udp_threads:
-        thread.join()
-    
-    udp_total = time.time() - udp_start
-    print(f"UDP total time: {udp_total:.3f}s")
+    print(f"\nTesting {num_clients} UDP clients...")
+    udp_report = run_load(protocol='udp', port=12345, **options)
     
     time.sleep(1)  # Brief pause
     
-    # Test TCP clients
     print(f"\nTesting {num_clients} TCP clients...")
-    tcp_threads = []
-    tcp_start = time.time()
-    
-    for i in range(num_clients):
-        thread = threading.Thread(target=tcp_client_test, args=(i+1,))
-        tcp_threads.append(thread)
-        thread.start()
-    
-    for thread in tcp_threads:
-        thread.join()
-    
-    tcp_total = time.time() - tcp_start
-    print(f"TCP total time: {tcp_total:.3f}s")
+    tcp_report = run_load(protocol='tcp', port=12346, **options)  # Different port for TCP
     
-    print(f"\nComparison Results:")
-    print(f"UDP: {udp_total:.3f}s")
-    print(f"TCP: {tcp_total:.3f}s")
-    print(f"Difference: {abs(tcp_total - udp_total):.3f}s")
+    print("\nComparison Results:")
+    print(json.dumps({'udp': udp_report, 'tcp': tcp_report}, indent=2))
+    return udp_report, tcp_report
 
 if __name__ == "__main__":
     compare_tcp_udp()
@@ -0,0 +1,133 @@
+
+# ASYNC BATCHED LOGGER (async_logger.py)
+# Shared by all the servers. Handlers only append a compact record to a
+# queue; a background thread formats records and writes them in batches, so
+# a slow terminal or pipe never stalls the network path.
+import atexit
+import itertools
+import sys
+import threading
+import time
+from collections import deque
+
+DEBUG = 10
+INFO = 20
+WARNING = 30
+ERROR = 40
+
+LEVEL_NAMES = {DEBUG: 'DEBUG', INFO: 'INFO', WARNING: 'WARNING', ERROR: 'ERROR'}
+
+class AsyncLogger:
+    """Queue-backed logger with batched writes, sampling and per-level suppression"""
+    def __init__(self, sink=None, level=DEBUG, sample_every=None, suppressed=(),
+                 flush_interval=0.05, max_pending=100000):
+        self.sink = sink or sys.stdout
+        self.level = level
+        # e.g. {DEBUG: 100} keeps one DEBUG record in every hundred
+        self.sample_every = dict(sample_every or {})
+        self.suppressed = set(suppressed)
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+
+        self.pending = deque()
+        self.samplers = {level: itertools.count() for level in self.sample_every}
+        self.wakeup = threading.Event()
+        self.stopped = False
+        self.written = 0
+        self.dropped = 0
+        self.sampled_out = 0
+        self.batches = 0
+
+        # Formatting "[HH:MM:SS]" once per second instead of once per record
+        self.cached_second = None
+        self.cached_stamp = ''
+
+        self.writer = threading.Thread(target=self.writer_loop, name="async-logger", daemon=True)
+        self.writer.start()
+        atexit.register(self.close)
+
+    def enabled(self, level):
+        return level >= self.level and level not in self.suppressed
+
+    def log(self, level, fmt, *args):
+        """Queue a record; fmt is only formatted with args later, on the writer thread"""
+        if level < self.level or level in self.suppressed:
+            return
+        every = self.sample_every.get(level)
+        if every and next(self.samplers[level]) % every:
+            self.sampled_out += 1
+            return
+        if len(self.pending) >= self.max_pending:
+            # The sink cannot keep up; losing log lines beats blocking a handler
+            self.dropped += 1
+            return
+        self.pending.append((time.time(), level, fmt, args))
+
+    def debug(self, fmt, *args):
+        self.log(DEBUG, fmt, *args)
+
+    def info(self, fmt, *args):
+        self.log(INFO, fmt, *args)
+
+    def warning(self, fmt, *args):
+        self.log(WARNING, fmt, *args)
+
+    def error(self, fmt, *args):
+        self.log(ERROR, fmt, *args)
+
+    def stamp(self, created):
+        second = int(created)
+        if second != self.cached_second:
+            self.cached_second = second
+            self.cached_stamp = time.strftime("[%H:%M:%S]", time.localtime(second))
+        return self.cached_stamp
+
+    def format_record(self, record):
+        created, level, fmt, args = record
+        try:
+            text = fmt.format(*args) if args else fmt
+        except (IndexError, KeyError, ValueError) as e:
+            text = f"{fmt!r} {args!r} (format error: {e})"
+        if level >= WARNING:
+            return f"{self.stamp(created)} {LEVEL_NAMES[level]}: {text}\n"
+        return f"{self.stamp(created)} {text}\n"
+
+    def flush(self):
+        """Write everything queued so far as one batch"""
+        pending = self.pending
+        lines = []
+        while pending:
+            lines.append(self.format_record(pending.popleft()))
+        if not lines:
+            return
+        try:
+            self.sink.write(''.join(lines))
+            self.sink.flush()
+        except (OSError, ValueError):
+            return
+        self.written += len(lines)
+        self.batches += 1
+
+    def writer_loop(self):
+        while not self.stopped:
+            self.wakeup.wait(self.flush_interval)
+            self.wakeup.clear()
+            self.flush()
+
+    def close(self):
+        """Stop the writer and flush what is left"""
+        if self.stopped:
+            return
+        self.stopped = True
+        self.wakeup.set()
+        self.writer.join(timeout=1.0)
+        self.flush()
+
+    def stats(self):
+        return {
+            'pending': len(self.pending),
+            'written': self.written,
+            'dropped': self.dropped,
+            'sampled_out': self.sampled_out,
+            'batches': self.batches,
+        }
@@ -0,0 +1,215 @@
+
+# BINARY PROTOCOL (binary_protocol.py)
+# Shared by the TCP and UDP servers and clients. A compact alternative to the
+# text messages: every message is an 11-byte struct header (magic, opcode,
+# flags, request id, payload length) followed by the payload, and the server
+# looks the opcode up in a table instead of parsing strings. On TCP a client
+# switches to it like to framed mode, after BINARY_FEATURE in the welcome
+# banner; on UDP the magic byte alone marks a binary datagram.
+import socket
+import struct
+
+from framing import MAX_FRAME_SIZE, FrameError
+
+# 0xFB never occurs in UTF-8 and differs from the compressed, batched and reliable markers
+BINARY_MAGIC = 0xFB
+BINARY_HEADER = struct.Struct('!BBBII')  # magic, opcode, flags, request id, payload length
+
+BINARY_FEATURE = 'binary'
+BINARY_REQUEST = 'PROTO binary'
+BINARY_ACK = 'PROTO binary OK'
+
+# Flags
+REPLY = 0x01
+ERROR = 0x02  # The payload is a UTF-8 error message
+PUSH = 0x04   # Sent by the server unasked (a published update), with request id 0
+
+# Opcodes 0x01-0x3F are the built-in commands; 0x40 and up are free for applications
+OP_ECHO = 0x01  # Reply: the payload, unchanged
+OP_ACK = 0x02   # Reply: ACK_BODY (TCP) or UDP_ACK_BODY (UDP)
+OP_QUIT = 0x03  # Reply: empty; the server then closes the connection (or ends the UDP session)
+OP_SUBSCRIBE = 0x04    # Payload: a topic name. Reply: empty
+OP_UNSUBSCRIBE = 0x05  # Payload: a topic name. Reply: empty
+OP_PUBLISH = 0x06      # Payload: pack_topic(). Reply: ACK_BODY with the subscriber count; pushes use it too
+FIRST_APPLICATION_OPCODE = 0x40
+
+ACK_BODY = struct.Struct('!I')       # server-wide message number
+UDP_ACK_BODY = struct.Struct('!II')  # session message count, total message count
+TOPIC_HEADER = struct.Struct('!B')   # length of the UTF-8 topic name in front of a published payload
+
+def is_binary(data):
+    return len(data) >= BINARY_HEADER.size and data[0] == BINARY_MAGIC
+
+def encode_message(opcode, request_id, payload=b'', flags=0):
+    return BINARY_HEADER.pack(BINARY_MAGIC, opcode, flags, request_id, len(payload)) + payload
+
+def write_message(out, opcode, request_id, payload=b'', flags=0):
+    """Append a message to an output buffer (ReplyBuffer or OutputBuffer) without joining"""
+    out.write(BINARY_HEADER.pack(BINARY_MAGIC, opcode, flags, request_id, len(payload)))
+    out.write(payload)
+
+def write_error(out, opcode, request_id, message):
+    """Append the error reply a handler raising ValueError(message) would have produced"""
+    write_message(out, opcode, request_id, message.encode('utf-8'), REPLY | ERROR)
+
+def pack_topic(topic, payload=b''):
+    name = topic.encode('utf-8')
+    if len(name) > 255:
+        raise ValueError("Topic name longer than 255 bytes")
+    return TOPIC_HEADER.pack(len(name)) + name + payload
+
+def unpack_topic(payload):
+    """Returns (topic, payload view) for a publish request or push"""
+    view = memoryview(payload)
+    if not view:
+        raise ValueError("Missing topic")
+    end = TOPIC_HEADER.size + view[0]
+    if end > len(view):
+        raise ValueError("Truncated topic")
+    return str(view[TOPIC_HEADER.size:end], 'utf-8'), view[end:]
+
+def decode_message(data):
+    """Returns (opcode, flags, request_id, payload) for one binary datagram; raises ValueError if malformed"""
+    magic, opcode, flags, request_id, length = BINARY_HEADER.unpack_from(data)
+    if magic != BINARY_MAGIC or len(data) - BINARY_HEADER.size != length:
+        raise ValueError("Malformed binary message")
+    return opcode, flags, request_id, memoryview(data)[BINARY_HEADER.size:]
+
+class OpcodeTable:
+    """Table-driven dispatch: opcode -> handler(context, payload), returning (reply_payload, keep_open)
+
+    context is what the server knows about the request: the client id on TCP, and
+    (address, session count, total count) on UDP. payload is a view that is only valid
+    during the call. A handler raising ValueError gets its message sent back as an error reply.
+    """
+    def __init__(self):
+        self.handlers = [None] * 256
+        self.names = {}
+
+    def register(self, opcode, handler, name=None):
+        if not 0 < opcode < 256:
+            raise ValueError(f"Opcode {opcode} out of range")
+        self.handlers[opcode] = handler
+        self.names[opcode] = name or getattr(handler, '__name__', str(opcode))
+
+    def name(self, opcode):
+        return self.names.get(opcode, f"0x{opcode:02x}")
+
+    def call(self, context, opcode, payload):
+        """Run the opcode's handler; returns (reply flags, reply payload, keep_open)"""
+        handler = self.handlers[opcode]
+        if handler is None:
+            return REPLY | ERROR, b"unknown opcode", True
+        try:
+            reply, keep_open = handler(context, payload)
+        except ValueError as e:
+            return REPLY | ERROR, str(e).encode('utf-8'), True
+        return REPLY, reply, keep_open
+
+    def dispatch(self, context, opcode, request_id, payload, out):
+        """Run the handler and write its reply to out; returns keep_open"""
+        flags, reply, keep_open = self.call(context, opcode, payload)
+        write_message(out, opcode, request_id, reply, flags)
+        return keep_open
+
+class BinaryDecoder:
+    """Turns a chunked byte stream of binary messages back into (opcode, flags, request_id, payload)"""
+    def __init__(self, max_payload_size=MAX_FRAME_SIZE):
+        self.max_payload_size = max_payload_size
+        self.buffer = bytearray()
+
+    def feed(self, data):
+        buffer = self.buffer
+        buffer += data
+
+        messages = []
+        offset = 0
+        header_size = BINARY_HEADER.size
+        while len(buffer) - offset >= header_size:
+            magic, opcode, flags, request_id, length = BINARY_HEADER.unpack_from(buffer, offset)
+            if magic != BINARY_MAGIC:
+                raise FrameError("Lost binary message boundary")
+            if length > self.max_payload_size:
+                raise FrameError(f"Message of {length} bytes exceeds limit of {self.max_payload_size}")
+            end = offset + header_size + length
+            if end > len(buffer):
+                break
+            messages.append((opcode, flags, request_id, bytes(buffer[offset + header_size:end])))
+            offset = end
+
+        if offset:
+            del buffer[:offset]
+        return messages
+
+class BinaryClient:
+    """Blocking TCP client for binary mode: send any number of requests, then read their replies in order
+
+    Pushes from topics this client subscribed to are kept apart from the replies.
+    """
+    def __init__(self, host='localhost', port=12345, timeout=10.0):
+        self.sock = socket.create_connection((host, port), timeout=timeout)
+        self.decoder = BinaryDecoder()
+        self.replies = []
+        self.pushes = []
+        self.next_id = 1
+        self.welcome = self.sock.recv(1024).decode('utf-8', 'replace')
+        if BINARY_FEATURE not in self.welcome.split("Features:", 1)[-1].split():
+            self.sock.close()
+            raise ConnectionError(f"Server does not offer binary mode: {self.welcome}")
+        self.sock.sendall(BINARY_REQUEST.encode('utf-8'))
+        ack = b''
+        while len(ack) < len(BINARY_ACK):
+            chunk = self.sock.recv(len(BINARY_ACK) - len(ack))
+            if not chunk:
+                raise ConnectionError("Server closed the connection during the binary handshake")
+            ack += chunk
+        if ack.decode('utf-8', 'replace') != BINARY_ACK:
+            raise ConnectionError(f"Unexpected reply to binary request: {ack!r}")
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def send(self, opcode, payload=b''):
+        """Send one request; returns its request id"""
+        request_id = self.next_id
+        self.next_id = (request_id + 1) & 0xFFFFFFFF
+        self.sock.sendall(encode_message(opcode, request_id, payload))
+        return request_id
+
+    def send_many(self, requests):
+        """Send (opcode, payload) pairs in one write; returns the first request id"""
+        first = self.next_id
+        parts = []
+        for opcode, payload in requests:
+            parts.append(encode_message(opcode, self.next_id, payload))
+            self.next_id = (self.next_id + 1) & 0xFFFFFFFF
+        self.sock.sendall(b''.join(parts))
+        return first
+
+    def subscribe(self, topic):
+        return self.send(OP_SUBSCRIBE, topic.encode('utf-8'))
+
+    def publish(self, topic, payload):
+        return self.send(OP_PUBLISH, pack_topic(topic, payload))
+
+    def read(self):
+        data = self.sock.recv(65536)
+        if not data:
+            raise ConnectionError("Server closed the connection")
+        for message in self.decoder.feed(data):
+            (self.pushes if message[1] & PUSH else self.replies).append(message)
+
+    def receive(self, count=1):
+        """The next count replies, as (opcode, flags, request_id, payload)"""
+        while len(self.replies) < count:
+            self.read()
+        replies, self.replies = self.replies[:count], self.replies[count:]
+        return replies
+
+    def receive_pushes(self, count=1):
+        """The next count pushes, as (topic, payload)"""
+        while len(self.pushes) < count:
+            self.read()
+        pushes, self.pushes = self.pushes[:count], self.pushes[count:]
+        return [(topic, bytes(payload)) for topic, payload in (unpack_topic(push[3]) for push in pushes)]
+
+    def close(self):
+        self.sock.close()
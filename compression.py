@@ -0,0 +1,411 @@
+
+# PAYLOAD COMPRESSION (compression.py)
+# Shared by the TCP and UDP servers and clients. Compression is negotiated
+# once per connection (TCP: along with the framing request; UDP: with a PROTO
+# datagram that sets up the session) and then applied per message above a
+# size threshold. Shared dictionaries prime the compressor with typical
+# listing text; on TCP each message is also compressed against the ones
+# before it, so repetitive traffic shrinks further the longer a link lives.
+import os
+import sys
+import time
+import zlib
+from collections import Counter
+
+try:
+    import lz4.block as lz4_block
+except ImportError:
+    lz4_block = None  # LZ4 is optional; zlib is always there
+
+from framing import MAX_FRAME_SIZE
+
+# Welcome-banner features and PROTO options: "compress=zlib,lz4" and "dict=name:crc32,..."
+COMPRESS_OPTION = 'compress'
+DICT_OPTION = 'dict'
+
+# UDP negotiation; TCP sends its options after FRAMED_REQUEST instead
+COMPRESS_REQUEST = 'PROTO compress'
+COMPRESS_ACK = 'PROTO compress OK'
+PROTO_ERROR = 'PROTO error'
+
+# What a sync flush ends with; left off the wire and added back before inflating
+SYNC_TAIL = b'\x00\x00\xff\xff'
+
+# Framed payloads start with a flag byte once compression is on
+RAW_PREFIX = b'\x00'
+COMPRESSED_PREFIX = b'\x01'
+# Compressed datagrams start with a marker that never occurs in UTF-8 (reliable and batched use 0xFE/0xFD)
+COMPRESSED_MAGIC = 0xFC
+COMPRESSED_DATAGRAM_PREFIX = bytes([COMPRESSED_MAGIC])
+MAX_DATAGRAM_SIZE = 65535
+
+class CompressionError(ValueError):
+    """Unsupported codec or dictionary, or a payload that does not decompress"""
+
+# Shared dictionaries by name; both ends must register the same bytes under the same name
+DICTIONARIES = {}
+
+def register_dictionary(name, data):
+    """Make a shared dictionary available to every server and client in this process"""
+    if not name or any(char in name for char in ' ,:='):
+        raise ValueError(f"Invalid dictionary name: {name!r}")
+    DICTIONARIES[name] = bytes(data)
+
+def build_dictionary(samples, size=8192):
+    """A shared dictionary from sample messages: common ones last, where deflate finds them cheapest"""
+    counts = Counter(bytes(sample) for sample in samples)
+    parts = []
+    total = 0
+    for sample, _ in counts.most_common():
+        if total + len(sample) > size:
+            break
+        parts.append(sample)
+        total += len(sample)
+    return b''.join(reversed(parts))
+
+def dictionary_token(name, data):
+    # The checksum catches two ends that registered different bytes under one name
+    return f"{name}:{zlib.crc32(data):08x}"
+
+class ZlibCodec:
+    """Raw deflate, without the zlib header and checksum; TCP and UDP already check integrity
+
+    With stream=True one compressor lives as long as the connection and every message is
+    sync-flushed out of it, so later messages back-reference earlier ones (the same idea as
+    WebSocket permessage-deflate). That needs in-order delivery, so it is for TCP only.
+    """
+    name = 'zlib'
+    supports_dictionary = True
+
+    def __init__(self, level=6, dictionary=b'', stream=False):
+        self.level = level
+        self.dictionary = dictionary
+        self.stream = stream
+        # A deflate state is a few hundred KB; allocating and faulting one in per message
+        # costs far more than compressing a short message, so it is set up once
+        self.compressor = None
+        self.decompressor = None
+        if stream or dictionary:
+            self.compressor = self.new_compressor(15)
+        if stream:
+            self.decompressor = self.new_decompressor()
+
+    def new_compressor(self, wbits):
+        if self.dictionary:
+            return zlib.compressobj(self.level, zlib.DEFLATED, -wbits, 8, zlib.Z_DEFAULT_STRATEGY, self.dictionary)
+        return zlib.compressobj(self.level, zlib.DEFLATED, -wbits)
+
+    def new_decompressor(self):
+        if self.dictionary:
+            return zlib.decompressobj(-15, self.dictionary)
+        return zlib.decompressobj(-15)
+
+    def compress(self, data):
+        if self.stream:
+            packed = self.compressor.compress(data) + self.compressor.flush(zlib.Z_SYNC_FLUSH)
+            return packed[:-len(SYNC_TAIL)]
+        if self.compressor is not None:
+            # Starts from the primed dictionary every time; copying is thread-safe
+            compressor = self.compressor.copy()
+        else:
+            # A window just big enough for the payload keeps the throwaway state small
+            compressor = self.new_compressor(min(15, max(9, len(data).bit_length())))
+        return compressor.compress(data) + compressor.flush()
+
+    def decompress(self, data, max_size):
+        try:
+            if self.stream:
+                decompressor = self.decompressor
+                data = bytes(data) + SYNC_TAIL
+            else:
+                decompressor = self.new_decompressor()
+            # The limit stops a small payload from expanding into an unbounded one
+            result = decompressor.decompress(data, max_size)
+        except zlib.error as e:
+            raise CompressionError(f"Corrupt zlib payload: {e}") from None
+        if decompressor.unconsumed_tail:
+            raise CompressionError(f"Payload expands beyond {max_size} bytes")
+        if not self.stream and not decompressor.eof:
+            raise CompressionError("Truncated zlib payload")
+        return result
+
+class Lz4Codec:
+    """LZ4 block format: less compression than zlib for a fraction of the CPU (needs the lz4 package)"""
+    name = 'lz4'
+    supports_dictionary = False
+
+    def __init__(self, level=6, dictionary=b'', stream=False):
+        self.dictionary = b''
+        # Blocks are always independent
+        self.stream = False
+        # lz4's high-compression mode only pays off at the top of zlib's level range
+        self.mode = 'high_compression' if level >= 9 else 'default'
+
+    def compress(self, data):
+        return lz4_block.compress(data, mode=self.mode)
+
+    def decompress(self, data, max_size):
+        # The block starts with the uncompressed size, so the limit is checked before decompressing
+        if len(data) >= 4 and int.from_bytes(bytes(data[:4]), 'little') > max_size:
+            raise CompressionError(f"Payload expands beyond {max_size} bytes")
+        try:
+            return lz4_block.decompress(data)
+        except lz4_block.LZ4BlockError as e:
+            raise CompressionError(f"Corrupt lz4 payload: {e}") from None
+
+# Preference order when both ends support several
+CODECS = {'zlib': ZlibCodec}
+if lz4_block is not None:
+    CODECS = {'lz4': Lz4Codec, 'zlib': ZlibCodec}
+
+def parse_options(text):
+    """{'compress': [...], 'dict': [...]} from option tokens such as 'compress=zlib dict=listings:1a2b3c4d'"""
+    options = {}
+    for token in text.split():
+        key, _, values = token.partition('=')
+        if key in (COMPRESS_OPTION, DICT_OPTION):
+            options[key] = [value for value in values.split(',') if value]
+    return options
+
+class CompressionSession:
+    """One connection's (or UDP session's) codec and threshold, with byte and CPU accounting"""
+    def __init__(self, codec, dictionary_name=None, threshold=256, max_size=MAX_FRAME_SIZE):
+        self.codec = codec
+        self.dictionary_name = dictionary_name
+        self.threshold = threshold
+        self.max_size = max_size
+        self.compressed = 0
+        self.uncompressed = 0
+        self.raw_out = 0
+        self.wire_out = 0
+        self.raw_in = 0
+        self.wire_in = 0
+        self.compress_ns = 0
+        self.decompress_ns = 0
+
+    def describe(self):
+        """The options that reproduce this session on the other end"""
+        text = f"{COMPRESS_OPTION}={self.codec.name}"
+        if self.dictionary_name:
+            text += f" {DICT_OPTION}={dictionary_token(self.dictionary_name, self.codec.dictionary)}"
+        return text
+
+    def compress(self, payload):
+        """Compressed bytes, or None when the payload is too small or does not shrink
+
+        A stream codec has already added the payload to the shared window by the time
+        its size is known, so its output is sent even if it did not shrink; otherwise the
+        peer's decompressor would miss those bytes and every later back-reference.
+        """
+        size = len(payload)
+        self.raw_out += size
+        if size >= self.threshold:
+            # Thread CPU time, so time spent waiting on other threads is not charged to compression
+            started = time.thread_time_ns()
+            packed = self.codec.compress(payload)
+            self.compress_ns += time.thread_time_ns() - started
+            if len(packed) < size or self.codec.stream:
+                self.compressed += 1
+                self.wire_out += len(packed) + 1
+                return packed
+        self.uncompressed += 1
+        self.wire_out += size + 1
+        return None
+
+    def decompress(self, packed):
+        started = time.thread_time_ns()
+        payload = self.codec.decompress(packed, self.max_size)
+        self.decompress_ns += time.thread_time_ns() - started
+        self.raw_in += len(payload)
+        return payload
+
+    def encode(self, payload):
+        """A framed payload: flag byte, then the payload as is or compressed"""
+        packed = self.compress(payload)
+        if packed is None:
+            return RAW_PREFIX + payload
+        return COMPRESSED_PREFIX + packed
+
+    def decode(self, payload):
+        """Reverse of encode(); a raw payload comes back as a view without copying"""
+        self.wire_in += len(payload)
+        flag = payload[0] if payload else None
+        if flag == RAW_PREFIX[0]:
+            self.raw_in += len(payload) - 1
+            return payload[1:]
+        if flag == COMPRESSED_PREFIX[0]:
+            return self.decompress(payload[1:])
+        raise CompressionError(f"Unknown payload flag {flag!r}")
+
+    def pack_datagram(self, data):
+        """A datagram as sent: compressed behind COMPRESSED_MAGIC when that saves space, else unchanged"""
+        packed = self.compress(data)
+        if packed is None:
+            # The marker byte is only added to compressed datagrams
+            self.wire_out -= 1
+            return data
+        return COMPRESSED_DATAGRAM_PREFIX + packed
+
+    def unpack_datagram(self, data):
+        self.wire_in += len(data)
+        if not is_compressed(data):
+            self.raw_in += len(data)
+            return data
+        return self.decompress(memoryview(data)[1:])
+
+    def stats(self):
+        return {
+            'codec': self.codec.name,
+            'dictionary': self.dictionary_name,
+            'compressed': self.compressed,
+            'uncompressed': self.uncompressed,
+            'ratio_out': round(self.raw_out / self.wire_out, 3) if self.wire_out else None,
+            'ratio_in': round(self.raw_in / self.wire_in, 3) if self.wire_in else None,
+            'bytes_saved': self.raw_out + self.raw_in - self.wire_out - self.wire_in,
+            'compress_cpu_ms': round(self.compress_ns / 1e6, 3),
+            'decompress_cpu_ms': round(self.decompress_ns / 1e6, 3),
+        }
+
+def is_compressed(data):
+    return len(data) > 0 and data[0] == COMPRESSED_MAGIC
+
+class CompressedSender:
+    """Wraps a UDP socket so every reply sent through it is compressed for one client"""
+    def __init__(self, sock, session):
+        self.sock = sock
+        self.session = session
+
+    def sendto(self, data, address):
+        return self.sock.sendto(self.session.pack_datagram(data), address)
+
+def negotiate_datagram(sock, address, options):
+    """UDP session setup: offer everything options supports; returns the session the server chose
+
+    Raises CompressionError if the server refuses, and socket.timeout if it does not answer.
+    """
+    sock.sendto(' '.join([COMPRESS_REQUEST] + options.offer()).encode('utf-8'), address)
+    reply = sock.recvfrom(MAX_DATAGRAM_SIZE)[0].decode('utf-8', 'replace')
+    if not reply.startswith(COMPRESS_ACK):
+        raise CompressionError(reply)
+    return options.accept(reply[len(COMPRESS_ACK):], exact=True, max_size=MAX_DATAGRAM_SIZE)
+
+class CompressionOptions:
+    """The codecs and shared dictionaries one end supports, and how eagerly it compresses"""
+    def __init__(self, codecs=None, dictionaries=None, threshold=256, level=6):
+        self.codecs = [name for name in (CODECS if codecs is None else codecs) if name in CODECS]
+        self.dictionaries = DICTIONARIES if dictionaries is None else dictionaries
+        # Below the threshold the codec's own overhead outweighs what it saves
+        self.threshold = threshold
+        self.level = level
+        # Stateless codecs hold nothing per session, so UDP sessions share one per (codec, dictionary)
+        self.shared_codecs = {}
+
+    def codec(self, name, dictionary_name, stream):
+        dictionary = self.dictionaries[dictionary_name] if dictionary_name else b''
+        if stream:
+            return CODECS[name](self.level, dictionary, stream=True)
+        key = (name, dictionary_name)
+        codec = self.shared_codecs.get(key)
+        if codec is None:
+            codec = self.shared_codecs[key] = CODECS[name](self.level, dictionary)
+        return codec
+
+    def offer(self):
+        """Option tokens listing everything supported, e.g. for the welcome banner"""
+        if not self.codecs:
+            return []
+        tokens = [f"{COMPRESS_OPTION}={','.join(self.codecs)}"]
+        if self.dictionaries:
+            names = ','.join(dictionary_token(name, data) for name, data in self.dictionaries.items())
+            tokens.append(f"{DICT_OPTION}={names}")
+        return tokens
+
+    def accept(self, text, exact=False, stream=False, max_size=MAX_FRAME_SIZE):
+        """A session for the first codec and dictionary offered in text that this end supports
+
+        Returns None when text asks for no compression. With exact=True (the peer already
+        chose), anything unsupported is an error instead of being skipped. stream=True is
+        for ordered transports: the session keeps compression context between messages.
+        """
+        options = parse_options(text)
+        offered = options.get(COMPRESS_OPTION)
+        if not offered:
+            return None
+        codec_name = next((name for name in offered if name in self.codecs), None)
+        if codec_name is None or (exact and codec_name != offered[0]):
+            raise CompressionError(f"Unsupported compression: {','.join(offered)}")
+        codec_class = CODECS[codec_name]
+
+        dictionary_name = None
+        wanted = options.get(DICT_OPTION, []) if codec_class.supports_dictionary else []
+        for token in wanted:
+            name = token.partition(':')[0]
+            data = self.dictionaries.get(name)
+            if data is not None and dictionary_token(name, data) == token:
+                dictionary_name = name
+                break
+            if exact:
+                raise CompressionError(f"Unknown dictionary: {token}")
+        return CompressionSession(self.codec(codec_name, dictionary_name, stream), dictionary_name,
+                                  self.threshold, max_size)
+
+    def choose(self, features, stream=True):
+        """Client side: the session to ask for, given the server's welcome features (None if no match)"""
+        try:
+            return self.accept(' '.join(features), stream=stream)
+        except CompressionError:
+            return None
+
+def benchmark(messages=2000):
+    """Wire bytes and CPU per message for listing-like payloads, by codec, dictionary and context"""
+    listings = [
+        (f"Listing #{4400 + i}: reclaimed oak dining table, seats {4 + i % 4}, condition: like new. "
+         f"Shipping: local pickup or courier. Seller rating {4 + (i % 10) / 10:.1f}. "
+         f"Eco score A, carbon offset included, price negotiable.").encode('utf-8')
+        for i in range(messages + 100)
+    ]
+    dictionaries = {'listings': build_dictionary(listings[:100])}
+    traffic = listings[100:]
+    raw_bytes = sum(len(message) for message in traffic)
+
+    for name in CODECS:
+        for dictionary_name in (None, 'listings'):
+            for stream in (False, True):
+                if (dictionary_name and not CODECS[name].supports_dictionary) or (stream and name != 'zlib'):
+                    continue
+                # Separate ends, as on a real link, so stream mode keeps both contexts in step
+                sender = CompressionOptions([name], dictionaries, threshold=0)
+                receiver = CompressionOptions([name], dictionaries, threshold=0)
+                offer = f"{COMPRESS_OPTION}={name}"
+                if dictionary_name:
+                    offer += f" {DICT_OPTION}={dictionary_token(dictionary_name, dictionaries[dictionary_name])}"
+                out = sender.accept(offer, exact=True, stream=stream)
+                back = receiver.accept(offer, exact=True, stream=stream)
+                wire = [out.encode(message) for message in traffic]
+                assert [bytes(back.decode(payload)) for payload in wire] == traffic
+                label = f"{name}{' + dictionary' if dictionary_name else ''}{' + context' if stream else ''}"
+                print(f"{label:>26}: ratio {raw_bytes / sum(len(payload) for payload in wire):5.2f}, "
+                      f"compress {out.compress_ns / messages / 1e3:6.1f} us, "
+                      f"decompress {back.decompress_ns / messages / 1e3:6.1f} us per message")
+
+def test_mixed_stream(rounds=200):
+    """Stream mode with incompressible payloads between compressible ones stays in step on both ends"""
+    sender = CompressionOptions(['zlib'], {}, threshold=64)
+    receiver = CompressionOptions(['zlib'], {}, threshold=64)
+    out = sender.accept(f"{COMPRESS_OPTION}=zlib", exact=True, stream=True)
+    back = receiver.accept(f"{COMPRESS_OPTION}=zlib", exact=True, stream=True)
+    noise = os.urandom(300)
+    traffic = []
+    for i in range(rounds):
+        # Short (raw), random (does not shrink, twice so the second could reference the first) and text
+        traffic += [b'ping', noise, noise, f"Listing #{i}: reclaimed oak dining table".encode('utf-8') * 8]
+    wire = [out.encode(message) for message in traffic]
+    assert [bytes(back.decode(payload)) for payload in wire] == traffic
+    print(f"Mixed stream: {len(traffic)} messages round-tripped, {out.stats()}")
+
+if __name__ == "__main__":
+    # Pass "test" to check that stream mode survives payloads that do not compress
+    if len(sys.argv) > 1 and sys.argv[1] == "test":
+        test_mixed_stream()
+    else:
+        benchmark()
@@ -0,0 +1,58 @@
+
+# LENGTH-PREFIXED FRAMING (framing.py)
+# Shared by the TCP servers and clients. A frame is a 4-byte big-endian
+# payload length followed by the payload, so message boundaries survive
+# Nagle/coalescing and many requests can be pipelined on one connection.
+import struct
+
+FRAME_HEADER = struct.Struct('!I')
+MAX_FRAME_SIZE = 16 * 1024 * 1024
+
+# The server lists FRAMED_FEATURE in its welcome banner. A client opts in by
+# sending FRAMED_REQUEST as a plain text message and waiting for FRAMED_ACK;
+# every message after that, in both directions, is framed.
+FRAMED_FEATURE = 'framed'
+FRAMED_REQUEST = 'PROTO framed'
+FRAMED_ACK = 'PROTO framed OK'
+
+class FrameError(ValueError):
+    """Raised when a peer announces a frame larger than we accept"""
+
+def encode_frame(payload):
+    """Prefix a bytes payload with its length"""
+    return FRAME_HEADER.pack(len(payload)) + payload
+
+def write_frame(out, payload):
+    """Append a framed payload to an output buffer (ReplyBuffer or OutputBuffer) without joining"""
+    out.write(FRAME_HEADER.pack(len(payload)))
+    out.write(payload)
+
+class FrameDecoder:
+    """Turns an arbitrarily chunked byte stream back into payloads"""
+    def __init__(self, max_frame_size=MAX_FRAME_SIZE):
+        self.max_frame_size = max_frame_size
+        self.buffer = bytearray()
+
+    def feed(self, data):
+        """Add received bytes and return every payload that is now complete"""
+        buffer = self.buffer
+        buffer += data
+
+        payloads = []
+        offset = 0
+        header_size = FRAME_HEADER.size
+        while len(buffer) - offset >= header_size:
+            (length,) = FRAME_HEADER.unpack_from(buffer, offset)
+            if length > self.max_frame_size:
+                raise FrameError(f"Frame of {length} bytes exceeds limit of {self.max_frame_size}")
+
+            end = offset + header_size + length
+            if end > len(buffer):
+                break
+            payloads.append(bytes(buffer[offset + header_size:end]))
+            offset = end
+
+        # Drop consumed frames in one go rather than once per frame
+        if offset:
+            del buffer[:offset]
+        return payloads
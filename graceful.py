@@ -0,0 +1,253 @@
+
+# GRACEFUL RESTART (graceful.py)
+# Shared by the TCP servers. SIGTERM stops the accept loop and drains the live
+# connections: each is closed as soon as it is between messages, so no reply
+# is cut off, and whatever is still open at the deadline goes down with the
+# process. For a restart, the new process first takes the listening socket
+# over a Unix socket (SCM_RIGHTS); the kernel keeps queueing SYNs on it the
+# whole time, so no connection attempt is refused during a deploy.
+import asyncio
+import os
+import selectors
+import signal
+import socket
+import tempfile
+import threading
+import time
+
+# Passing file descriptors between processes is a Unix feature
+FD_PASSING = hasattr(socket, 'send_fds')
+HANDOFF_READY = b'ready'
+
+def default_handoff_path(name, port):
+    """Where a server on port offers its listener to its successor, or None where that is unsupported"""
+    return os.path.join(tempfile.gettempdir(), f"{name}-{port}.handoff") if FD_PASSING else None
+
+def shutdown_read(sock):
+    """Make a blocked read see EOF once the data already received is consumed; a reply being sent still goes out"""
+    try:
+        sock.shutdown(socket.SHUT_RD)
+    except OSError:
+        pass
+
+def receive_listener(path, timeout=5.0):
+    """Take over the listening socket of the server offering it on path; None if no server is"""
+    channel = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    channel.settimeout(timeout)
+    with channel:
+        try:
+            channel.connect(path)
+        except (FileNotFoundError, ConnectionRefusedError):
+            return None  # First start, or a path left behind by a server that crashed
+        _, fds, _, _ = socket.recv_fds(channel, 16, 1)
+        if not fds:
+            return None  # That server is already shutting down and has closed its listener
+        listener = socket.socket(fileno=fds[0])
+        channel.sendall(HANDOFF_READY)
+        # The old server removes path before hanging up, so our own offer can take its place
+        channel.recv(1)
+    return listener
+
+class ListenerHandoff:
+    """Offers a listening socket to the next server process on a Unix socket path"""
+    def __init__(self, path, listener, on_handoff, timeout=5.0):
+        self.path = path
+        self.listener = listener
+        self.on_handoff = on_handoff
+        self.timeout = timeout
+        self.closed = False
+        try:
+            os.unlink(path)
+        except FileNotFoundError:
+            pass
+        self.server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.server.bind(path)
+        self.server.listen(1)
+        self.thread = threading.Thread(target=self.run, name="listener-handoff", daemon=True)
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def run(self):
+        while not self.closed:
+            try:
+                channel, _ = self.server.accept()
+            except OSError:
+                return  # Closed
+            with channel:
+                if self.offer(channel):
+                    self.on_handoff()
+                    return
+
+    def offer(self, channel):
+        """Send the listener; True once the new process confirms it has it"""
+        channel.settimeout(self.timeout)
+        try:
+            socket.send_fds(channel, [b'listener'], [self.listener.fileno()])
+            if channel.recv(len(HANDOFF_READY)) != HANDOFF_READY:
+                return False
+        except OSError:
+            return False  # The new process went away before taking over; keep serving
+        self.close()
+        return True
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        try:
+            # Wakes the thread blocked in accept; close alone does not on Linux
+            self.server.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.server.close()
+        try:
+            os.unlink(self.path)
+        except FileNotFoundError:
+            pass
+
+class AcceptLoop:
+    """Accepts connections until stop() is called, which is safe from any thread or a signal handler"""
+    def __init__(self, listener, on_accept=None):
+        self.listener = listener
+        # on_accept(start_ns, end_ns) times each accept() call, without the wait for a client
+        self.on_accept = on_accept
+        # Polled, not blocking: after a handoff the other process may take the connection first
+        listener.setblocking(False)
+        self.wake_reader, self.wake_writer = socket.socketpair()
+        self.selector = selectors.DefaultSelector()
+        self.selector.register(listener, selectors.EVENT_READ)
+        self.selector.register(self.wake_reader, selectors.EVENT_READ)
+        self.stopped = False
+
+    def accept(self):
+        """The next (client_socket, address), or None once stopped"""
+        while not self.stopped:
+            self.selector.select()
+            if self.stopped:
+                break
+            started = time.perf_counter_ns()
+            try:
+                client_socket, address = self.listener.accept()
+            except (BlockingIOError, InterruptedError):
+                continue
+            if self.on_accept is not None:
+                self.on_accept(started, time.perf_counter_ns())
+            # Some platforms hand out accepted sockets in the listener's non-blocking mode
+            client_socket.setblocking(True)
+            return client_socket, address
+        return None
+
+    def stop(self):
+        self.stopped = True
+        try:
+            self.wake_writer.send(b'\0')
+        except OSError:
+            pass
+
+    def close(self):
+        self.selector.close()
+        self.wake_reader.close()
+        self.wake_writer.close()
+
+class GracefulShutdown:
+    """Stops a server on SIGTERM or once its listener was handed off, then drains its connections
+
+    Connections are tracked by their idle reaper timer, whose partial flag tells whether
+    the client is in the middle of a message.
+    """
+    def __init__(self, drain_timeout=30.0, handoff_path=None, poll_interval=0.1):
+        self.drain_timeout = drain_timeout
+        self.handoff_path = handoff_path if FD_PASSING else None
+        self.poll_interval = poll_interval
+        self.lock = threading.Lock()
+        self.connections = {}  # timer -> close(), or None once asked to close
+        self.stop_accepting = None
+        self.handoff = None
+        self.draining = False
+        self.deadline = None
+        self.handed_off = False
+        self.closed_idle = 0
+        self.cut = 0
+
+    def inherit_listener(self):
+        """The listening socket of the server being replaced, or None to bind a new one"""
+        if self.handoff_path is None:
+            return None
+        return receive_listener(self.handoff_path)
+
+    def start(self, listener, stop_accepting):
+        """Arm SIGTERM and, with a handoff path, offer listener to the next server process"""
+        self.stop_accepting = stop_accepting
+        if threading.current_thread() is threading.main_thread():
+            signal.signal(signal.SIGTERM, lambda signum, frame: self.begin())
+        if self.handoff_path is not None:
+            self.handoff = ListenerHandoff(self.handoff_path, listener, self.handed_over).start()
+
+    def handed_over(self):
+        self.handed_off = True
+        self.begin()
+
+    def begin(self):
+        """Stop accepting; the server then drains its connections until the deadline"""
+        if self.draining:
+            return
+        self.draining = True
+        self.deadline = time.monotonic() + self.drain_timeout
+        if self.handoff is not None:
+            self.handoff.close()
+        if self.stop_accepting is not None:
+            self.stop_accepting()
+
+    def track(self, timer, close):
+        """Register a connection; close() is called to end it once it is between messages"""
+        with self.lock:
+            self.connections[timer] = close
+
+    def untrack(self, timer):
+        with self.lock:
+            self.connections.pop(timer, None)
+
+    def overdue(self):
+        return self.deadline is not None and time.monotonic() >= self.deadline
+
+    def close_idle(self):
+        """Close every connection that is between messages; returns how many are still open"""
+        with self.lock:
+            idle = [timer for timer, close in self.connections.items() if close is not None and not timer.partial]
+            closers = [self.connections[timer] for timer in idle]
+            for timer in idle:
+                self.connections[timer] = None
+            remaining = len(self.connections)
+        self.closed_idle += len(closers)
+        for close in closers:
+            close()
+        return remaining
+
+    def finish(self):
+        """Returns True if every connection closed before the deadline"""
+        with self.lock:
+            self.cut = len(self.connections)
+        return self.cut == 0
+
+    def drain(self):
+        """Close connections as they go idle until none are left or the deadline passes"""
+        while self.close_idle() and not self.overdue():
+            time.sleep(self.poll_interval)
+        return self.finish()
+
+    async def drain_async(self):
+        while self.close_idle() and not self.overdue():
+            await asyncio.sleep(self.poll_interval)
+        return self.finish()
+
+    def stats(self):
+        return {
+            'draining': self.draining,
+            'handed_off': self.handed_off,
+            'connections': len(self.connections),
+            'closed_idle': self.closed_idle,
+            'cut': self.cut,
+            'drain_timeout': self.drain_timeout,
+        }
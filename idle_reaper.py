@@ -0,0 +1,175 @@
+
+# IDLE CONNECTION REAPER (idle_reaper.py)
+# Shared by the TCP servers. A client that goes quiet (or crashed without
+# closing) would otherwise keep its handler and its max_clients slot forever.
+# Every connection gets a timer in one hashed timing wheel; a message only
+# stamps the time, and the wheel, advanced once per tick, re-files or closes
+# the connections whose deadline came up. Closing is left to a callback, so
+# threaded, selector and asyncio servers can each do it their own way.
+import asyncio
+import math
+import socket
+import threading
+import time
+
+class TimerWheel:
+    """Hashed timing wheel: O(1) to schedule, and each tick only looks at one slot"""
+    def __init__(self, tick=1.0, slots=512, now=None):
+        self.tick = tick
+        self.slots = [[] for _ in range(slots)]
+        self.current = int((time.monotonic() if now is None else now) / tick)
+        self.scheduled = 0
+
+    def schedule(self, deadline, item):
+        # Rounded up, so nothing fires early; deadlines beyond one turn wait for later rounds
+        tick = max(math.ceil(deadline / self.tick), self.current + 1)
+        self.slots[tick % len(self.slots)].append((tick, item))
+        self.scheduled += 1
+
+    def advance(self, now):
+        """Items whose tick has come, in no particular order"""
+        target = int(now / self.tick)
+        expired = []
+        # After a long pause every slot is visited once rather than every missed tick
+        for step in range(1, min(target - self.current, len(self.slots)) + 1):
+            slot = self.slots[(self.current + step) % len(self.slots)]
+            if not slot:
+                continue
+            remaining = []
+            for entry in slot:
+                if entry[0] <= target:
+                    expired.append(entry[1])
+                else:
+                    remaining.append(entry)
+            slot[:] = remaining
+        self.current = max(self.current, target)
+        self.scheduled -= len(expired)
+        return expired
+
+class ConnectionTimer:
+    """A tracked connection; touch() is all the hot path pays"""
+    __slots__ = ('last_active', 'partial', 'expire', 'label', 'closed')
+
+    def __init__(self, now, expire, label):
+        self.last_active = now
+        self.partial = False
+        self.expire = expire
+        self.label = label
+        self.closed = False
+
+    def touch(self, partial=False):
+        """Record activity; partial=True while the client is in the middle of sending a message"""
+        self.last_active = time.monotonic()
+        self.partial = partial
+
+def shutdown_socket(sock):
+    """Wake a thread blocked on sock with EOF; safe to race with the owner closing it"""
+    try:
+        sock.shutdown(socket.SHUT_RDWR)
+    except OSError:
+        pass
+
+class IdleReaper:
+    """Closes connections idle longer than idle_timeout, or stuck mid-message longer than read_timeout
+
+    Either timeout may be None to turn it off.
+    """
+    def __init__(self, idle_timeout=300.0, read_timeout=30.0, tick=1.0):
+        self.idle_timeout = idle_timeout
+        self.read_timeout = read_timeout
+        self.tick = tick
+        self.wheel = TimerWheel(tick)
+        self.lock = threading.Lock()
+        self.stop_event = threading.Event()
+        self.thread = None
+        self.active = 0
+        self.reaped_idle = 0
+        self.reaped_read = 0
+
+    def track(self, expire, label=None):
+        """Start timing a connection; expire() is called (from the reaper) to close it"""
+        now = time.monotonic()
+        timer = ConnectionTimer(now, expire, label)
+        check = self.next_check(timer, now)
+        with self.lock:
+            self.active += 1
+            if check is not None:
+                self.wheel.schedule(check, timer)
+        return timer
+
+    def untrack(self, timer):
+        """The connection closed by itself; its wheel entry is simply skipped when it comes up"""
+        if not timer.closed:
+            timer.closed = True
+            with self.lock:
+                self.active -= 1
+
+    def timeout(self, timer):
+        return self.read_timeout if timer.partial else self.idle_timeout
+
+    def next_check(self, timer, now):
+        """The timer's deadline or, if its current timeout is off, when to see whether that changed"""
+        timeout = self.timeout(timer)
+        if timeout is not None:
+            return timer.last_active + timeout
+        enabled = [timeout for timeout in (self.idle_timeout, self.read_timeout) if timeout is not None]
+        return now + min(enabled) if enabled else None
+
+    def reap(self, now=None):
+        """Close every connection past its deadline; returns how many were closed"""
+        now = time.monotonic() if now is None else now
+        with self.lock:
+            due = self.wheel.advance(now)
+        expired = []
+        for timer in due:
+            if timer.closed:
+                continue
+            timeout = self.timeout(timer)
+            if timeout is not None and timer.last_active + timeout <= now:
+                expired.append(timer)
+                continue
+            # Active since it was filed: file it again under its new deadline
+            check = self.next_check(timer, now)
+            if check is not None:
+                with self.lock:
+                    self.wheel.schedule(check, timer)
+
+        for timer in expired:
+            partial = timer.partial
+            self.untrack(timer)
+            if partial:
+                self.reaped_read += 1
+            else:
+                self.reaped_idle += 1
+            timer.expire()
+        return len(expired)
+
+    def run(self):
+        while not self.stop_event.wait(self.tick):
+            self.reap()
+
+    def start(self):
+        """Reap from a background thread (threaded servers)"""
+        if self.thread is None:
+            self.thread = threading.Thread(target=self.run, name="idle-reaper", daemon=True)
+            self.thread.start()
+        return self
+
+    async def run_async(self):
+        """Reap from the event loop itself (asyncio servers), so expire() runs on the loop thread"""
+        while True:
+            await asyncio.sleep(self.tick)
+            self.reap()
+
+    def stop(self):
+        self.stop_event.set()
+
+    def stats(self):
+        return {
+            'tracked': self.active,
+            'scheduled': self.wheel.scheduled,
+            'reaped_idle': self.reaped_idle,
+            'reaped_read': self.reaped_read,
+            'idle_timeout': self.idle_timeout,
+            'read_timeout': self.read_timeout,
+        }
@@ -0,0 +1,252 @@
+
+# HOT-PATH INSTRUMENTATION (instrumentation.py)
+# Shared by the TCP and UDP servers. One message in sample_every has each
+# stage it passes through (accept, recv, decode, build, send) timed with
+# perf_counter_ns into a per-stage histogram; every other message only bumps
+# plain attributes of a per-connection object owned by its handler. A Tracer
+# subclass receives the same spans, and MetricsEndpoint serves all server
+# statistics in the Prometheus text format on a separate local port.
+import socket
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+MSG_DONTWAIT = getattr(socket, 'MSG_DONTWAIT', 0)
+STAGES = ('accept', 'recv', 'decode', 'build', 'send')
+PROMETHEUS_CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+class Tracer:
+    """Hooks for an external tracer; subclass and override what you need
+
+    on_stage only sees sampled messages, with the stage's start and end in perf_counter_ns.
+    Hooks run on the server's own threads, so they should hand work off rather than block.
+    """
+    def on_connection_open(self, connection):
+        pass
+
+    def on_stage(self, connection, stage, start_ns, end_ns):
+        pass
+
+    def on_connection_close(self, connection):
+        pass
+
+class ConnectionMetrics:
+    """Byte and message counters of one connection (or UDP socket); only its handler writes them
+
+    messages counts requests answered on TCP and datagrams received on UDP.
+    """
+    __slots__ = ('instruments', 'id', 'address', 'opened', 'bytes_in', 'bytes_out', 'messages',
+                 'countdown', 'mark')
+
+    def __init__(self, instruments, connection_id, address):
+        self.instruments = instruments
+        self.id = connection_id
+        self.address = address
+        self.opened = time.monotonic()
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.messages = 0
+        # The first message is sampled, so even short connections show up in the stage timers
+        self.countdown = 1 if instruments.sample_every else 0
+        # perf_counter_ns at the end of the last timed stage; 0 while the message is not sampled
+        self.mark = 0
+
+    def sample(self):
+        """Start the next message; True (with the clock running) if it is one of the timed ones"""
+        self.countdown -= 1
+        if self.countdown:
+            self.mark = 0
+            return False
+        self.countdown = self.instruments.sample_every
+        self.mark = time.perf_counter_ns()
+        return True
+
+    def lap(self, stage):
+        """End a stage of a sampled message; callers check mark first so unsampled ones pay nothing"""
+        now = time.perf_counter_ns()
+        self.instruments.record(self, stage, self.mark, now)
+        self.mark = now
+
+    def sent(self, nbytes, messages=1):
+        self.bytes_out += nbytes
+        self.messages += messages
+
+    def snapshot(self):
+        return {
+            'id': self.id,
+            'address': self.address,
+            'age_s': round(time.monotonic() - self.opened, 3),
+            'bytes_in': self.bytes_in,
+            'bytes_out': self.bytes_out,
+            'messages': self.messages,
+        }
+
+class Instruments:
+    """Stage timers, per-connection counters and tracer hooks for one server"""
+    def __init__(self, server_stats, sample_every=16, tracer=None, stages=STAGES):
+        # 0 turns the stage timers off; the byte and message counters are always kept
+        self.sample_every = sample_every
+        self.tracer = tracer
+        self.stages = {stage: server_stats.histogram(f'stage_{stage}', 'ns') for stage in stages}
+        # Spread of totals over closed connections
+        self.connection_bytes = server_stats.histogram('connection_bytes', 'bytes')
+        self.connection_messages = server_stats.histogram('connection_messages', 'messages')
+        self.lock = threading.Lock()  # Taken once per connection, never per message
+        self.live = set()
+        self.closed = 0
+        self.closed_bytes_in = 0
+        self.closed_bytes_out = 0
+        self.closed_messages = 0
+        server_stats.gauge('connection_totals', self.totals)
+
+    def open(self, connection_id, address=None):
+        connection = ConnectionMetrics(self, connection_id, address)
+        with self.lock:
+            self.live.add(connection)
+        if self.tracer is not None:
+            self.tracer.on_connection_open(connection)
+        return connection
+
+    def close(self, connection):
+        with self.lock:
+            self.live.discard(connection)
+            self.closed += 1
+            self.closed_bytes_in += connection.bytes_in
+            self.closed_bytes_out += connection.bytes_out
+            self.closed_messages += connection.messages
+        self.connection_bytes.record(connection.bytes_in + connection.bytes_out)
+        self.connection_messages.record(connection.messages)
+        if self.tracer is not None:
+            self.tracer.on_connection_close(connection)
+
+    def record(self, connection, stage, start_ns, end_ns):
+        self.stages[stage].record(end_ns - start_ns)
+        if self.tracer is not None:
+            self.tracer.on_stage(connection, stage, start_ns, end_ns)
+
+    def recv_into(self, connection, inbox, sock, max_read=None, flags=0):
+        """inbox.recv_into that counts the bytes and, for a sampled message, times the call
+
+        A blocking read mostly waits for the client, which is not receive time, so a sampled
+        read first tries without waiting and only counts as timed if data was already there.
+        """
+        if not connection.sample():
+            nbytes = inbox.recv_into(sock, max_read, flags)
+        elif flags & MSG_DONTWAIT or not MSG_DONTWAIT:
+            nbytes = inbox.recv_into(sock, max_read, flags)
+            connection.lap('recv')
+        else:
+            try:
+                nbytes = inbox.recv_into(sock, max_read, flags | MSG_DONTWAIT)
+                connection.lap('recv')
+            except BlockingIOError:
+                nbytes = inbox.recv_into(sock, max_read, flags)
+                connection.mark = time.perf_counter_ns()
+        connection.bytes_in += nbytes
+        return nbytes
+
+    def recvfrom(self, connection, sock, size):
+        """sock.recvfrom for UDP, counted and timed like recv_into"""
+        if not connection.sample() or not MSG_DONTWAIT:
+            data, address = sock.recvfrom(size)
+            if connection.mark:
+                connection.lap('recv')
+        else:
+            try:
+                data, address = sock.recvfrom(size, MSG_DONTWAIT)
+                connection.lap('recv')
+            except BlockingIOError:
+                data, address = sock.recvfrom(size)
+                connection.mark = time.perf_counter_ns()
+        connection.bytes_in += len(data)
+        connection.messages += 1
+        return data, address
+
+    def accepted(self, start_ns, end_ns):
+        """Time of one accept() call (every connection, not sampled)"""
+        self.record(None, 'accept', start_ns, end_ns)
+
+    def totals(self):
+        """Open connections, and bytes and messages over every connection so far"""
+        with self.lock:
+            live = list(self.live)
+            totals = {
+                'open': len(live),
+                'closed': self.closed,
+                'bytes_in': self.closed_bytes_in,
+                'bytes_out': self.closed_bytes_out,
+                'messages': self.closed_messages,
+            }
+        # Live counters are read without their handlers' cooperation; a scrape may be one message behind
+        for connection in live:
+            totals['bytes_in'] += connection.bytes_in
+            totals['bytes_out'] += connection.bytes_out
+            totals['messages'] += connection.messages
+        return totals
+
+    def connections(self, limit=100):
+        """Per-connection counters of the busiest open connections"""
+        with self.lock:
+            live = list(self.live)
+        live.sort(key=lambda connection: connection.bytes_in + connection.bytes_out, reverse=True)
+        return [connection.snapshot() for connection in live[:limit]]
+
+class InstrumentedSender:
+    """Wraps a UDP socket to count reply bytes and time the first reply to a sampled datagram
+
+    Decoding and building are not split out on UDP: build runs from the last lap to that reply.
+    """
+    def __init__(self, sock, connection):
+        self.sock = sock
+        self.connection = connection
+
+    def sendto(self, data, address):
+        connection = self.connection
+        connection.bytes_out += len(data)
+        if not connection.mark:
+            return self.sock.sendto(data, address)
+        connection.lap('build')
+        sent = self.sock.sendto(data, address)
+        connection.lap('send')
+        connection.mark = 0
+        return sent
+
+class MetricsEndpoint:
+    """Serves GET /metrics in Prometheus text format from a background thread
+
+    Binds to loopback by default: the numbers are for a local scraper, not the clients.
+    """
+    def __init__(self, render, host='127.0.0.1', port=9100):
+        self.render = render
+        self.host = host
+        self.port = port
+        self.httpd = None
+
+    def start(self):
+        render = self.render
+
+        class MetricsHandler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?', 1)[0] not in ('/', '/metrics'):
+                    self.send_error(404)
+                    return
+                body = render().encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', PROMETHEUS_CONTENT_TYPE)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass  # Scrapes every few seconds would drown the server's own log
+
+        self.httpd = ThreadingHTTPServer((self.host, self.port), MetricsHandler)
+        self.httpd.daemon_threads = True
+        self.port = self.httpd.server_address[1]
+        threading.Thread(target=self.httpd.serve_forever, name="metrics-endpoint", daemon=True).start()
+        return self
+
+    def close(self):
+        if self.httpd is not None:
+            self.httpd.shutdown()
+            self.httpd.server_close()
@@ -0,0 +1,562 @@
+
+# DURABLE MESSAGE JOURNAL (journal.py)
+# Shared by the TCP and UDP servers. Handlers append each message they
+# receive to an in-memory queue; one writer thread turns everything queued
+# into one checksummed batch, written with a single write and a single fsync
+# (group commit) after waiting at most commit_interval for more records to
+# share it. Batches go to append-only segment files named after their first
+# offset; full segments are rolled over and old ones deleted by size or age.
+# JournalReader memory-maps the segments to replay or follow them from any offset.
+import atexit
+import mmap
+import os
+import struct
+import threading
+import time
+import zlib
+from collections import deque
+
+# Record kinds
+TEXT = 0     # A text or framed message as received
+BINARY = 1   # A binary protocol message: the opcode byte, then the payload
+CONNECT = 2  # A TCP client connected; the data is its "host:port", the source its client id
+
+# A segment is a run of batches, one per commit. The checksum covers a whole batch, since a
+# crash can only tear the last write; each record in it is RECORD_HEADER, the source and the data
+BATCH_HEADER = struct.Struct('!III')     # body length, CRC-32 of the body, record count
+RECORD_HEADER = struct.Struct('!qBHI')   # receive time in ns since the epoch, kind, source length, data length
+
+SEGMENT_SUFFIX = '.journal'
+
+def segment_name(base_offset):
+    # Zero-padded, so the names sort in offset order
+    return f"{base_offset:020d}{SEGMENT_SUFFIX}"
+
+def list_segments(directory):
+    """(base offset, path) of every segment in directory, oldest first"""
+    segments = []
+    for name in os.listdir(directory):
+        if name.endswith(SEGMENT_SUFFIX) and name[:-len(SEGMENT_SUFFIX)].isdigit():
+            segments.append((int(name[:-len(SEGMENT_SUFFIX)]), os.path.join(directory, name)))
+    segments.sort()
+    return segments
+
+def source_bytes(source):
+    """A client id or (host, port) address as the bytes stored in a record"""
+    if isinstance(source, tuple):
+        return f"{source[0]}:{source[1]}".encode('utf-8')
+    return str(source).encode('utf-8')
+
+def encode_batch(records):
+    """One batch of (timestamp_ns, kind, source, data) records, ready to append to a segment"""
+    parts = []
+    sources = {}  # A batch mostly comes from a handful of clients
+    for timestamp_ns, kind, source, data in records:
+        name = sources.get(source)
+        if name is None:
+            name = sources[source] = source_bytes(source)
+        parts.append(RECORD_HEADER.pack(timestamp_ns, kind, len(name), len(data)))
+        parts.append(name)
+        parts.append(data)
+    body = b''.join(parts)
+    return BATCH_HEADER.pack(len(body), zlib.crc32(body), len(records)) + body
+
+def batch_end(buffer, position, check=True):
+    """End of the intact batch at position, or None if it is torn, corrupt or not all there yet"""
+    if len(buffer) - position < BATCH_HEADER.size:
+        return None
+    length, crc, _ = BATCH_HEADER.unpack_from(buffer, position)
+    end = position + BATCH_HEADER.size + length
+    if end > len(buffer):
+        return None
+    if check and zlib.crc32(memoryview(buffer)[position + BATCH_HEADER.size:end]) != crc:
+        return None
+    return end
+
+def valid_end(buffer, position=0):
+    """Where the intact batches starting at position end; a torn tail is left out"""
+    while True:
+        end = batch_end(buffer, position)
+        if end is None:
+            return position
+        position = end
+
+def fsync_directory(directory):
+    """Make a created or deleted segment file itself durable, where the platform allows it"""
+    try:
+        fd = os.open(directory, os.O_RDONLY)
+    except OSError:
+        return  # Windows cannot open a directory
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+class JournalRecord:
+    """One replayed record; offset and end are positions in the journal's byte stream
+
+    Reading from a record's end resumes right after it.
+    """
+    __slots__ = ('offset', 'end', 'timestamp_ns', 'kind', 'source', 'data')
+
+    def __init__(self, offset, end, timestamp_ns, kind, source, data):
+        self.offset = offset
+        self.end = end
+        self.timestamp_ns = timestamp_ns
+        self.kind = kind
+        self.source = source
+        self.data = data
+
+    def __repr__(self):
+        return (f"JournalRecord(offset={self.offset}, kind={self.kind}, source={self.source!r}, "
+                f"data={self.data!r})")
+
+class SyncMarker(threading.Event):
+    """Queued by sync() behind the records it waits for; set once their batch is written or given up"""
+    def __init__(self, lost):
+        super().__init__()
+        # Records given up before sync() was called were already counted; only later losses matter
+        self.lost = lost
+        self.durable = False
+
+class Journal:
+    """Append-only segmented journal with group commit
+
+    append() only queues the record; the writer thread makes it durable within
+    commit_interval plus one fsync, and sync() waits for that when a caller needs it.
+    If max_pending records are queued, append() blocks until the writer catches up:
+    an audit trail that silently drops records would be worse than a slow handler.
+    A caller that must not block (an event loop) passes block=False and is refused instead.
+    A failing write is retried with backoff up to max_retries times, then its batch is
+    given up and counted as lost, so a dead disk cannot hold the writer forever.
+    """
+    def __init__(self, directory, segment_bytes=64 * 1024 * 1024, retention_bytes=None, retention_seconds=None,
+                 commit_interval=0.005, max_batch=10000, max_pending=100000, fsync=True, retry_interval=0.5,
+                 max_retry_interval=5.0, max_retries=20):
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        # Oldest segments are deleted once the journal is larger or older than these; never the open one
+        self.retention_bytes = retention_bytes
+        self.retention_seconds = retention_seconds
+        # Latency budget: how long a record may wait for others to share its fsync,
+        # unless max_batch records are already waiting
+        self.commit_interval = commit_interval
+        self.max_batch = max_batch
+        self.max_pending = max_pending
+        self.fsync = fsync
+        self.retry_interval = retry_interval
+        self.max_retry_interval = max_retry_interval
+        self.max_retries = max_retries
+
+        # Appends take no lock: deque.append is atomic, and the writer only pops from the left
+        self.pending = deque()
+        self.signalled = False  # The writer was woken for what is queued and has not drained it yet
+        self.urgent = False     # Someone waits in sync() or append(), so commit without the budget
+        self.wakeup = threading.Event()
+        self.not_full = threading.Condition()
+        self.stopped = False
+
+        self.committed = 0
+        self.batches = 0
+        self.bytes_written = 0
+        self.blocked = 0
+        self.refused = 0
+        self.errors = 0
+        self.last_error = None
+        self.lost = 0
+        self.largest_batch = 0
+        self.commit_us = 0
+        self.segments_deleted = 0
+
+        os.makedirs(directory, exist_ok=True)
+        self.segments = list_segments(directory)
+        self.fd = None
+        self.recover()
+
+        self.writer = threading.Thread(target=self.writer_loop, name="journal-writer", daemon=True)
+        self.writer.start()
+        atexit.register(self.close)
+
+    def recover(self):
+        """Open the newest segment for appending, cutting off a record torn by a crash"""
+        if not self.segments:
+            self.open_segment(0)
+            return
+        base, path = self.segments[-1]
+        with open(path, 'rb') as f:
+            data = f.read()
+        end = valid_end(data)
+        if end < len(data):
+            os.truncate(path, end)
+        self.fd = os.open(path, os.O_WRONLY | os.O_APPEND)
+        self.segment_base = base
+        self.segment_size = end
+
+    def open_segment(self, base):
+        path = os.path.join(self.directory, segment_name(base))
+        self.fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+        self.segment_base = base
+        self.segment_size = 0
+        self.segments.append((base, path))
+        if self.fsync:
+            fsync_directory(self.directory)
+
+    @property
+    def offset(self):
+        """Where the next record will be written"""
+        return self.segment_base + self.segment_size
+
+    def append(self, source, data, kind=TEXT, block=True):
+        """Queue one record; source is a client id or (host, port)
+
+        Returns False, without queuing it, if max_pending records are waiting and block is False.
+        """
+        pending = self.pending
+        if len(pending) >= self.max_pending:
+            if not block:
+                self.refused += 1
+                return False
+            self.wait_for_room()
+        if type(data) is not bytes:
+            # Handlers pass views into receive buffers that the next read overwrites
+            data = bytes(data)
+        pending.append((time.time_ns(), kind, source, data))
+        # Checked after the append: the writer clears it before draining, so no record is left unseen
+        if not self.signalled:
+            self.signalled = True
+            self.wakeup.set()
+        elif len(pending) == self.max_batch:
+            self.wakeup.set()
+        return True
+
+    def wait_for_room(self):
+        with self.not_full:
+            self.blocked += 1
+            while len(self.pending) >= self.max_pending and not self.stopped:
+                self.urgent = True
+                self.wakeup.set()
+                self.not_full.wait()
+
+    def connected(self, client_id, address, block=True):
+        """Record which address a TCP client id belongs to; its messages only carry the id"""
+        return self.append(client_id, source_bytes(address), CONNECT, block)
+
+    def sync(self, timeout=None):
+        """Wait until everything appended so far is durable
+
+        False on timeout, if the journal closed first, or if any of those records was given up.
+        """
+        if self.stopped:
+            return False
+        # Queued behind the records; the writer sets it once their batch is on disk
+        marker = SyncMarker(self.lost)
+        self.pending.append(marker)
+        self.urgent = True
+        self.wakeup.set()
+        return marker.wait(timeout) and marker.durable
+
+    def writer_loop(self):
+        pending = self.pending
+        while True:
+            if not self.stopped:
+                self.wakeup.wait()
+                self.wakeup.clear()
+                # Group commit: records appended within the latency budget share this write and fsync
+                deadline = time.monotonic() + self.commit_interval
+                while not (self.stopped or self.urgent) and len(pending) < self.max_batch:
+                    delay = deadline - time.monotonic()
+                    if delay <= 0:
+                        break
+                    self.wakeup.wait(delay)
+                    self.wakeup.clear()
+            self.urgent = False
+            self.signalled = False
+            batch = []
+            markers = []
+            for _ in range(len(pending)):
+                item = pending.popleft()
+                if type(item) is tuple:
+                    batch.append(item)
+                else:
+                    markers.append(item)
+            with self.not_full:
+                self.not_full.notify_all()
+            if batch and not self.commit(batch):
+                # The disk kept failing, or the journal stopped meanwhile; those records never became durable
+                self.lost += len(batch)
+            for marker in markers:
+                # Any batch given up since the marker was queued may have held records from before it
+                marker.durable = self.lost == marker.lost
+                marker.set()
+            if self.stopped and not pending:
+                return
+
+    def commit(self, batch):
+        """Write a batch as one write() and one fsync(), retrying while the disk refuses it
+
+        False if it was given up: after max_retries failures, or once the journal is stopped.
+        """
+        started = time.perf_counter_ns()
+        buffer = encode_batch(batch)
+        size = len(buffer)
+        retries = 0
+        while True:
+            try:
+                # Checked on every attempt: a segment that failed to open is tried again with the batch
+                if self.segment_size and self.segment_size + size > self.segment_bytes:
+                    self.roll()
+                self.write(buffer)
+                break
+            except OSError as e:
+                # Disk full or an I/O error: nothing after this batch is acknowledged until it is written or given up
+                self.errors += 1
+                self.last_error = str(e)
+                try:
+                    os.ftruncate(self.fd, self.segment_size)
+                except OSError:
+                    pass
+                if self.stopped or retries >= self.max_retries:
+                    return False
+                time.sleep(min(self.max_retry_interval, self.retry_interval * 2 ** retries))
+                retries += 1
+        self.segment_size += size
+        self.committed += len(batch)
+        self.batches += 1
+        self.bytes_written += size
+        self.largest_batch = max(self.largest_batch, len(batch))
+        self.commit_us = (time.perf_counter_ns() - started) // 1000
+        return True
+
+    def write(self, buffer):
+        view = memoryview(buffer)
+        while view:
+            view = view[os.write(self.fd, view):]
+        if self.fsync:
+            # fdatasync skips the metadata a reader does not need, like the modification time
+            getattr(os, 'fdatasync', os.fsync)(self.fd)
+
+    def roll(self):
+        """Close the full segment and start the next one where it ended
+
+        The next segment is opened before the full one is closed, so if that fails
+        the writer still holds a valid descriptor and commit() can retry the roll.
+        """
+        full = self.fd
+        if self.fsync:
+            os.fsync(full)
+        self.open_segment(self.offset)
+        try:
+            os.close(full)
+        except OSError:
+            pass  # Already synced, and the descriptor is released either way
+        self.enforce_retention()
+
+    def enforce_retention(self):
+        total = sum(os.path.getsize(path) for _, path in self.segments[:-1]) + self.segment_size
+        cutoff = time.time() - self.retention_seconds if self.retention_seconds is not None else None
+        while len(self.segments) > 1:
+            _, path = self.segments[0]
+            too_big = self.retention_bytes is not None and total > self.retention_bytes
+            too_old = cutoff is not None and os.path.getmtime(path) < cutoff
+            if not (too_big or too_old):
+                break
+            total -= os.path.getsize(path)
+            # A reader with the segment mapped keeps its copy until it moves on
+            os.unlink(path)
+            self.segments.pop(0)
+            self.segments_deleted += 1
+
+    def reader(self):
+        return JournalReader(self.directory)
+
+    def close(self):
+        """Commit everything queued and close the open segment"""
+        if self.stopped:
+            return
+        self.stopped = True
+        with self.not_full:
+            self.not_full.notify_all()
+        self.wakeup.set()
+        self.writer.join(timeout=5.0)
+        if self.fd is not None and not self.writer.is_alive():
+            os.close(self.fd)
+            self.fd = None
+
+    def stats(self):
+        return {
+            'committed': self.committed,
+            'pending': len(self.pending),
+            'batches': self.batches,
+            'largest_batch': self.largest_batch,
+            'last_commit_us': self.commit_us,
+            'bytes_written': self.bytes_written,
+            'offset': self.offset,
+            'segments': len(self.segments),
+            'segments_deleted': self.segments_deleted,
+            'blocked': self.blocked,
+            'refused': self.refused,
+            'errors': self.errors,
+            'last_error': self.last_error,
+            'lost': self.lost,
+        }
+
+class JournalReader:
+    """Replays or follows a journal directory through read-only memory maps
+
+    Works from another process too: it only trusts batches whose CRC checks out, so it
+    stops at one the writer has not finished yet and picks it up on the next poll.
+    """
+    def __init__(self, directory):
+        self.directory = directory
+
+    def read_segment(self, base, path, offset, position=0):
+        """Yield the intact records of one segment from offset on; returns where its intact batches end
+
+        position is a batch boundary at or before offset to start from, such as a value this returned.
+        """
+        try:
+            fd = os.open(path, os.O_RDONLY)
+        except FileNotFoundError:
+            return position  # Deleted by retention
+        try:
+            size = os.fstat(fd).st_size
+            if size <= position:
+                return position
+            mapped = mmap.mmap(fd, size, access=mmap.ACCESS_READ)
+        finally:
+            os.close(fd)
+        view = memoryview(mapped)
+        try:
+            while True:
+                # Batches wholly before offset are only hopped over, not checked
+                end = batch_end(view, position, check=False)
+                if end is not None and end > offset:
+                    end = batch_end(view, position)
+                if end is None:
+                    break
+                cursor = position + BATCH_HEADER.size
+                while cursor < end:
+                    timestamp_ns, kind, source_length, data_length = RECORD_HEADER.unpack_from(view, cursor)
+                    start = cursor + RECORD_HEADER.size + source_length
+                    record_end = start + data_length
+                    if cursor >= offset:
+                        # Copies, so the map can be closed whatever the caller keeps
+                        yield JournalRecord(base + cursor, base + record_end, timestamp_ns, kind,
+                                            str(view[cursor + RECORD_HEADER.size:start], 'utf-8', 'replace'),
+                                            mapped[start:record_end])
+                    cursor = record_end
+                position = end
+        finally:
+            view.release()
+            mapped.close()
+        return position
+
+    def start(self, segments, offset):
+        """Index of the segment holding offset; offsets already deleted start at the oldest kept"""
+        index = 0
+        for i, (base, _) in enumerate(segments):
+            if base <= offset:
+                index = i
+        return index
+
+    def read(self, offset=0):
+        """Every record from offset (a record's offset or end) up to what is written now"""
+        segments = list_segments(self.directory)
+        for base, path in segments[self.start(segments, offset):]:
+            offset = max(offset, base)
+            yield from self.read_segment(base, path, offset - base)
+
+    def tail(self, offset=0, poll_interval=0.05):
+        """Like read(), but keeps following new records (and new segments) until the caller stops"""
+        position = 0  # Batch boundary in the current segment that the next poll starts from
+        current = None
+        while True:
+            segments = list_segments(self.directory)
+            if not segments:
+                time.sleep(poll_interval)
+                continue
+            index = self.start(segments, offset)
+            base, path = segments[index]
+            if base != current:
+                current = base
+                position = 0
+            offset = max(offset, base)
+            position = yield from self.read_segment(base, path, offset - base, position)
+            offset = max(offset, base + position)
+            if index + 1 < len(segments):
+                # The writer only starts a segment once the last one is complete
+                offset = max(offset, segments[index + 1][0])
+                continue
+            time.sleep(poll_interval)
+
+def benchmark(messages=200000, threads=4, directory=None):
+    """Handler throughput with the journal off and on, and the append-to-durable latency"""
+    import shutil
+    import tempfile
+
+    from response_templates import ReplyTemplate, TimestampCache
+
+    reply = ReplyTemplate("Server received: '%b' (Message #%d) at %b")
+    timestamps = TimestampCache()
+    message = b"Test message 42 from client 7"
+    per_thread = messages // threads
+
+    def handler(journal, client_id):
+        for number in range(per_thread):
+            if journal is not None:
+                journal.append(client_id, memoryview(message))
+            reply.render(message, number, timestamps.encoded())
+
+    def run(journal):
+        workers = [threading.Thread(target=handler, args=(journal, i)) for i in range(threads)]
+        started = time.perf_counter()
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        handled = time.perf_counter() - started
+        if journal is not None:
+            journal.sync()
+        return handled, time.perf_counter() - started
+
+    root = directory or tempfile.mkdtemp(prefix='journal-bench-')
+    try:
+        handled, _ = run(None)
+        print(f"{'journal off':>24}: {messages / handled:10.0f} messages/s")
+        for label, interval, fsync in (('journal, 5 ms budget', 0.005, True),
+                                       ('journal, 1 ms budget', 0.001, True),
+                                       ('journal, no fsync', 0.005, False)):
+            path = os.path.join(root, label.replace(' ', '-').replace(',', ''))
+            journal = Journal(path, commit_interval=interval, fsync=fsync)
+            handled, durable = run(journal)
+            stats = journal.stats()
+            journal.close()
+            print(f"{label:>24}: {messages / handled:10.0f} messages/s handled, "
+                  f"{messages / durable:10.0f}/s durable, {stats['batches']} batches, "
+                  f"largest {stats['largest_batch']}")
+
+        started = time.perf_counter()
+        replayed = sum(1 for _ in JournalReader(path).read())
+        print(f"{'replay':>24}: {replayed / (time.perf_counter() - started):10.0f} records/s")
+
+        # Latency of a lone message that has to wait for its own commit
+        journal = Journal(os.path.join(root, 'latency'))
+        samples = []
+        for _ in range(200):
+            started = time.perf_counter()
+            journal.append(0, message)
+            journal.sync()
+            samples.append((time.perf_counter() - started) * 1000)
+            time.sleep(0.001)
+        journal.close()
+        samples.sort()
+        print(f"{'append to durable':>24}: p50 {samples[len(samples) // 2]:.2f} ms, "
+              f"p99 {samples[int(len(samples) * 0.99)]:.2f} ms")
+    finally:
+        if directory is None:
+            shutil.rmtree(root, ignore_errors=True)
+
+if __name__ == "__main__":
+    benchmark()
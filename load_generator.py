@@ -0,0 +1,402 @@
+
+# LOAD GENERATOR (load_generator.py)
+# Drives the TCP response servers and the UDP server with thousands of
+# simulated asyncio clients. Open-loop mode sends at a fixed arrival rate and
+# measures latency from when each request *should* have been sent, so a
+# stalled server shows up in the percentiles instead of quietly slowing the
+# generator down (coordinated omission).
+#
+# Examples:
+#   python load_generator.py udp --port 12345 --rate 5000 --clients 200 --duration 10
+#   python load_generator.py tcp --port 12345 --concurrency 500 --framed --mix 64:0.9,4096:0.1
+import argparse
+import asyncio
+import itertools
+import json
+import random
+import sys
+import time
+from collections import deque
+
+from framing import FRAMED_ACK, FRAMED_REQUEST, FrameDecoder, encode_frame
+from socket_io import raise_fd_limit
+
+class LatencyHistogram:
+    """HDR-style log-linear histogram: exact below 128, then about 1.5% relative precision"""
+    SUB_BITS = 7
+    SUB_COUNT = 1 << SUB_BITS
+    HALF_COUNT = SUB_COUNT // 2
+
+    def __init__(self):
+        self.counts = {}
+        self.total = 0
+        self.sum = 0
+        self.min = None
+        self.max = 0
+
+    def index_of(self, value):
+        if value < self.SUB_COUNT:
+            return value
+        shift = value.bit_length() - self.SUB_BITS
+        return self.SUB_COUNT + (shift - 1) * self.HALF_COUNT + (value >> shift) - self.HALF_COUNT
+
+    def highest_equivalent(self, index):
+        """Largest value that lands in the same bucket"""
+        if index < self.SUB_COUNT:
+            return index
+        shift, offset = divmod(index - self.SUB_COUNT, self.HALF_COUNT)
+        top = offset + self.HALF_COUNT
+        return ((top + 1) << (shift + 1)) - 1
+
+    def record(self, value):
+        value = max(0, int(value))
+        index = self.index_of(value)
+        self.counts[index] = self.counts.get(index, 0) + 1
+        self.total += 1
+        self.sum += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if value > self.max:
+            self.max = value
+
+    def merge(self, other):
+        for index, count in other.counts.items():
+            self.counts[index] = self.counts.get(index, 0) + count
+        self.total += other.total
+        self.sum += other.sum
+        if other.min is not None and (self.min is None or other.min < self.min):
+            self.min = other.min
+        self.max = max(self.max, other.max)
+
+    def percentile(self, percent):
+        if not self.total:
+            return 0
+        target = max(1, int(self.total * percent / 100.0 + 0.5))
+        seen = 0
+        for index in sorted(self.counts):
+            seen += self.counts[index]
+            if seen >= target:
+                return min(self.highest_equivalent(index), self.max)
+        return self.max
+
+    def summary(self):
+        return {
+            'count': self.total,
+            'min': self.min or 0,
+            'mean': round(self.sum / self.total, 1) if self.total else 0.0,
+            'p50': self.percentile(50),
+            'p90': self.percentile(90),
+            'p99': self.percentile(99),
+            'p99.9': self.percentile(99.9),
+            'max': self.max,
+        }
+
+def parse_mix(text):
+    """'64:0.8,1024:0.2' -> ([64, 1024], [0.8, 0.2])"""
+    sizes, weights = [], []
+    for part in text.split(','):
+        size, _, weight = part.partition(':')
+        sizes.append(int(size))
+        weights.append(float(weight or 1))
+    return sizes, weights
+
+def make_payload(request_id, size):
+    """Tag each request with its id so the reply (which echoes it) can be matched"""
+    tag = f"lg{request_id}:".encode('utf-8')
+    return tag + b'x' * max(0, size - len(tag))
+
+def reply_id(reply):
+    """Pull the request id back out of a reply, or None"""
+    start = reply.find(b"'lg")
+    if start < 0:
+        return None
+    end = reply.find(b':', start)
+    try:
+        return int(reply[start + 3:end])
+    except ValueError:
+        return None
+
+class TcpLoadClient:
+    """One TCP connection; replies are matched to requests in order"""
+    def __init__(self, host, port, framed=False):
+        self.host = host
+        self.port = port
+        self.framed = framed
+        self.reader = None
+        self.writer = None
+        self.waiting = deque()
+        # Plain text replies have no boundaries, so only one request may be in flight
+        self.turn = None if framed else asyncio.Lock()
+        self.reader_task = None
+
+    async def connect(self):
+        self.reader, self.writer = await asyncio.open_connection(self.host, self.port)
+        welcome = await self.reader.read(1024)
+        if not welcome or b'Server full' in welcome:
+            raise ConnectionRefusedError("Server full")
+        if self.framed:
+            self.writer.write(FRAMED_REQUEST.encode('utf-8'))
+            ack = await self.reader.read(1024)
+            if ack.decode('utf-8', 'replace') != FRAMED_ACK:
+                raise ConnectionError("Server does not support framing")
+        self.reader_task = asyncio.create_task(self.read_replies())
+
+    async def read_replies(self):
+        decoder = FrameDecoder() if self.framed else None
+        try:
+            while True:
+                data = await self.reader.read(65536)
+                if not data:
+                    break
+                replies = decoder.feed(data) if decoder else [data]
+                for reply in replies:
+                    if not self.waiting:
+                        continue
+                    future = self.waiting.popleft()
+                    # A request that already timed out still owns its slot in the order
+                    if not future.done():
+                        future.set_result(reply)
+        except (ConnectionError, OSError):
+            pass
+        finally:
+            while self.waiting:
+                future = self.waiting.popleft()
+                if not future.done():
+                    future.set_exception(ConnectionError("Connection closed"))
+
+    async def request(self, payload):
+        if self.turn is None:
+            return await self.send(payload)
+        async with self.turn:
+            return await self.send(payload)
+
+    async def send(self, payload):
+        future = asyncio.get_running_loop().create_future()
+        self.waiting.append(future)
+        self.writer.write(encode_frame(payload) if self.framed else payload)
+        # shield() keeps a timed-out request's future (and its place in line) alive
+        return await asyncio.shield(future)
+
+    async def close(self):
+        if self.reader_task:
+            self.reader_task.cancel()
+        if self.writer:
+            self.writer.close()
+
+class UdpLoadProtocol(asyncio.DatagramProtocol):
+    def __init__(self, client):
+        self.client = client
+
+    def datagram_received(self, data, address):
+        future = self.client.waiting.pop(reply_id(data), None)
+        if future is not None and not future.done():
+            future.set_result(data)
+
+    def error_received(self, exc):
+        self.client.errors += 1
+
+class UdpLoadClient:
+    """One UDP socket; replies are matched by the request id they echo back"""
+    def __init__(self, host, port):
+        self.host = host
+        self.port = port
+        self.transport = None
+        self.waiting = {}
+        self.errors = 0
+
+    async def connect(self):
+        loop = asyncio.get_running_loop()
+        self.transport, _ = await loop.create_datagram_endpoint(
+            lambda: UdpLoadProtocol(self), remote_addr=(self.host, self.port)
+        )
+
+    async def request(self, payload, request_id):
+        future = asyncio.get_running_loop().create_future()
+        self.waiting[request_id] = future
+        self.transport.sendto(payload)
+        try:
+            return await future
+        finally:
+            self.waiting.pop(request_id, None)
+
+    async def close(self):
+        if self.transport:
+            # End the server-side session like the interactive clients do
+            self.transport.sendto(b'quit')
+            self.transport.close()
+
+class LoadGenerator:
+    """Open-loop (fixed rate) or closed-loop (fixed concurrency) load against one server"""
+    def __init__(self, protocol='tcp', host='localhost', port=12345, clients=100, rate=None,
+                 concurrency=None, duration=10.0, sizes=(64,), weights=None, timeout=2.0,
+                 framed=False, max_in_flight=100000):
+        self.protocol = protocol
+        self.host = host
+        self.port = port
+        self.num_clients = clients
+        self.rate = rate
+        self.concurrency = concurrency or clients
+        self.duration = duration
+        self.sizes = list(sizes)
+        self.weights = weights
+        self.timeout = timeout
+        self.framed = framed
+        self.max_in_flight = max_in_flight
+
+        self.histogram = LatencyHistogram()
+        self.request_ids = itertools.count(1)
+        self.clients = []
+        self.in_flight = 0
+        self.sent = 0
+        self.completed = 0
+        self.errors = 0
+        self.timeouts = 0
+        self.connect_errors = 0
+        self.overload_skips = 0
+
+    def make_client(self):
+        if self.protocol == 'udp':
+            return UdpLoadClient(self.host, self.port)
+        return TcpLoadClient(self.host, self.port, self.framed)
+
+    async def connect_all(self):
+        async def connect_one(client):
+            try:
+                await client.connect()
+                return client
+            except (OSError, ConnectionError):
+                self.connect_errors += 1
+                return None
+
+        clients = [self.make_client() for _ in range(self.num_clients)]
+        # Connect in slices so a few thousand SYNs do not overflow the listen backlog
+        for start in range(0, len(clients), 200):
+            connected = await asyncio.gather(*(connect_one(c) for c in clients[start:start + 200]))
+            self.clients.extend(client for client in connected if client is not None)
+        if not self.clients:
+            raise ConnectionError(f"Could not connect any client to {self.host}:{self.port}")
+
+    async def issue(self, client, intended):
+        """Send one request; latency is measured from its intended start time"""
+        request_id = next(self.request_ids)
+        size = random.choices(self.sizes, self.weights)[0] if len(self.sizes) > 1 else self.sizes[0]
+        payload = make_payload(request_id, size)
+        self.sent += 1
+        self.in_flight += 1
+        try:
+            if self.protocol == 'udp':
+                request = client.request(payload, request_id)
+            else:
+                request = client.request(payload)
+            reply = await asyncio.wait_for(request, self.timeout)
+            if reply_id(reply) != request_id:
+                self.errors += 1
+                return
+            self.completed += 1
+            self.histogram.record((time.perf_counter() - intended) * 1_000_000)
+        except asyncio.TimeoutError:
+            self.timeouts += 1
+        except (OSError, ConnectionError):
+            self.errors += 1
+        finally:
+            self.in_flight -= 1
+
+    async def run_open_loop(self, deadline):
+        interval = 1.0 / self.rate
+        tasks = set()
+        clients = itertools.cycle(self.clients)
+        start = time.perf_counter()
+        for sequence in itertools.count():
+            intended = start + sequence * interval
+            if intended >= deadline:
+                break
+            delay = intended - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            if self.in_flight >= self.max_in_flight:
+                # Still counted against the schedule, so the loss is visible
+                self.overload_skips += 1
+                continue
+            task = asyncio.create_task(self.issue(next(clients), intended))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+        if tasks:
+            await asyncio.wait(tasks)
+
+    async def run_closed_loop(self, deadline):
+        async def worker(client):
+            while time.perf_counter() < deadline:
+                await self.issue(client, time.perf_counter())
+
+        workers = [worker(self.clients[i % len(self.clients)]) for i in range(self.concurrency)]
+        await asyncio.gather(*workers)
+
+    async def run(self):
+        await self.connect_all()
+        started = time.perf_counter()
+        deadline = started + self.duration
+        if self.rate:
+            await self.run_open_loop(deadline)
+        else:
+            await self.run_closed_loop(deadline)
+        elapsed = time.perf_counter() - started
+
+        for client in self.clients:
+            await client.close()
+        return self.report(elapsed)
+
+    def report(self, elapsed):
+        return {
+            'protocol': self.protocol,
+            'target': f"{self.host}:{self.port}",
+            'mode': 'open' if self.rate else 'closed',
+            'rate': self.rate,
+            'concurrency': None if self.rate else self.concurrency,
+            'clients': len(self.clients),
+            'framed': self.framed if self.protocol == 'tcp' else None,
+            'sizes': dict(zip(self.sizes, self.weights or [1] * len(self.sizes))),
+            'duration_s': round(elapsed, 3),
+            'sent': self.sent,
+            'completed': self.completed,
+            'throughput_rps': round(self.completed / elapsed, 1) if elapsed else 0.0,
+            'errors': self.errors + sum(getattr(client, 'errors', 0) for client in self.clients),
+            'timeouts': self.timeouts,
+            'connect_errors': self.connect_errors,
+            'overload_skips': self.overload_skips,
+            'latency_us': self.histogram.summary(),
+        }
+
+def run_load(**options):
+    """Run one load test and return its JSON-ready report"""
+    raise_fd_limit()
+    return asyncio.run(LoadGenerator(**options).run())
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Load generator for the TCP and UDP servers")
+    parser.add_argument('protocol', choices=['tcp', 'udp'])
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('--port', type=int, default=12345)
+    parser.add_argument('--clients', type=int, default=100, help="simulated clients (connections/sockets)")
+    parser.add_argument('--rate', type=float, help="open loop: total requests per second")
+    parser.add_argument('--concurrency', type=int, help="closed loop: requests in flight (default: clients)")
+    parser.add_argument('--duration', type=float, default=10.0, help="seconds")
+    parser.add_argument('--size', type=int, default=64, help="message size in bytes")
+    parser.add_argument('--mix', help="size mix, e.g. 64:0.8,1024:0.2 (overrides --size)")
+    parser.add_argument('--timeout', type=float, default=2.0, help="per-request timeout in seconds")
+    parser.add_argument('--framed', action='store_true', help="TCP: length-prefixed framing with pipelining")
+    args = parser.parse_args(argv)
+
+    sizes, weights = parse_mix(args.mix) if args.mix else ([args.size], None)
+    if args.protocol == 'tcp' and not args.framed and max(sizes) > 1024:
+        parser.error("text mode messages must fit in 1024 bytes; use --framed for larger sizes")
+
+    report = run_load(
+        protocol=args.protocol, host=args.host, port=args.port, clients=args.clients,
+        rate=args.rate, concurrency=args.concurrency, duration=args.duration,
+        sizes=sizes, weights=weights, timeout=args.timeout, framed=args.framed,
+    )
+    json.dump(report, sys.stdout, indent=2)
+    print()
+
+if __name__ == "__main__":
+    main()
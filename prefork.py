@@ -0,0 +1,167 @@
+
+# PREFORK WORKER SUPERVISOR (prefork.py)
+# Shared by the TCP and UDP servers. Each worker process binds the same port
+# with SO_REUSEPORT and the kernel spreads connections/datagrams across them,
+# so the servers are no longer limited to the one core the GIL gives them.
+import multiprocessing
+import multiprocessing.connection
+import os
+import signal
+import threading
+import time
+
+# Workers inherit the server objects by forking; SO_REUSEPORT is a Unix feature anyway
+mp = multiprocessing.get_context('fork')
+
+class SharedCounters:
+    """Per-worker counters in shared memory, summed into one global view on read"""
+    def __init__(self, num_workers, names):
+        self.num_workers = num_workers
+        # Every worker only ever writes its own slot, so the arrays need no cross-process lock.
+        # A worker's handler threads do share its slot, and += on it is a read-modify-write,
+        # so they take this lock; each forked worker gets its own copy of it
+        self.slots = {name: mp.Array('q', num_workers, lock=False) for name in names}
+        self.lock = threading.Lock()
+
+    def add(self, worker_id, name, amount=1):
+        with self.lock:
+            self.slots[name][worker_id] += amount
+
+    def set(self, worker_id, name, value):
+        self.slots[name][worker_id] = value
+
+    def totals(self):
+        return {name: sum(values) for name, values in self.slots.items()}
+
+    def per_worker(self):
+        return {name: list(values) for name, values in self.slots.items()}
+
+class GlobalSlots:
+    """A limit such as max_clients enforced across every worker process"""
+    def __init__(self, limit, num_workers):
+        self.limit = limit
+        self.in_use = mp.Value('i', 0)
+        # Updated under in_use's lock so a crashed worker's share can be reclaimed
+        self.per_worker = mp.Array('i', num_workers, lock=False)
+
+    def acquire(self, worker_id):
+        """Take one slot; returns False when every slot is in use"""
+        with self.in_use.get_lock():
+            if self.in_use.value >= self.limit:
+                return False
+            self.in_use.value += 1
+            self.per_worker[worker_id] += 1
+            return True
+
+    def release(self, worker_id):
+        with self.in_use.get_lock():
+            self.in_use.value -= 1
+            self.per_worker[worker_id] -= 1
+
+    def reclaim(self, worker_id):
+        """Give back every slot held by a worker that died without releasing them"""
+        with self.in_use.get_lock():
+            held = self.per_worker[worker_id]
+            self.in_use.value -= held
+            self.per_worker[worker_id] = 0
+        return held
+
+class PreforkSupervisor:
+    """Starts N worker processes and restarts any that exit unexpectedly"""
+    def __init__(self, worker_main, num_workers=None, counters=None, slots=None,
+                 restart_delay=1.0, report_interval=10.0, drain_timeout=30.0):
+        self.worker_main = worker_main
+        self.num_workers = num_workers or os.cpu_count() or 1
+        self.counters = counters
+        self.slots = slots
+        self.restart_delay = restart_delay
+        self.report_interval = report_interval
+        # How long workers get to drain their clients after SIGTERM
+        self.drain_timeout = drain_timeout
+        self.processes = {}
+        self.started_at = {}
+        self.restarts = 0
+        self.running = False
+
+    def run_worker(self, worker_id):
+        # A forked worker starts with the supervisor's SIGTERM handler; the server sets its own
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        self.worker_main(worker_id)
+
+    def start_worker(self, worker_id):
+        process = mp.Process(target=self.run_worker, args=(worker_id,), name=f"worker-{worker_id}")
+        process.daemon = True
+        process.start()
+        self.processes[worker_id] = process
+        self.started_at[worker_id] = time.monotonic()
+        print(f"Supervisor: started worker {worker_id} (pid {process.pid})")
+
+    def restart_crashed(self):
+        for worker_id, process in list(self.processes.items()):
+            if process.is_alive():
+                continue
+
+            process.join()
+            print(f"Supervisor: worker {worker_id} (pid {process.pid}) exited with code {process.exitcode}")
+            if self.slots is not None:
+                reclaimed = self.slots.reclaim(worker_id)
+                if reclaimed:
+                    print(f"Supervisor: reclaimed {reclaimed} client slots from worker {worker_id}")
+
+            # Avoid a tight crash loop when a worker dies right after starting
+            uptime = time.monotonic() - self.started_at[worker_id]
+            if uptime < self.restart_delay:
+                time.sleep(self.restart_delay - uptime)
+            self.restarts += 1
+            self.start_worker(worker_id)
+
+    def stats(self):
+        """Aggregated view over all workers"""
+        snapshot = {
+            'workers': self.num_workers,
+            'alive': sum(1 for process in self.processes.values() if process.is_alive()),
+            'restarts': self.restarts,
+        }
+        if self.counters is not None:
+            snapshot.update(self.counters.totals())
+            snapshot['per_worker'] = self.counters.per_worker()
+        if self.slots is not None:
+            snapshot['active_clients'] = self.slots.in_use.value
+            snapshot['max_clients'] = self.slots.limit
+        return snapshot
+
+    def stop(self, signum=None, frame=None):
+        self.running = False
+
+    def run(self):
+        self.running = True
+        signal.signal(signal.SIGTERM, self.stop)
+        for worker_id in range(self.num_workers):
+            self.start_worker(worker_id)
+
+        next_report = time.monotonic() + self.report_interval
+        try:
+            while self.running:
+                # Wake up as soon as any worker exits
+                sentinels = [process.sentinel for process in self.processes.values()]
+                multiprocessing.connection.wait(sentinels, timeout=1.0)
+                self.restart_crashed()
+
+                if time.monotonic() >= next_report:
+                    stats = self.stats()
+                    stats.pop('per_worker', None)
+                    print(f"Supervisor stats: {stats}")
+                    next_report = time.monotonic() + self.report_interval
+        except KeyboardInterrupt:
+            print("\nSupervisor shutting down workers...")
+        finally:
+            self.running = False
+            # terminate() sends SIGTERM, so each worker drains before it exits
+            for process in self.processes.values():
+                if process.is_alive():
+                    process.terminate()
+            deadline = time.monotonic() + self.drain_timeout + 1.0
+            for process in self.processes.values():
+                process.join(timeout=max(0.0, deadline - time.monotonic()))
+                if process.is_alive():
+                    process.kill()
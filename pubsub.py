@@ -0,0 +1,422 @@
+
+# PUBLISH/SUBSCRIBE FAN-OUT (pubsub.py)
+# Shared by the response servers. Binary-mode clients subscribe to topics and
+# every update published on a topic is pushed to all of them. An update is
+# encoded once and the same bytes object is queued for every subscriber. Each
+# queue is bounded: until it fills every update is delivered, and after that a
+# subscriber that falls behind has its pending updates conflated (only the
+# newest per topic is kept) or is disconnected. One writer
+# thread, or the event loop, drains the queues with non-blocking sends, so no
+# connection's own thread ever waits on another client's socket.
+import socket
+import threading
+import time
+from collections import deque
+
+from binary_protocol import OP_PUBLISH, PUSH, encode_message, pack_topic
+from socket_io import IOV_MAX
+
+CONFLATE = 'conflate'      # A full queue keeps only the newest update per topic, then drops the oldest
+DISCONNECT = 'disconnect'  # A full queue closes the connection
+
+MSG_DONTWAIT = getattr(socket, 'MSG_DONTWAIT', 0)
+
+class Subscriber:
+    """One connection's topics and the pushes queued for it; the queue is guarded by the hub's lock
+
+    Used as a context manager around the connection's own writes, so a reply never lands
+    in the middle of a push the writer only got partly out.
+    """
+    def __init__(self, hub, subscriber_id, channel, close, timer=None):
+        self.hub = hub
+        self.id = subscriber_id
+        # A blocking socket (threaded servers) or an asyncio transport
+        self.channel = channel
+        self.close = close
+        # The connection's idle reaper timer: a client that only listens is still active
+        self.timer = timer
+        self.topics = set()
+        self.queue = deque()  # [topic, data] entries, oldest first
+        self.latest = {}      # topic -> its entry in queue that may still be replaced
+        self.offset = 0       # Bytes of queue[0] already sent
+        self.sending = 0      # Entries at the front handed to the writer and not yet consumed
+        self.send_lock = threading.Lock()
+        self.signalled = False  # Handed to the writer and not drained since
+        self.closed = False
+        self.sent = 0
+        self.conflated = 0
+        self.dropped = 0
+
+    def enqueue(self, topic, data, max_queue, conflate):
+        """Queue one push; returns False if the queue is full and the subscriber should be disconnected"""
+        queue = self.queue
+        if len(queue) >= max_queue:
+            if not conflate:
+                return False
+            # Only a full queue conflates: a pending update on the same topic is replaced in place
+            entry = self.latest.get(topic)
+            if entry is not None:
+                entry[1] = data
+                self.conflated += 1
+                return True
+            # Drop the oldest update that is not already on its way out
+            index = max(self.sending, 1 if self.offset else 0)
+            if index < len(queue):
+                victim = queue[index]
+                del queue[index]
+                if self.latest.get(victim[0]) is victim:
+                    del self.latest[victim[0]]
+                self.dropped += 1
+        entry = [topic, data]
+        queue.append(entry)
+        if conflate:
+            self.latest[topic] = entry
+        return True
+
+    def chunks(self, limit):
+        """Views of up to limit queued pushes, starting where the last send stopped
+
+        Pushes handed out here are no longer conflated, since part of them may be sent.
+        An empty queue clears signalled, so the next push wakes the writer again.
+        """
+        queue = self.queue
+        if not queue:
+            self.signalled = False
+            return []
+        latest = self.latest
+        chunks = []
+        for entry in queue:
+            if latest.get(entry[0]) is entry:
+                del latest[entry[0]]
+            chunks.append(entry[1])
+            if len(chunks) >= limit:
+                break
+        if self.offset:
+            chunks[0] = memoryview(chunks[0])[self.offset:]
+        self.sending = len(chunks)
+        return chunks
+
+    def consumed(self, nbytes):
+        """Drop the pushes the kernel took; keep the unsent tail of a partial one
+
+        Returns True if anything is left, and otherwise clears signalled like chunks() would.
+        """
+        self.sent += nbytes
+        timer = self.timer
+        # Not while the client is mid-message, or pushes would keep it clear of the read timeout
+        if timer is not None and nbytes and not timer.partial:
+            timer.touch()
+        queue = self.queue
+        nbytes += self.offset
+        while queue and nbytes >= len(queue[0][1]):
+            nbytes -= len(queue.popleft()[1])
+        self.offset = nbytes
+        self.sending = 0
+        if queue:
+            return True
+        self.signalled = False
+        return False
+
+    def __enter__(self):
+        self.send_lock.acquire()
+        if self.offset:
+            # The writer stopped halfway through a push; finish it before anything else goes out
+            with self.hub.lock:
+                if not self.queue:
+                    return self
+                rest = memoryview(self.queue[0][1])[self.offset:]
+            self.channel.sendall(rest)
+            with self.hub.lock:
+                self.consumed(len(rest))
+        return self
+
+    def __exit__(self, *exc_info):
+        self.send_lock.release()
+        # The writer skips a subscriber whose connection is writing, so hand back anything it left
+        if self.queue:
+            self.hub.wake([self])
+
+class PubSub:
+    """Topic registry and fan-out: publish() encodes once and queues the same bytes for every subscriber"""
+    def __init__(self, max_queue=1024, slow_consumer=CONFLATE):
+        if slow_consumer not in (CONFLATE, DISCONNECT):
+            raise ValueError(f"Unknown slow consumer policy {slow_consumer!r}")
+        self.max_queue = max(2, max_queue)
+        self.conflate = slow_consumer == CONFLATE
+        self.slow_consumer = slow_consumer
+        self.lock = threading.Lock()
+        self.subscribers = {}  # id -> Subscriber
+        self.topics = {}       # topic -> set of Subscribers
+        self.writer = None
+        self.published = 0
+        self.queued = 0
+        self.disconnected = 0
+
+    def register(self, subscriber_id, channel, close, timer=None):
+        """Add a connection that can receive pushes; close() ends it if it falls too far behind
+
+        timer, the connection's idle reaper timer, is touched whenever a push goes out.
+        """
+        subscriber = Subscriber(self, subscriber_id, channel, close, timer)
+        with self.lock:
+            self.subscribers[subscriber_id] = subscriber
+        return subscriber
+
+    def unregister(self, subscriber):
+        with self.lock:
+            subscriber.closed = True
+            self.subscribers.pop(subscriber.id, None)
+            for topic in subscriber.topics:
+                members = self.topics.get(topic)
+                if members is not None:
+                    members.discard(subscriber)
+                    if not members:
+                        del self.topics[topic]
+            subscriber.queue.clear()
+            subscriber.latest.clear()
+            subscriber.offset = subscriber.sending = 0
+
+    def get(self, subscriber_id):
+        return self.subscribers.get(subscriber_id)
+
+    def subscribe(self, subscriber_id, topic):
+        with self.lock:
+            subscriber = self.subscribers.get(subscriber_id)
+            if subscriber is None:
+                raise ValueError("Not a subscriber")
+            subscriber.topics.add(topic)
+            self.topics.setdefault(topic, set()).add(subscriber)
+
+    def unsubscribe(self, subscriber_id, topic):
+        with self.lock:
+            subscriber = self.subscribers.get(subscriber_id)
+            if subscriber is None:
+                return
+            subscriber.topics.discard(topic)
+            members = self.topics.get(topic)
+            if members is not None:
+                members.discard(subscriber)
+                if not members:
+                    del self.topics[topic]
+
+    def publish(self, topic, payload):
+        """Push payload to every subscriber of topic; returns how many it was queued for"""
+        data = encode_message(OP_PUBLISH, 0, pack_topic(topic, payload), PUSH)
+        with self.lock:
+            self.published += 1
+            count, woken, slow = self.fan_out(self.topics.get(topic, ()), topic, data)
+        self.notify(woken, slow)
+        return count
+
+    def broadcast(self, payload, topic=''):
+        """Push payload to every registered connection, subscribed or not"""
+        data = encode_message(OP_PUBLISH, 0, pack_topic(topic, payload), PUSH)
+        with self.lock:
+            self.published += 1
+            count, woken, slow = self.fan_out(self.subscribers.values(), topic, data)
+        self.notify(woken, slow)
+        return count
+
+    def fan_out(self, subscribers, topic, data):
+        """Queue data for subscribers, holding self.lock; returns (count, subscribers to wake, slow ones)"""
+        woken = []
+        slow = []
+        max_queue = self.max_queue
+        conflate = self.conflate
+        count = 0
+        for subscriber in subscribers:
+            if subscriber.closed:
+                continue
+            if not subscriber.enqueue(topic, data, max_queue, conflate):
+                subscriber.closed = True
+                slow.append(subscriber)
+                continue
+            count += 1
+            if not subscriber.signalled:
+                subscriber.signalled = True
+                woken.append(subscriber)
+        self.queued += count
+        self.disconnected += len(slow)
+        return count, woken, slow
+
+    def notify(self, woken, slow):
+        # Outside the lock: closing and waking may each take a while
+        for subscriber in slow:
+            subscriber.close()
+        if woken:
+            self.wake(woken)
+
+    def wake(self, subscribers):
+        if self.writer is not None:
+            self.writer.notify(subscribers)
+
+    def stats(self):
+        with self.lock:
+            subscribers = list(self.subscribers.values())
+            topics = len(self.topics)
+        return {
+            'subscribers': len(subscribers),
+            'topics': topics,
+            'published': self.published,
+            'queued': self.queued,
+            'backlog': sum(len(subscriber.queue) for subscriber in subscribers),
+            'conflated': sum(subscriber.conflated for subscriber in subscribers),
+            'dropped': sum(subscriber.dropped for subscriber in subscribers),
+            'disconnected': self.disconnected,
+            'max_queue': self.max_queue,
+            'slow_consumer': self.slow_consumer,
+        }
+
+class FanoutWriter:
+    """Writes the subscriber queues of a threaded server from one thread, never blocking on a socket
+
+    A subscriber whose socket buffer is full (or whose own thread is writing) is retried
+    every retry_interval until its queue is empty.
+    """
+    def __init__(self, hub, retry_interval=0.002):
+        self.hub = hub
+        self.retry_interval = retry_interval
+        self.ready = deque()
+        self.retry = []
+        self.wakeup = threading.Event()
+        self.stopped = False
+        self.thread = None
+        self.syscalls = 0
+        hub.writer = self
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, name="pubsub-writer", daemon=True)
+        self.thread.start()
+        return self
+
+    def notify(self, subscribers):
+        self.ready.extend(subscribers)
+        self.wakeup.set()
+
+    def run(self):
+        while not self.stopped:
+            self.wakeup.wait(self.retry_interval if self.retry else None)
+            self.wakeup.clear()
+            ready = self.ready
+            if self.retry:
+                ready.extend(self.retry)
+                self.retry = []
+            while ready:
+                self.pump(ready.popleft())
+
+    def pump(self, subscriber):
+        if subscriber.closed:
+            return
+        if not subscriber.send_lock.acquire(blocking=False):
+            self.retry.append(subscriber)
+            return
+        try:
+            sock = subscriber.channel
+            lock = self.hub.lock
+            while True:
+                with lock:
+                    if subscriber.closed:
+                        return
+                    chunks = subscriber.chunks(IOV_MAX)
+                if not chunks:
+                    return
+                try:
+                    sent = sock.sendmsg(chunks, (), MSG_DONTWAIT)
+                except (BlockingIOError, InterruptedError):
+                    self.retry.append(subscriber)
+                    return
+                except OSError:
+                    return  # The connection is going away; its handler unregisters it
+                self.syscalls += 1
+                with lock:
+                    if not subscriber.consumed(sent):
+                        return  # Saves a trip through the lock for the usual single push
+        finally:
+            subscriber.send_lock.release()
+
+    def stop(self):
+        self.stopped = True
+        self.wakeup.set()
+
+class AsyncFanoutWriter:
+    """Writes the subscriber queues of an asyncio server on its event loop
+
+    Pushes go to a transport only while its write buffer is below high_water; the rest
+    wait in the subscriber's queue, where they can still be conflated.
+    """
+    def __init__(self, hub, loop, high_water=64 * 1024, retry_interval=0.002):
+        self.hub = hub
+        self.loop = loop
+        self.high_water = high_water
+        self.retry_interval = retry_interval
+        hub.writer = self
+
+    def notify(self, subscribers):
+        # Publishing may happen on any thread
+        self.loop.call_soon_threadsafe(self.pump_all, subscribers)
+
+    def pump_all(self, subscribers):
+        for subscriber in subscribers:
+            self.pump(subscriber)
+
+    def pump(self, subscriber):
+        transport = subscriber.channel
+        lock = self.hub.lock
+        while not subscriber.closed and not transport.is_closing():
+            if transport.get_write_buffer_size() >= self.high_water:
+                self.loop.call_later(self.retry_interval, self.pump, subscriber)
+                return
+            with lock:
+                chunks = subscriber.chunks(IOV_MAX)
+                if chunks:
+                    # The transport takes everything it is given
+                    subscriber.consumed(sum(len(chunk) for chunk in chunks))
+            if not chunks:
+                return
+            transport.writelines(chunks)
+
+def fanout_latency(publish, receivers, messages=100, interval=0.01, topic='bench'):
+    """Publish timestamped updates and report how long each took to reach every receiver
+
+    publish(topic, payload) sends one update; receivers is a list of BinaryClient already
+    subscribed to topic. Returns the latency percentiles in milliseconds.
+    """
+    import selectors
+    import struct
+
+    stamp = struct.Struct('!Q')
+    selector = selectors.DefaultSelector()
+    for client in receivers:
+        client.sock.setblocking(False)
+        selector.register(client.sock, selectors.EVENT_READ, client)
+    latencies = []
+    expected = messages * len(receivers)
+    deadline = time.monotonic() + messages * interval + 10.0
+    next_publish = time.monotonic()
+    published = 0
+    while len(latencies) < expected and time.monotonic() < deadline:
+        if published < messages and time.monotonic() >= next_publish:
+            publish(topic, stamp.pack(time.monotonic_ns()))
+            published += 1
+            next_publish += interval
+        for key, _ in selector.select(max(0.0, next_publish - time.monotonic()) if published < messages else 0.1):
+            client = key.data
+            try:
+                client.read()
+            except BlockingIOError:
+                continue
+            now = time.monotonic_ns()
+            for _, _, _, payload in client.pushes:
+                latencies.append((now - stamp.unpack_from(payload, len(payload) - stamp.size)[0]) / 1e6)
+            client.pushes.clear()
+    selector.close()
+    latencies.sort()
+    if not latencies:
+        return {'delivered': 0, 'expected': expected}
+    return {
+        'delivered': len(latencies),
+        'expected': expected,
+        'p50_ms': round(latencies[len(latencies) // 2], 3),
+        'p99_ms': round(latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))], 3),
+        'max_ms': round(latencies[-1], 3),
+    }
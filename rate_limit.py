@@ -0,0 +1,209 @@
+
+# RATE LIMITING AND FAIR QUEUEING (rate_limit.py)
+# Shared by the TCP and UDP servers. Every client address, and optionally its
+# whole subnet, gets a token bucket that refills at a fixed rate up to a burst
+# size. Buckets are created on demand and dropped once they have refilled, so
+# the table only holds clients that are actually sending. FairQueue serves the
+# queued work of many clients in deficit round-robin order, so one flooding
+# client cannot push everyone else to the back of a shared FIFO.
+import queue
+import socket
+import threading
+import time
+from collections import OrderedDict, deque
+
+def subnet_key(host, ipv4_prefix=24, ipv6_prefix=64):
+    """The network a host address belongs to, as a small hashable key"""
+    try:
+        packed = socket.inet_pton(socket.AF_INET, host)
+        bits = 32 - ipv4_prefix
+    except OSError:
+        try:
+            packed = socket.inet_pton(socket.AF_INET6, host.split('%', 1)[0])
+        except OSError:
+            return host  # Not an IP address; the host is its own subnet
+        bits = 128 - ipv6_prefix
+    return len(packed), int.from_bytes(packed, 'big') >> bits
+
+class TokenBucket:
+    __slots__ = ('tokens', 'updated')
+
+    def __init__(self, tokens, updated):
+        self.tokens = tokens
+        self.updated = updated
+
+class BucketTable:
+    """Token buckets by key, created full on first use and dropped once they are full again"""
+    def __init__(self, rate, burst, max_entries=100000):
+        self.rate = rate
+        self.burst = burst
+        self.max_entries = max_entries
+        # Least recently used first, which is also the order the buckets fill back up in
+        self.buckets = OrderedDict()
+        self.throttled = 0
+        self.expirations = 0
+        self.evictions = 0
+
+    def refill(self, key, now):
+        """The key's bucket with the tokens earned since it was last used"""
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            self.expire(now)
+            if len(self.buckets) >= self.max_entries:
+                # Forgetting a bucket hands that client a fresh burst, so only under memory pressure
+                self.buckets.popitem(last=False)
+                self.evictions += 1
+            bucket = self.buckets[key] = TokenBucket(self.burst, now)
+            return bucket
+        self.buckets.move_to_end(key)
+        bucket.tokens = min(self.burst, bucket.tokens + (now - bucket.updated) * self.rate)
+        bucket.updated = now
+        return bucket
+
+    def expire(self, now):
+        """Drop buckets that have refilled completely; a new one would be identical"""
+        buckets = self.buckets
+        while buckets:
+            bucket = next(iter(buckets.values()))
+            if bucket.tokens + (now - bucket.updated) * self.rate < self.burst:
+                break
+            buckets.popitem(last=False)
+            self.expirations += 1
+
+    def stats(self):
+        return {
+            'entries': len(self.buckets),
+            'rate': self.rate,
+            'burst': self.burst,
+            'throttled': self.throttled,
+            'expirations': self.expirations,
+            'evictions': self.evictions,
+        }
+
+class RateLimiter:
+    """Per-client token buckets, plus optional per-subnet buckets that catch floods from many addresses
+
+    Rates are in messages (or datagrams) per second; burst is how many may arrive at once.
+    """
+    def __init__(self, rate=100.0, burst=200.0, subnet_rate=None, subnet_burst=None,
+                 ipv4_prefix=24, ipv6_prefix=64, max_entries=100000, clock=time.monotonic):
+        self.clients = BucketTable(rate, burst, max_entries)
+        self.subnets = None
+        if subnet_rate is not None:
+            self.subnets = BucketTable(subnet_rate, subnet_burst or subnet_rate * 2, max_entries)
+        self.ipv4_prefix = ipv4_prefix
+        self.ipv6_prefix = ipv6_prefix
+        self.clock = clock
+        # Receive threads share the tables
+        self.lock = threading.Lock()
+
+    def allow(self, host, cost=1.0):
+        """Take cost tokens from the client's and its subnet's bucket; False, taking none, if either is short"""
+        now = self.clock()
+        with self.lock:
+            client = self.clients.refill(host, now)
+            if client.tokens < cost:
+                self.clients.throttled += 1
+                return False
+            if self.subnets is not None:
+                subnet = self.subnets.refill(subnet_key(host, self.ipv4_prefix, self.ipv6_prefix), now)
+                if subnet.tokens < cost:
+                    self.subnets.throttled += 1
+                    return False
+                subnet.tokens -= cost
+            client.tokens -= cost
+            return True
+
+    def reserve(self, host, cost=1.0):
+        """Take cost tokens even into debt; returns how many seconds to wait until the debt is paid off
+
+        For TCP, where delaying the next read pushes back on the client instead of losing data.
+        """
+        now = self.clock()
+        with self.lock:
+            client = self.clients.refill(host, now)
+            client.tokens -= cost
+            delay = max(0.0, -client.tokens / self.clients.rate)
+            if delay:
+                self.clients.throttled += 1
+            if self.subnets is not None:
+                subnet = self.subnets.refill(subnet_key(host, self.ipv4_prefix, self.ipv6_prefix), now)
+                subnet.tokens -= cost
+                subnet_delay = max(0.0, -subnet.tokens / self.subnets.rate)
+                if subnet_delay > delay:
+                    self.subnets.throttled += 1
+                    delay = subnet_delay
+            return delay
+
+    def stats(self):
+        snapshot = {'clients': self.clients.stats()}
+        if self.subnets is not None:
+            snapshot['subnets'] = self.subnets.stats()
+        return snapshot
+
+class FairQueue:
+    """Bounded work queue with one FIFO per client, served in deficit round-robin order
+
+    Each turn a client may take up to quantum cost units (bytes, say) before the next
+    client's turn; with cost=1 and quantum=1 this is plain round-robin. put_nowait and
+    get mirror queue.Queue, and a full queue raises queue.Full.
+    """
+    def __init__(self, maxsize=4096, per_client=None, quantum=1500):
+        self.maxsize = maxsize
+        # No single client may hold more than this share of the queue
+        self.per_client = per_client or max(1, maxsize // 4)
+        self.quantum = quantum
+        self.queues = {}
+        self.deficits = {}
+        self.active = deque()  # Clients with queued work, in service order
+        self.size = 0
+        self.condition = threading.Condition()
+
+    def put_nowait(self, key, item, cost=1):
+        with self.condition:
+            if self.size >= self.maxsize:
+                raise queue.Full
+            pending = self.queues.get(key)
+            if pending is None:
+                pending = self.queues[key] = deque()
+                # A client's quantum is credited when its turn starts, which is now if nobody else is queued
+                self.deficits[key] = 0 if self.active else self.quantum
+                self.active.append(key)
+            elif len(pending) >= self.per_client:
+                raise queue.Full
+            pending.append((cost, item))
+            self.size += 1
+            self.condition.notify()
+
+    def get(self):
+        with self.condition:
+            while not self.size:
+                self.condition.wait()
+            active = self.active
+            deficits = self.deficits
+            while True:
+                key = active[0]
+                pending = self.queues[key]
+                cost = pending[0][0]
+                if deficits[key] >= cost:
+                    break
+                # Out of credit this round: the next client's turn starts with a fresh quantum
+                active.rotate(-1)
+                deficits[active[0]] += self.quantum
+            _, item = pending.popleft()
+            deficits[key] -= cost
+            self.size -= 1
+            if not pending:
+                # A client with nothing queued keeps no credit for later
+                del self.queues[key]
+                del deficits[key]
+                active.popleft()
+                if active:
+                    deficits[active[0]] += self.quantum
+            return item
+
+    def qsize(self):
+        return self.size
+
+    def clients(self):
+        return len(self.queues)
@@ -0,0 +1,197 @@
+
+# RECEIVE BUFFER (receive_buffer.py)
+# Shared by the TCP servers. Each connection reads with recv_into() into one
+# bytearray it keeps for its whole life, finds message boundaries on a
+# memoryview of it, and only decodes once a message is complete. A UTF-8
+# character or frame header split across two reads simply stays unread until
+# the rest of it arrives.
+from codecs import utf_8_decode
+
+from binary_protocol import BINARY_HEADER, BINARY_MAGIC
+from framing import FRAME_HEADER, MAX_FRAME_SIZE, FrameError
+
+class ReceiveBuffer:
+    """Per-connection ring of unread bytes between start and end, parsed in place"""
+    def __init__(self, capacity=65536, max_frame_size=MAX_FRAME_SIZE):
+        self.buffer = bytearray(capacity)
+        self.view = memoryview(self.buffer)
+        self.start = 0
+        self.end = 0
+        self.max_frame_size = max_frame_size
+        # Bytes still missing from a partly received frame, so the next read makes room for it
+        self.wanted = 0
+        self.compactions = 0
+        self.grows = 0
+
+    def __len__(self):
+        return self.end - self.start
+
+    def make_room(self, needed):
+        """Make sure needed bytes fit after end, wrapping unread bytes back to the front"""
+        unread = self.end - self.start
+        if not unread:
+            self.start = self.end = 0
+        free = len(self.buffer) - self.end
+        # Keep reads large: wrap once less than a quarter of the buffer is left
+        if free >= needed and (free >= len(self.buffer) // 4 or not self.start):
+            return
+
+        size = len(self.buffer)
+        while size < unread + needed:
+            size *= 2
+        if size == len(self.buffer):
+            self.compactions += 1
+            target = self.buffer
+        else:
+            # A new buffer, so payload views handed out earlier stay intact
+            self.grows += 1
+            target = bytearray(size)
+        if unread:
+            target[:unread] = bytes(self.view[self.start:self.end])
+        if target is not self.buffer:
+            self.buffer = target
+            self.view = memoryview(target)
+        self.start = 0
+        self.end = unread
+
+    def recv_into(self, sock, max_read=None, flags=0):
+        """One recv_into() call appending to the unread bytes; returns the byte count (0 at EOF)"""
+        end = self.end
+        if self.start == end:
+            self.start = self.end = end = 0
+        needed = max_read if max_read and max_read > self.wanted else self.wanted or 1
+        capacity = len(self.buffer)
+        if end + needed > capacity or self.start > capacity >> 1:
+            self.make_room(needed)
+            end = self.end
+            capacity = len(self.buffer)
+        # Reading at offset 0 (the usual case once everything was consumed) needs no slice
+        nbytes = sock.recv_into(self.view[end:] if end else self.view, max_read or capacity - end, flags)
+        self.end = end + nbytes
+        return nbytes
+
+    def write(self, data):
+        """Append bytes that were read elsewhere (e.g. by an asyncio StreamReader)"""
+        size = len(data)
+        self.make_room(max(size, self.wanted))
+        self.view[self.end:self.end + size] = data
+        self.end += size
+
+    def read_text(self):
+        """Decode and consume the unread bytes; returns (text, raw)
+
+        A character cut off at the end stays unread, so text is '' while only part of one
+        has arrived. raw is a view of exactly the bytes behind text, valid until the next read.
+        """
+        start = self.start
+        data = self.view[start:self.end]
+        # final=False decodes up to the last complete character instead of failing on it
+        text, consumed = utf_8_decode(data, 'strict', False)
+        self.start = start + consumed
+        if consumed < len(data):
+            data = data[:consumed]
+        return text, data
+
+    def frames(self):
+        """Every complete length-prefixed payload, as views valid until the next read"""
+        payloads = []
+        buffer = self.buffer
+        view = self.view
+        start, end = self.start, self.end
+        header_size = FRAME_HEADER.size
+        while end - start >= header_size:
+            (length,) = FRAME_HEADER.unpack_from(buffer, start)
+            if length > self.max_frame_size:
+                raise FrameError(f"Frame of {length} bytes exceeds limit of {self.max_frame_size}")
+            frame_end = start + header_size + length
+            if frame_end > end:
+                break
+            payloads.append(view[start + header_size:frame_end])
+            start = frame_end
+        self.start = start
+        # Room is made on the next read, once the views returned here are no longer used
+        self.wanted = frame_end - end if end - start >= header_size else 0
+        return payloads
+
+    def messages(self):
+        """Every complete binary message as (opcode, flags, request_id, payload view), valid until the next read"""
+        messages = []
+        buffer = self.buffer
+        view = self.view
+        start, end = self.start, self.end
+        header_size = BINARY_HEADER.size
+        unpack_from = BINARY_HEADER.unpack_from
+        while end - start >= header_size:
+            magic, opcode, flags, request_id, length = unpack_from(buffer, start)
+            if magic != BINARY_MAGIC:
+                raise FrameError("Lost binary message boundary")
+            if length > self.max_frame_size:
+                raise FrameError(f"Message of {length} bytes exceeds limit of {self.max_frame_size}")
+            message_end = start + header_size + length
+            if message_end > end:
+                break
+            messages.append((opcode, flags, request_id, view[start + header_size:message_end]))
+            start = message_end
+        self.start = start
+        self.wanted = message_end - end if end - start >= header_size else 0
+        return messages
+
+def benchmark(messages=20000):
+    """recv() + decode / FrameDecoder vs ReceiveBuffer, and text vs binary, over a local socket pair"""
+    import socket
+    import timeit
+    import tracemalloc
+
+    from binary_protocol import OP_ECHO, encode_message
+    from framing import FrameDecoder, encode_frame
+
+    sender, receiver = socket.socketpair()
+    message = b"Test message 42 from client 7"
+    batch = b''.join(encode_frame(message) for _ in range(100))
+    inbox = ReceiveBuffer()
+
+    def text_recv():
+        sender.send(message)
+        return receiver.recv(1024).decode('utf-8')
+
+    def text_ring():
+        sender.send(message)
+        inbox.recv_into(receiver, 1024)
+        return inbox.read_text()
+
+    decoder = FrameDecoder()
+
+    def framed_recv():
+        sender.sendall(batch)
+        return [payload.decode('utf-8') for payload in decoder.feed(receiver.recv(65536))]
+
+    def framed_ring():
+        sender.sendall(batch)
+        inbox.recv_into(receiver)
+        return [str(payload, 'utf-8') for payload in inbox.frames()]
+
+    binary_batch = b''.join(encode_message(OP_ECHO, i, message) for i in range(100))
+
+    def binary_ring():
+        sender.sendall(binary_batch)
+        inbox.recv_into(receiver)
+        return inbox.messages()
+
+    cases = (('text recv+decode', text_recv, 1), ('text ring', text_ring, 1),
+             ('framed recv+feed', framed_recv, 100), ('framed ring', framed_ring, 100),
+             ('binary ring', binary_ring, 100))
+    for name, read, per_call in cases:
+        calls = messages // per_call
+        seconds = min(timeit.repeat(read, number=calls, repeat=5))
+        tracemalloc.start()
+        for _ in range(calls // 10):
+            read()
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        print(f"{name:>17}: {seconds / messages * 1e9:7.1f} ns/message, peak traced memory {peak} bytes")
+
+    sender.close()
+    receiver.close()
+
+if __name__ == "__main__":
+    benchmark()
@@ -0,0 +1,298 @@
+
+# RELIABLE UDP (reliable_udp.py)
+# Opt-in reliability for the UDP server and clients. Every request carries a
+# per-session sequence number and the server's reply doubles as its ACK.
+# The client keeps a window of requests in flight and retransmits the ones
+# whose ACK is overdue, with a timeout derived from measured round-trip
+# times (RFC 6298), so one lost datagram costs a few RTTs, not seconds.
+import socket
+import struct
+import threading
+import time
+from concurrent.futures import Future, InvalidStateError
+
+# 0xFE never occurs in UTF-8, so a reliable datagram cannot be mistaken for a plain text message
+RELIABLE_MAGIC = 0xFE
+DATA = 1
+ACK = 2
+DUPLICATE_ACK = 3  # The request was already processed and its replies are no longer cached
+NACK = 4           # The sequence number is outside the server's receive window; the request was not processed
+
+# What ReceiveWindow.accept() makes of a sequence number
+ACCEPTED = 'accepted'
+DUPLICATE = 'duplicate'
+OUT_OF_WINDOW = 'out of window'
+
+RELIABLE_HEADER = struct.Struct('!BBI')  # magic, kind, sequence number
+ITEM_HEADER = struct.Struct('!H')        # length of each reply carried by an ACK
+
+def is_reliable(data):
+    return len(data) >= RELIABLE_HEADER.size and data[0] == RELIABLE_MAGIC
+
+def encode_data(sequence, payload):
+    return RELIABLE_HEADER.pack(RELIABLE_MAGIC, DATA, sequence) + payload
+
+def encode_ack(sequence, replies, kind=ACK):
+    """An ACK carrying every reply to the request, each prefixed with its length"""
+    parts = [RELIABLE_HEADER.pack(RELIABLE_MAGIC, kind, sequence)]
+    for reply in replies:
+        parts.append(ITEM_HEADER.pack(len(reply)))
+        parts.append(reply)
+    return b''.join(parts)
+
+def decode_header(data):
+    """Returns (kind, sequence, body) for a reliable datagram"""
+    _, kind, sequence = RELIABLE_HEADER.unpack_from(data)
+    return kind, sequence, memoryview(data)[RELIABLE_HEADER.size:]
+
+def decode_items(body):
+    """Split a length-prefixed list of replies back into bytes"""
+    items = []
+    offset = 0
+    while offset + ITEM_HEADER.size <= len(body):
+        (length,) = ITEM_HEADER.unpack_from(body, offset)
+        offset += ITEM_HEADER.size
+        items.append(bytes(body[offset:offset + length]))
+        offset += length
+    return items
+
+class ReceiveWindow:
+    """Sequence numbers already processed for one client: all up to floor, plus a sparse set above it
+
+    A new window (a client's first request, or one whose session expired or was evicted)
+    starts just below the first sequence number it sees, since the client may be far along.
+    """
+    __slots__ = ('floor', 'above')
+
+    # Requests further ahead than this are refused; the client's window is far smaller
+    MAX_AHEAD = 4096
+
+    def __init__(self):
+        self.floor = None
+        self.above = set()
+
+    def accept(self, sequence):
+        """Record a sequence number: ACCEPTED if it is new, DUPLICATE if seen before, else OUT_OF_WINDOW"""
+        if self.floor is None:
+            self.floor = sequence - 1
+        if sequence <= self.floor or sequence in self.above:
+            return DUPLICATE
+        if sequence > self.floor + self.MAX_AHEAD:
+            return OUT_OF_WINDOW
+        above = self.above
+        above.add(sequence)
+        # Slide the floor over every number that is now contiguous
+        while self.floor + 1 in above:
+            self.floor += 1
+            above.remove(self.floor)
+        return ACCEPTED
+
+class RttEstimator:
+    """Retransmission timeout from smoothed RTT and RTT variance, as in RFC 6298"""
+    ALPHA = 1 / 8
+    BETA = 1 / 4
+    K = 4
+
+    def __init__(self, initial_rto=1.0, min_rto=0.05, max_rto=60.0, granularity=0.001):
+        self.srtt = None
+        self.rttvar = None
+        self.rto = initial_rto
+        self.min_rto = min_rto
+        self.max_rto = max_rto
+        self.granularity = granularity
+        self.samples = 0
+
+    def sample(self, rtt):
+        """Feed one RTT measurement (never from a retransmitted request: Karn's algorithm)"""
+        if self.srtt is None:
+            self.srtt = rtt
+            self.rttvar = rtt / 2
+        else:
+            self.rttvar = (1 - self.BETA) * self.rttvar + self.BETA * abs(self.srtt - rtt)
+            self.srtt = (1 - self.ALPHA) * self.srtt + self.ALPHA * rtt
+        self.samples += 1
+        self.rto = min(self.max_rto, max(self.min_rto, self.srtt + max(self.granularity, self.K * self.rttvar)))
+
+    def timeout_for(self, retries):
+        """The timeout doubles with every retransmission of the same request"""
+        return min(self.max_rto, self.rto * 2 ** retries)
+
+class PendingRequest:
+    __slots__ = ('datagram', 'first_sent', 'deadline', 'retries', 'future')
+
+    def __init__(self, datagram, now, rto, future):
+        self.datagram = datagram
+        self.first_sent = now
+        self.deadline = now + rto
+        self.retries = 0
+        self.future = future
+
+class ReliableUDPClient:
+    """Sliding window of sequenced requests, retransmitted until the server ACKs them"""
+    def __init__(self, host='localhost', port=12345, window=32, max_retries=8,
+                 initial_rto=1.0, min_rto=0.05, max_rto=60.0):
+        self.server_address = (host, port)
+        self.max_retries = max_retries
+        self.rtt = RttEstimator(initial_rto, min_rto, max_rto)
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        # A connected UDP socket only receives datagrams from the server
+        self.sock.connect(self.server_address)
+        self.window = threading.Semaphore(window)
+        self.pending = {}
+        self.lock = threading.Lock()
+        self.next_sequence = 1
+        self.closed = False
+        self.sent = 0
+        self.retransmissions = 0
+        self.duplicate_acks = 0
+        self.failures = 0
+        self.rejected = 0
+        self.receiver = threading.Thread(target=self.receive_loop, name="reliable-udp-client", daemon=True)
+        self.receiver.start()
+
+    def request(self, message):
+        """Send one message; returns a Future for the list of reply strings
+
+        Blocks while the window is full.
+        """
+        payload = message.encode('utf-8') if isinstance(message, str) else message
+        self.window.acquire()
+        future = Future()
+        future.add_done_callback(lambda _: self.window.release())
+        with self.lock:
+            if self.closed:
+                future.set_exception(ConnectionError("Client is closed"))
+                return future
+            sequence = self.next_sequence
+            self.next_sequence += 1
+            datagram = encode_data(sequence, payload)
+            self.pending[sequence] = PendingRequest(datagram, time.monotonic(), self.rtt.rto, future)
+            self.sent += 1
+        try:
+            self.sock.send(datagram)
+        except OSError:
+            pass  # Lost like any other datagram; the retransmission timer covers it
+        return future
+
+    def call(self, message, timeout=None):
+        """Send one message and wait for its replies"""
+        return self.request(message).result(timeout)
+
+    def next_timeout(self):
+        with self.lock:
+            if not self.pending:
+                return self.rtt.rto
+            deadline = min(pending.deadline for pending in self.pending.values())
+        # Never zero: a zero timeout would switch the shared socket to non-blocking mode
+        return max(0.001, deadline - time.monotonic())
+
+    def receive_loop(self):
+        buffer = bytearray(65536)
+        while not self.closed:
+            self.sock.settimeout(self.next_timeout())
+            try:
+                nbytes = self.sock.recv_into(buffer)
+            except socket.timeout:
+                self.retransmit_overdue()
+                continue
+            except OSError:
+                # ICMP port unreachable surfaces here; the retransmission timer still applies
+                if self.closed:
+                    break
+                self.retransmit_overdue()
+                continue
+            data = bytes(buffer[:nbytes])
+            if is_reliable(data):
+                self.handle_ack(*decode_header(data))
+        self.fail_all(ConnectionError("Client is closed"))
+
+    def handle_ack(self, kind, sequence, body):
+        now = time.monotonic()
+        with self.lock:
+            pending = self.pending.pop(sequence, None)
+            if pending is None:
+                return  # ACK for a request that already completed
+            if pending.retries == 0:
+                # Karn's algorithm: a retransmitted request's ACK cannot be timed unambiguously
+                self.rtt.sample(now - pending.first_sent)
+            if kind == DUPLICATE_ACK:
+                self.duplicate_acks += 1
+            elif kind == NACK:
+                self.rejected += 1
+        if kind == NACK:
+            try:
+                pending.future.set_exception(ConnectionError(f"Server refused sequence {sequence}: "
+                                                             "outside its receive window"))
+            except InvalidStateError:
+                pass
+            return
+        replies = [reply.decode('utf-8', 'replace') for reply in decode_items(body)]
+        try:
+            pending.future.set_result(replies)
+        except InvalidStateError:
+            pass
+
+    def retransmit_overdue(self):
+        now = time.monotonic()
+        resend = []
+        failed = []
+        with self.lock:
+            overdue = [(sequence, pending) for sequence, pending in self.pending.items() if pending.deadline <= now]
+            # Backed off per request, so one unlucky request does not stretch everyone's timeout
+            for sequence, pending in overdue:
+                if pending.retries >= self.max_retries:
+                    del self.pending[sequence]
+                    failed.append(pending)
+                    continue
+                pending.retries += 1
+                pending.deadline = now + self.rtt.timeout_for(pending.retries)
+                resend.append(pending.datagram)
+            self.retransmissions += len(resend)
+            self.failures += len(failed)
+        for datagram in resend:
+            try:
+                self.sock.send(datagram)
+            except OSError:
+                pass
+        for pending in failed:
+            try:
+                pending.future.set_exception(TimeoutError(f"No ACK after {self.max_retries} retransmissions"))
+            except InvalidStateError:
+                pass
+
+    def fail_all(self, error):
+        with self.lock:
+            pending, self.pending = list(self.pending.values()), {}
+        for request in pending:
+            try:
+                request.future.set_exception(error)
+            except InvalidStateError:
+                pass
+
+    def stats(self):
+        return {
+            'sent': self.sent,
+            'retransmissions': self.retransmissions,
+            'duplicate_acks': self.duplicate_acks,
+            'failures': self.failures,
+            'rejected': self.rejected,
+            'in_flight': len(self.pending),
+            'srtt_ms': round(self.rtt.srtt * 1000, 3) if self.rtt.srtt is not None else None,
+            'rto_ms': round(self.rtt.rto * 1000, 3),
+        }
+
+    def close(self):
+        self.closed = True
+        try:
+            # Wakes the receive thread out of recv_into
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.receiver.join(timeout=1.0)
+        self.sock.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
@@ -0,0 +1,522 @@
+
+# RESPONSE CLIENT LIBRARY (response_client.py)
+# Shared by the TCP clients. Connections are opened once and kept in a
+# per-host pool, switch to framed mode when the server offers it so many
+# requests can be in flight at a time (compressed, if both ends agree), and
+# are reopened with jittered backoff when they drop. Comes as a threaded and
+# an asyncio flavour.
+import asyncio
+import random
+import socket
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future, InvalidStateError
+
+from framing import FRAMED_ACK, FRAMED_FEATURE, FRAMED_REQUEST, encode_frame
+from receive_buffer import ReceiveBuffer
+
+class ServerFullError(ConnectionRefusedError):
+    """The server accepted the connection only to say it has no free slot"""
+
+def parse_features(welcome):
+    """Feature names listed after 'Features:' in the welcome banner"""
+    if "Features:" not in welcome:
+        return []
+    return welcome.split("Features:", 1)[1].split()
+
+def framing_request(compression_options, features):
+    """The framing request, plus the compression to ask for; returns (request, session or None)"""
+    compression = compression_options.choose(features) if compression_options else None
+    if compression is None:
+        return FRAMED_REQUEST, None
+    return f"{FRAMED_REQUEST} {compression.describe()}", compression
+
+def check_welcome(welcome):
+    if not welcome:
+        raise ConnectionError("Server closed the connection")
+    if welcome.startswith("Server full"):
+        raise ServerFullError(welcome)
+    return parse_features(welcome)
+
+class Backoff:
+    """Exponential reconnect delay with full jitter, so clients do not retry in lockstep"""
+    def __init__(self, base=0.05, cap=2.0):
+        self.base = base
+        self.cap = cap
+        self.attempt = 0
+
+    def next_delay(self):
+        delay = random.uniform(0, min(self.cap, self.base * 2 ** self.attempt))
+        self.attempt += 1
+        return delay
+
+    def reset(self):
+        self.attempt = 0
+
+class ClientConnection:
+    """One connection with up to max_in_flight pipelined requests; replies resolve futures in order"""
+    def __init__(self, host='localhost', port=12345, framed=True, max_in_flight=64, connect_timeout=5.0,
+                 compression=None):
+        self.host = host
+        self.port = port
+        self.framed = framed
+        self.max_in_flight = max_in_flight
+        self.connect_timeout = connect_timeout
+        # CompressionOptions to negotiate with, and the CompressionSession once agreed
+        self.compression_options = compression
+        self.compression = None
+        self.sock = None
+        self.welcome = ''
+        self.features = []
+        self.waiting = deque()
+        self.send_lock = threading.Lock()
+        self.slots = None
+        self.closed = True
+        self.last_used = time.monotonic()
+        self.requests = 0
+
+    def connect(self):
+        sock = socket.create_connection((self.host, self.port), timeout=self.connect_timeout)
+        try:
+            welcome = sock.recv(1024).decode('utf-8', 'replace')
+            features = check_welcome(welcome)
+            # Plain text replies have no boundaries, so without framing only one request may be in flight
+            self.framed = self.framed and FRAMED_FEATURE in features
+            compression = None
+            if self.framed:
+                request, compression = framing_request(self.compression_options, features)
+                sock.sendall(request.encode('utf-8'))
+                ack = b''
+                while len(ack) < len(FRAMED_ACK):
+                    chunk = sock.recv(len(FRAMED_ACK) - len(ack))
+                    if not chunk:
+                        raise ConnectionError("Server closed the connection during the framing handshake")
+                    ack += chunk
+                if ack.decode('utf-8', 'replace') != FRAMED_ACK:
+                    raise ConnectionError(f"Unexpected reply to framing request: {ack!r}")
+            sock.settimeout(None)
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            # Lets the kernel notice a peer that vanished without closing the connection
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        except BaseException:
+            sock.close()
+            raise
+
+        self.sock = sock
+        self.welcome = welcome
+        self.features = features
+        self.compression = compression
+        self.slots = threading.Semaphore(self.max_in_flight if self.framed else 1)
+        self.closed = False
+        threading.Thread(target=self.read_replies, name=f"client-{self.host}:{self.port}", daemon=True).start()
+        return self
+
+    @property
+    def in_flight(self):
+        return len(self.waiting)
+
+    def healthy(self, max_idle=None):
+        """Still open, and not idle so long that the server may be about to drop it"""
+        if self.closed:
+            return False
+        return max_idle is None or self.in_flight or time.monotonic() - self.last_used < max_idle
+
+    def request(self, message, timeout=None):
+        """Send one request; returns a Future for the reply text
+
+        Blocks while max_in_flight requests are outstanding on this connection.
+        """
+        payload = message.encode('utf-8') if isinstance(message, str) else message
+        compression = self.compression
+        if not self.slots.acquire(timeout=timeout):
+            raise TimeoutError("Too many requests in flight")
+        future = Future()
+        future.add_done_callback(lambda _: self.slots.release())
+
+        error = None
+        with self.send_lock:
+            # fail() takes this lock too, so a request either sees the connection closed here
+            # or has its future queued in time for fail() to find it
+            if self.closed:
+                future.set_exception(ConnectionError("Connection is closed"))
+                return future
+            # Appended under the same lock as the send, so the reply order matches
+            self.waiting.append(future)
+            self.requests += 1
+            self.last_used = time.monotonic()
+            try:
+                if compression is not None:
+                    # Inside the lock: the compression context has to see requests in send order
+                    payload = compression.encode(payload)
+                self.sock.sendall(encode_frame(payload) if self.framed else payload)
+            except OSError as e:
+                error = e
+        if error is not None:
+            self.fail(error)
+        return future
+
+    def read_replies(self):
+        inbox = ReceiveBuffer()
+        compression = self.compression
+        error = ConnectionError("Connection closed by server")
+        try:
+            while inbox.recv_into(self.sock):
+                if compression is not None:
+                    replies = [str(compression.decode(payload), 'utf-8') for payload in inbox.frames()]
+                elif self.framed:
+                    replies = [str(payload, 'utf-8') for payload in inbox.frames()]
+                else:
+                    text, _ = inbox.read_text()
+                    replies = [text] if text else []
+                for reply in replies:
+                    self.resolve(reply)
+                self.last_used = time.monotonic()
+        except (OSError, ValueError) as e:
+            # ValueError covers FrameError and CompressionError
+            error = e if not self.closed else ConnectionError("Connection closed")
+        finally:
+            self.fail(error)
+
+    def resolve(self, reply):
+        try:
+            future = self.waiting.popleft()
+        except IndexError:
+            return  # Nothing was asked; ignore
+        try:
+            future.set_result(reply)
+        except InvalidStateError:
+            pass  # Cancelled by the caller; it still owned its place in the order
+
+    def fail(self, error):
+        """Mark the connection dead and fail every request still waiting on it"""
+        with self.send_lock:
+            self.closed = True
+            waiting, self.waiting = self.waiting, deque()
+        for future in waiting:
+            try:
+                future.set_exception(error)
+            except InvalidStateError:
+                pass
+
+    def close(self):
+        if self.sock is None:
+            return
+        self.closed = True
+        try:
+            # Wakes the reader thread out of recv_into
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.sock.close()
+
+class HostPool:
+    """Connections and reconnect state for one (host, port)"""
+    def __init__(self, host, port, backoff):
+        self.host = host
+        self.port = port
+        self.backoff = backoff
+        self.connections = []
+        self.lock = threading.Lock()
+        self.opened = 0
+        self.failed = 0
+
+class ClientPool:
+    """Per-host pool of ClientConnections with health checks and jittered reconnect backoff"""
+    def __init__(self, max_per_host=4, max_in_flight=64, framed=True, connect_timeout=5.0,
+                 max_idle=60.0, retries=3, backoff_base=0.05, backoff_cap=2.0, compression=None):
+        self.max_per_host = max_per_host
+        self.max_in_flight = max_in_flight
+        self.framed = framed
+        self.connect_timeout = connect_timeout
+        self.compression = compression
+        self.max_idle = max_idle
+        self.retries = retries
+        self.backoff_base = backoff_base
+        self.backoff_cap = backoff_cap
+        self.hosts = {}
+        self.lock = threading.Lock()
+
+    def host_pool(self, host, port):
+        with self.lock:
+            if (host, port) not in self.hosts:
+                backoff = Backoff(self.backoff_base, self.backoff_cap)
+                self.hosts[(host, port)] = HostPool(host, port, backoff)
+            return self.hosts[(host, port)]
+
+    def connection(self, host='localhost', port=12345):
+        """The least busy healthy connection, opening a new one while under max_per_host"""
+        pool = self.host_pool(host, port)
+        with pool.lock:
+            alive = []
+            for conn in pool.connections:
+                if conn.healthy(self.max_idle):
+                    alive.append(conn)
+                else:
+                    conn.close()
+            pool.connections = alive
+
+            best = min(alive, key=lambda conn: conn.in_flight, default=None)
+            if best is not None and (not best.in_flight or len(alive) >= self.max_per_host):
+                return best
+            conn = self.open_connection(pool)
+            pool.connections.append(conn)
+            return conn
+
+    def open_connection(self, pool):
+        """Connect, retrying with jittered backoff; the caller holds pool.lock"""
+        for attempt in range(self.retries + 1):
+            try:
+                conn = ClientConnection(pool.host, pool.port, self.framed, self.max_in_flight,
+                                        self.connect_timeout, self.compression).connect()
+            except OSError as e:
+                pool.failed += 1
+                if attempt == self.retries:
+                    raise
+                time.sleep(pool.backoff.next_delay())
+                continue
+            pool.opened += 1
+            pool.backoff.reset()
+            return conn
+
+    def request(self, message, host='localhost', port=12345):
+        """Send a request on a pooled connection; returns a Future for the reply"""
+        return self.connection(host, port).request(message)
+
+    def call(self, message, host='localhost', port=12345, timeout=None):
+        """Send a request and wait for its reply"""
+        return self.request(message, host, port).result(timeout)
+
+    def stats(self):
+        with self.lock:
+            pools = list(self.hosts.values())
+        return {
+            f"{pool.host}:{pool.port}": {
+                'connections': len(pool.connections),
+                'in_flight': sum(conn.in_flight for conn in pool.connections),
+                'opened': pool.opened,
+                'failed_connects': pool.failed,
+            }
+            for pool in pools
+        }
+
+    def close(self):
+        with self.lock:
+            pools = list(self.hosts.values())
+        for pool in pools:
+            with pool.lock:
+                for conn in pool.connections:
+                    conn.close()
+                pool.connections = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+class AsyncClientConnection:
+    """asyncio flavour of ClientConnection"""
+    def __init__(self, host='localhost', port=12345, framed=True, max_in_flight=64, connect_timeout=5.0,
+                 compression=None):
+        self.host = host
+        self.port = port
+        self.framed = framed
+        self.max_in_flight = max_in_flight
+        self.connect_timeout = connect_timeout
+        self.compression_options = compression
+        self.compression = None
+        self.reader = None
+        self.writer = None
+        self.welcome = ''
+        self.features = []
+        self.waiting = deque()
+        self.slots = None
+        self.closed = True
+        self.reader_task = None
+        self.last_used = time.monotonic()
+        self.requests = 0
+
+    async def connect(self):
+        self.reader, self.writer = await asyncio.wait_for(
+            asyncio.open_connection(self.host, self.port), self.connect_timeout
+        )
+        try:
+            welcome = (await asyncio.wait_for(self.reader.read(1024), self.connect_timeout)).decode('utf-8', 'replace')
+            features = check_welcome(welcome)
+            self.framed = self.framed and FRAMED_FEATURE in features
+            compression = None
+            if self.framed:
+                request, compression = framing_request(self.compression_options, features)
+                self.writer.write(request.encode('utf-8'))
+                ack = await asyncio.wait_for(self.reader.readexactly(len(FRAMED_ACK)), self.connect_timeout)
+                if ack.decode('utf-8', 'replace') != FRAMED_ACK:
+                    raise ConnectionError(f"Unexpected reply to framing request: {ack!r}")
+        except asyncio.IncompleteReadError:
+            self.writer.close()
+            raise ConnectionError("Server closed the connection during the framing handshake")
+        except BaseException:
+            self.writer.close()
+            raise
+
+        self.welcome = welcome
+        self.features = features
+        self.compression = compression
+        self.slots = asyncio.Semaphore(self.max_in_flight if self.framed else 1)
+        self.closed = False
+        self.reader_task = asyncio.create_task(self.read_replies())
+        return self
+
+    @property
+    def in_flight(self):
+        return len(self.waiting)
+
+    def healthy(self, max_idle=None):
+        if self.closed:
+            return False
+        return max_idle is None or self.in_flight or time.monotonic() - self.last_used < max_idle
+
+    async def request(self, message):
+        """Send one request and wait for the reply text"""
+        payload = message.encode('utf-8') if isinstance(message, str) else message
+        await self.slots.acquire()
+        if self.closed:
+            self.slots.release()
+            raise ConnectionError("Connection is closed")
+        future = asyncio.get_running_loop().create_future()
+        future.add_done_callback(lambda _: self.slots.release())
+        self.waiting.append(future)
+        self.requests += 1
+        self.last_used = time.monotonic()
+        if self.compression is not None:
+            payload = self.compression.encode(payload)
+        self.writer.write(encode_frame(payload) if self.framed else payload)
+        await self.writer.drain()
+        # shield() keeps a cancelled request's future (and its place in line) alive
+        return await asyncio.shield(future)
+
+    async def read_replies(self):
+        inbox = ReceiveBuffer()
+        error = ConnectionError("Connection closed by server")
+        try:
+            while True:
+                data = await self.reader.read(65536)
+                if not data:
+                    break
+                inbox.write(data)
+                if self.compression is not None:
+                    replies = [str(self.compression.decode(payload), 'utf-8') for payload in inbox.frames()]
+                elif self.framed:
+                    replies = [str(payload, 'utf-8') for payload in inbox.frames()]
+                else:
+                    text, _ = inbox.read_text()
+                    replies = [text] if text else []
+                for reply in replies:
+                    if self.waiting:
+                        future = self.waiting.popleft()
+                        if not future.done():
+                            future.set_result(reply)
+                self.last_used = time.monotonic()
+        except (OSError, ValueError) as e:
+            error = e
+        finally:
+            self.closed = True
+            while self.waiting:
+                future = self.waiting.popleft()
+                if not future.done():
+                    future.set_exception(error)
+
+    async def close(self):
+        self.closed = True
+        if self.reader_task:
+            self.reader_task.cancel()
+        if self.writer:
+            self.writer.close()
+            try:
+                await self.writer.wait_closed()
+            except (ConnectionError, OSError):
+                pass
+
+class AsyncClientPool:
+    """asyncio flavour of ClientPool"""
+    def __init__(self, max_per_host=4, max_in_flight=64, framed=True, connect_timeout=5.0,
+                 max_idle=60.0, retries=3, backoff_base=0.05, backoff_cap=2.0, compression=None):
+        self.max_per_host = max_per_host
+        self.max_in_flight = max_in_flight
+        self.framed = framed
+        self.connect_timeout = connect_timeout
+        self.compression = compression
+        self.max_idle = max_idle
+        self.retries = retries
+        self.backoff_base = backoff_base
+        self.backoff_cap = backoff_cap
+        self.hosts = {}
+
+    def host_pool(self, host, port):
+        # Only touched from the event loop thread, so no lock is needed here
+        if (host, port) not in self.hosts:
+            pool = HostPool(host, port, Backoff(self.backoff_base, self.backoff_cap))
+            pool.lock = asyncio.Lock()
+            self.hosts[(host, port)] = pool
+        return self.hosts[(host, port)]
+
+    async def connection(self, host='localhost', port=12345):
+        pool = self.host_pool(host, port)
+        async with pool.lock:
+            alive = []
+            for conn in pool.connections:
+                if conn.healthy(self.max_idle):
+                    alive.append(conn)
+                else:
+                    await conn.close()
+            pool.connections = alive
+
+            best = min(alive, key=lambda conn: conn.in_flight, default=None)
+            if best is not None and (not best.in_flight or len(alive) >= self.max_per_host):
+                return best
+            conn = await self.open_connection(pool)
+            pool.connections.append(conn)
+            return conn
+
+    async def open_connection(self, pool):
+        for attempt in range(self.retries + 1):
+            try:
+                conn = await AsyncClientConnection(pool.host, pool.port, self.framed, self.max_in_flight,
+                                                   self.connect_timeout, self.compression).connect()
+            except (OSError, asyncio.TimeoutError):
+                pool.failed += 1
+                if attempt == self.retries:
+                    raise
+                await asyncio.sleep(pool.backoff.next_delay())
+                continue
+            pool.opened += 1
+            pool.backoff.reset()
+            return conn
+
+    async def request(self, message, host='localhost', port=12345):
+        """Send a request on a pooled connection and wait for the reply"""
+        conn = await self.connection(host, port)
+        return await conn.request(message)
+
+    def stats(self):
+        return {
+            f"{pool.host}:{pool.port}": {
+                'connections': len(pool.connections),
+                'in_flight': sum(conn.in_flight for conn in pool.connections),
+                'opened': pool.opened,
+                'failed_connects': pool.failed,
+            }
+            for pool in self.hosts.values()
+        }
+
+    async def close(self):
+        for pool in self.hosts.values():
+            for conn in pool.connections:
+                await conn.close()
+            pool.connections = []
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
@@ -0,0 +1,129 @@
+
+# RESPONSE TEMPLATES (response_templates.py)
+# Shared by the TCP and UDP servers. Replies are assembled from pre-encoded
+# static text, a timestamp that is formatted at most once per second, and
+# the raw bytes the client sent. Batches of replies (framed/pipelined mode)
+# are collected in a buffer that is reused from one batch to the next.
+import time
+
+class TimestampCache:
+    """Formats the current time once per second instead of once per message"""
+    def __init__(self, fmt="%H:%M:%S", clock=time.time):
+        self.fmt = fmt
+        self.clock = clock
+        # (second, text, encoded) replaced as one tuple so readers never see a half update
+        self.cached = (None, '', b'')
+
+    def refresh(self):
+        second = int(self.clock())
+        cached = self.cached
+        if cached[0] != second:
+            text = time.strftime(self.fmt, time.localtime(second))
+            cached = self.cached = (second, text, text.encode('ascii'))
+        return cached
+
+    def text(self):
+        return self.refresh()[1]
+
+    def encoded(self):
+        return self.refresh()[2]
+
+class ReplyBuffer:
+    """Output buffer written at a cursor and reset between messages, never shrunk"""
+    def __init__(self, capacity=4096):
+        self.buffer = bytearray(capacity)
+        self.view = memoryview(self.buffer)
+        self.length = 0
+
+    def write(self, data):
+        end = self.length + len(data)
+        if end > len(self.buffer):
+            self.grow(end)
+        self.buffer[self.length:end] = data
+        self.length = end
+
+    def reserve(self, size):
+        """Skip size bytes (e.g. a frame header filled in later); returns their offset"""
+        offset = self.length
+        end = offset + size
+        if end > len(self.buffer):
+            self.grow(end)
+        self.length = end
+        return offset
+
+    def grow(self, needed):
+        # A bytearray cannot be resized while a memoryview of it is alive
+        self.view.release()
+        self.buffer.extend(bytes(max(needed, 2 * len(self.buffer)) - len(self.buffer)))
+        self.view = memoryview(self.buffer)
+
+    def getvalue(self):
+        """The bytes written so far, as a view into the buffer (valid until the next write)"""
+        return self.view[:self.length]
+
+    def reset(self):
+        self.length = 0
+
+    def __len__(self):
+        return self.length
+
+class ReplyTemplate:
+    """A reply whose static text is encoded once, with %b (bytes) and %d (int) fields"""
+    def __init__(self, template):
+        # bytes %-formatting fills every field in one C call and one allocation
+        self.format = template.encode('utf-8')
+
+    def render(self, *fields):
+        return self.format % fields
+
+    def write_to(self, out, *fields):
+        """Append the reply to a ReplyBuffer"""
+        out.write(self.format % fields)
+
+def benchmark(iterations=200000):
+    """Per-message reply cost: f-string + strftime + encode vs templates + cached timestamp"""
+    from datetime import datetime
+    import timeit
+    import tracemalloc
+
+    message = "Test message 42 from client 7"
+    raw = message.encode('utf-8')
+    template = ReplyTemplate("Server received: '%b' (Message #%d) at %b")
+    timestamps = TimestampCache()
+    out = ReplyBuffer()
+
+    def baseline():
+        timestamp = datetime.now().strftime("%H:%M:%S")
+        response = f"Server received: '{message}' (Message #{12345}) at {timestamp}"
+        return response.encode('utf-8')
+
+    def templated():
+        return template.render(raw, 12345, timestamps.encoded())
+
+    def batched():
+        # Ten pipelined replies collected in the reused buffer
+        out.reset()
+        stamp = timestamps.encoded()
+        for number in range(12345, 12355):
+            template.write_to(out, raw, number, stamp)
+        return out.getvalue()
+
+    results = {}
+    for name, build in (('f-string', baseline), ('template', templated)):
+        seconds = min(timeit.repeat(build, number=iterations, repeat=3))
+        tracemalloc.start()
+        for _ in range(10000):
+            build()
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        results[name] = (seconds / iterations * 1e9, peak)
+        print(f"{name:>9}: {results[name][0]:7.1f} ns/reply, peak traced memory {peak} bytes")
+
+    print(f"  speedup: {results['f-string'][0] / results['template'][0]:.2f}x")
+
+    seconds = min(timeit.repeat(batched, number=iterations // 10, repeat=3))
+    print(f"  batched: {seconds / iterations * 1e9:7.1f} ns/reply into a reused ReplyBuffer")
+    return results
+
+if __name__ == "__main__":
+    benchmark()
@@ -0,0 +1,165 @@
+
+# SERVER STATISTICS (server_stats.py)
+# Shared by the TCP and UDP servers. Hot-path updates only ever touch memory
+# owned by the calling thread, so handlers never contend on a lock; the cost
+# moves to the (rare) reader, which sums every thread's shard. Snapshots come
+# as a dict, JSON or the Prometheus text exposition format.
+import json
+import re
+import threading
+import time
+
+def metric_name(*parts):
+    """Join name parts into a valid Prometheus metric name"""
+    return re.sub(r'[^a-zA-Z0-9_]', '_', '_'.join(part for part in parts if part))
+
+class ShardedCounter:
+    """A counter each thread increments in its own cell; reading sums the cells"""
+    def __init__(self):
+        self.local = threading.local()
+        self.cells = []
+        self.lock = threading.Lock()  # Only taken the first time a thread touches the counter
+
+    def new_cell(self):
+        cell = [0]
+        with self.lock:
+            self.cells.append(cell)
+        self.local.cell = cell
+        return cell
+
+    def add(self, amount=1):
+        try:
+            cell = self.local.cell
+        except AttributeError:
+            cell = self.new_cell()
+        # Only this thread ever writes this cell, so the increment cannot be lost
+        cell[0] += amount
+
+    @property
+    def value(self):
+        return sum(cell[0] for cell in list(self.cells))
+
+class Histogram:
+    """Power-of-two bucket histogram, sharded per thread like ShardedCounter"""
+    BUCKETS = 64
+
+    def __init__(self, unit=''):
+        self.unit = unit
+        self.local = threading.local()
+        self.shards = []
+        self.lock = threading.Lock()
+
+    def new_shard(self):
+        # Buckets, then count and sum in the last two cells
+        shard = [0] * (self.BUCKETS + 2)
+        with self.lock:
+            self.shards.append(shard)
+        self.local.shard = shard
+        return shard
+
+    def record(self, value):
+        try:
+            shard = self.local.shard
+        except AttributeError:
+            shard = self.new_shard()
+        value = int(value)
+        shard[min(value.bit_length(), self.BUCKETS - 1)] += 1
+        shard[-2] += 1
+        shard[-1] += value
+
+    def merged(self):
+        """Every shard summed: the buckets, then count and sum"""
+        merged = [0] * (self.BUCKETS + 2)
+        for shard in list(self.shards):
+            for index, amount in enumerate(shard):
+                merged[index] += amount
+        return merged
+
+    def snapshot(self):
+        merged = self.merged()
+        count, total = merged[-2], merged[-1]
+        snapshot = {'unit': self.unit, 'count': count, 'sum': total, 'mean': total / count if count else 0.0}
+        for name, quantile in (('p50', 0.5), ('p90', 0.9), ('p99', 0.99), ('max', 1.0)):
+            snapshot[name] = self.quantile(merged, count, quantile)
+        return snapshot
+
+    def quantile(self, buckets, count, quantile):
+        """Upper bound of the bucket holding the given quantile"""
+        if not count:
+            return 0
+        target = max(1, int(count * quantile + 0.5))
+        seen = 0
+        for index in range(self.BUCKETS):
+            seen += buckets[index]
+            if seen >= target:
+                return (1 << index) - 1
+        return (1 << self.BUCKETS) - 1
+
+class ServerStats:
+    """Named counters, histograms and gauges with a dict/JSON snapshot"""
+    def __init__(self):
+        self.started = time.time()
+        self.counters = {}
+        self.histograms = {}
+        self.gauges = {}
+
+    def counter(self, name):
+        if name not in self.counters:
+            self.counters[name] = ShardedCounter()
+        return self.counters[name]
+
+    def histogram(self, name, unit=''):
+        if name not in self.histograms:
+            self.histograms[name] = Histogram(unit)
+        return self.histograms[name]
+
+    def gauge(self, name, read):
+        """Register a callable that is read at snapshot time"""
+        self.gauges[name] = read
+
+    def snapshot(self):
+        return {
+            'uptime_s': round(time.time() - self.started, 3),
+            'counters': {name: counter.value for name, counter in self.counters.items()},
+            'gauges': {name: read() for name, read in self.gauges.items()},
+            'histograms': {name: histogram.snapshot() for name, histogram in self.histograms.items()},
+        }
+
+    def to_json(self):
+        return json.dumps(self.snapshot(), default=str)
+
+    def to_prometheus(self, namespace='server'):
+        """Text exposition format; nested gauge dicts are flattened and non-numeric values skipped"""
+        lines = []
+        uptime = metric_name(namespace, 'uptime_seconds')
+        lines += [f"# TYPE {uptime} gauge", f"{uptime} {time.time() - self.started:.3f}"]
+
+        for name, counter in self.counters.items():
+            full_name = metric_name(namespace, name, 'total')
+            lines += [f"# TYPE {full_name} counter", f"{full_name} {counter.value}"]
+
+        for name, read in self.gauges.items():
+            self.flatten_gauge(lines, metric_name(namespace, name), read())
+
+        for name, histogram in self.histograms.items():
+            full_name = metric_name(namespace, name, histogram.unit)
+            merged = histogram.merged()
+            lines.append(f"# TYPE {full_name} histogram")
+            used = [index for index in range(Histogram.BUCKETS) if merged[index]]
+            cumulative = 0
+            # Bucket i holds values of bit length i, so its upper bound is 2**i - 1
+            for index in range(used[-1] + 1 if used else 0):
+                cumulative += merged[index]
+                lines.append(f'{full_name}_bucket{{le="{(1 << index) - 1}"}} {cumulative}')
+            lines.append(f'{full_name}_bucket{{le="+Inf"}} {merged[-2]}')
+            lines.append(f"{full_name}_sum {merged[-1]}")
+            lines.append(f"{full_name}_count {merged[-2]}")
+        return '\n'.join(lines) + '\n'
+
+    def flatten_gauge(self, lines, name, value):
+        if isinstance(value, dict):
+            for key, item in value.items():
+                self.flatten_gauge(lines, metric_name(name, str(key)), item)
+        elif isinstance(value, (int, float)):
+            # True and False are ints too, and come out as 1 and 0
+            lines += [f"# TYPE {name} gauge", f"{name} {int(value) if isinstance(value, bool) else value}"]
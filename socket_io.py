@@ -0,0 +1,164 @@
+
+# SOCKET OPTIONS AND OUTPUT BUFFERING (socket_io.py)
+# Shared by the TCP servers and the load generator. SocketOptions gathers the
+# tunables that used to be hard-wired (Nagle, cork, kernel buffer sizes, listen
+# backlog, keepalive), and OutputBuffer merges pipelined replies so a busy
+# connection pays for one sendmsg() per batch instead of one send() per reply.
+import os
+import socket
+from contextlib import contextmanager
+
+try:
+    IOV_MAX = os.sysconf('SC_IOV_MAX')
+except (AttributeError, ValueError, OSError):
+    IOV_MAX = 1024
+
+HAS_SENDMSG = hasattr(socket.socket, 'sendmsg')
+TCP_CORK = getattr(socket, 'TCP_CORK', None)  # Linux only
+# Per-socket keepalive timing; macOS names the idle time TCP_KEEPALIVE
+TCP_KEEPIDLE = getattr(socket, 'TCP_KEEPIDLE', getattr(socket, 'TCP_KEEPALIVE', None))
+TCP_KEEPINTVL = getattr(socket, 'TCP_KEEPINTVL', None)
+TCP_KEEPCNT = getattr(socket, 'TCP_KEEPCNT', None)
+
+class SocketOptions:
+    """Tunables applied to listening and accepted sockets; None keeps the OS default"""
+    def __init__(self, nodelay=True, cork=False, sndbuf=None, rcvbuf=None, backlog=None,
+                 keepalive=True, keepidle=60, keepintvl=10, keepcnt=5):
+        # Replies are already coalesced in user space, so Nagle would only add delay
+        self.nodelay = nodelay
+        self.cork = cork and TCP_CORK is not None
+        self.sndbuf = sndbuf
+        self.rcvbuf = rcvbuf
+        self.backlog = backlog
+        # Probes a silent peer after keepidle seconds and drops it after keepcnt unanswered
+        # probes keepintvl apart (110s by default), instead of the kernel's two hours
+        self.keepalive = keepalive
+        self.keepidle = keepidle
+        self.keepintvl = keepintvl
+        self.keepcnt = keepcnt
+
+    def listen_backlog(self, default):
+        return default if self.backlog is None else self.backlog
+
+    def apply_listener(self, sock):
+        # Accepted sockets inherit the buffer sizes, and setting them before the handshake
+        # lets the kernel pick a matching window scale
+        if self.sndbuf is not None:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, self.sndbuf)
+        if self.rcvbuf is not None:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, self.rcvbuf)
+
+    def apply_client(self, sock):
+        if self.nodelay is not None:
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, int(self.nodelay))
+        if self.keepalive is not None:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, int(self.keepalive))
+        if self.keepalive:
+            for option, value in ((TCP_KEEPIDLE, self.keepidle), (TCP_KEEPINTVL, self.keepintvl),
+                                  (TCP_KEEPCNT, self.keepcnt)):
+                if option is not None and value is not None:
+                    sock.setsockopt(socket.IPPROTO_TCP, option, value)
+
+    def __repr__(self):
+        return (f"SocketOptions(nodelay={self.nodelay}, cork={self.cork}, sndbuf={self.sndbuf}, "
+                f"rcvbuf={self.rcvbuf}, backlog={self.backlog}, keepalive={self.keepalive}, "
+                f"keepidle={self.keepidle}, keepintvl={self.keepintvl}, keepcnt={self.keepcnt})")
+
+@contextmanager
+def corked(sock):
+    """Hold back partial segments until the block ends (TCP_CORK), then push them out"""
+    sock.setsockopt(socket.IPPROTO_TCP, TCP_CORK, 1)
+    try:
+        yield
+    finally:
+        sock.setsockopt(socket.IPPROTO_TCP, TCP_CORK, 0)
+
+def raise_fd_limit():
+    """Raise the open-file soft limit so one process can hold many sockets"""
+    try:
+        import resource
+    except ImportError:
+        return  # Not available on Windows
+
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    target = hard if hard != resource.RLIM_INFINITY else 1048576
+    if soft < target:
+        try:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (target, hard))
+        except (ValueError, OSError):
+            pass
+
+class OutputBuffer:
+    """Replies queued for one blocking socket and flushed with scatter/gather sendmsg"""
+    def __init__(self, sock, options=None, high_water=256 * 1024, guard=None):
+        self.sock = sock
+        self.cork = options.cork if options else False
+        # Held around each flush when another thread writes to the socket too (pubsub.Subscriber)
+        self.guard = guard
+        # Flush even if the client keeps sending, so replies never pile up unbounded
+        self.high_water = high_water
+        self.chunks = []
+        self.pending = 0
+        self.flushes = 0
+        self.syscalls = 0
+        self.short_writes = 0
+
+    def write(self, data):
+        """Queue bytes (or a view) to send; nothing is copied until the kernel takes it"""
+        if data:
+            self.chunks.append(data)
+            self.pending += len(data)
+
+    def __len__(self):
+        return self.pending
+
+    def full(self):
+        return self.pending >= self.high_water
+
+    def flush(self):
+        """Send everything queued, resuming after short writes"""
+        if not self.chunks:
+            return
+        self.flushes += 1
+        if self.guard is None:
+            self.send_queued()
+        else:
+            with self.guard:
+                self.send_queued()
+
+    def send_queued(self):
+        if self.cork:
+            with corked(self.sock):
+                self.send_all_chunks()
+        else:
+            self.send_all_chunks()
+
+    def send_all_chunks(self):
+        chunks = self.chunks
+        while chunks:
+            if HAS_SENDMSG:
+                sent = self.sock.sendmsg(chunks[:IOV_MAX])
+            else:
+                sent = self.sock.send(b''.join(chunks[:IOV_MAX]))
+            self.syscalls += 1
+            self.pending -= sent
+            self.consume(sent)
+
+    def consume(self, sent):
+        """Drop the chunks the kernel accepted; keep the unsent tail of a partial one"""
+        chunks = self.chunks
+        done = 0
+        for index, chunk in enumerate(chunks):
+            size = len(chunk)
+            if sent < size:
+                if sent:
+                    chunks[index] = memoryview(chunk)[sent:]
+                    self.short_writes += 1
+                break
+            sent -= size
+            done += 1
+        del chunks[:done]
+
+    def stats(self):
+        return {'pending': self.pending, 'flushes': self.flushes,
+                'syscalls': self.syscalls, 'short_writes': self.short_writes}
@@ -0,0 +1,239 @@
+
+# UDP BATCHING (udp_batching.py)
+# Opt-in batching for high-rate UDP senders. The client collects messages for
+# a few milliseconds (or until a datagram is full) and packs them into one
+# datagram no larger than the path MTU; the server processes them in order
+# and answers with one batched reply. Plain datagrams are unaffected, so
+# batching and unbatched clients can share a server.
+import socket
+import sys
+import threading
+import time
+
+from reliable_udp import ITEM_HEADER
+
+# 0xFD never occurs in UTF-8 either, and differs from the reliable mode's 0xFE
+BATCH_MAGIC = 0xFD
+BATCH_PREFIX = bytes([BATCH_MAGIC])
+
+# 1500-byte Ethernet MTU minus the IPv4 and UDP headers: the usual path MTU off the host
+ETHERNET_PAYLOAD = 1472
+MAX_UDP_PAYLOAD = 65507
+IP_HEADERS = 28
+# Linux reports the path MTU of a connected socket through IP_MTU
+IP_MTU = getattr(socket, 'IP_MTU', 14 if sys.platform.startswith('linux') else None)
+
+def is_batch(data):
+    return len(data) > 0 and data[0] == BATCH_MAGIC
+
+def encode_batch(items):
+    """One datagram carrying every item, each prefixed with its length"""
+    parts = [BATCH_PREFIX]
+    for item in items:
+        parts.append(ITEM_HEADER.pack(len(item)))
+        parts.append(item)
+    return b''.join(parts)
+
+def split_batch(data):
+    """The items of a batch, as views into data; a truncated last item is dropped"""
+    view = memoryview(data)
+    items = []
+    offset = 1
+    end = len(view)
+    while offset + ITEM_HEADER.size <= end:
+        (length,) = ITEM_HEADER.unpack_from(view, offset)
+        offset += ITEM_HEADER.size
+        if offset + length > end:
+            break
+        items.append(view[offset:offset + length])
+        offset += length
+    return items
+
+def pack_batches(items, limit=MAX_UDP_PAYLOAD):
+    """Encode items into as few batches of at most limit bytes as possible"""
+    batches = []
+    current = []
+    size = len(BATCH_PREFIX)
+    for item in items:
+        item_size = ITEM_HEADER.size + len(item)
+        if current and size + item_size > limit:
+            batches.append(encode_batch(current))
+            current = []
+            size = len(BATCH_PREFIX)
+        current.append(item)
+        size += item_size
+    if current:
+        batches.append(encode_batch(current))
+    return batches
+
+def path_mtu_payload(sock):
+    """Largest UDP payload that fits the path MTU of a connected socket, if the OS reports it"""
+    if IP_MTU is not None:
+        try:
+            return sock.getsockopt(socket.IPPROTO_IP, IP_MTU) - IP_HEADERS
+        except OSError:
+            pass
+    return ETHERNET_PAYLOAD
+
+class BatchingUDPClient:
+    """Queues messages and sends them batched, max_delay after the first one or as soon as a datagram is full"""
+    def __init__(self, host='localhost', port=12345, max_delay=0.005, max_datagram=None):
+        self.server_address = (host, port)
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.connect(self.server_address)
+        # Loopback reports a 64K MTU, which no real route has; stay within Ethernet unless told otherwise
+        self.max_datagram = max_datagram or min(path_mtu_payload(self.sock), ETHERNET_PAYLOAD)
+        self.max_delay = max_delay
+        self.items = []
+        self.size = len(BATCH_PREFIX)
+        self.deadline = None
+        self.condition = threading.Condition()
+        self.closed = False
+        self.messages = 0
+        self.datagrams = 0
+        self.reply_datagrams = 0
+        self.replies = 0
+        self.send_errors = 0
+        self.flusher = threading.Thread(target=self.flush_loop, name="udp-batch-flusher", daemon=True)
+        self.flusher.start()
+
+    def send(self, message):
+        """Queue one message; it goes out with the next batch"""
+        payload = message.encode('utf-8') if isinstance(message, str) else message
+        item_size = ITEM_HEADER.size + len(payload)
+        if len(BATCH_PREFIX) + item_size > self.max_datagram:
+            raise ValueError(f"Message of {len(payload)} bytes does not fit a {self.max_datagram}-byte datagram")
+        with self.condition:
+            if self.size + item_size > self.max_datagram:
+                self.flush_locked()
+            if not self.items:
+                self.deadline = time.monotonic() + self.max_delay
+                self.condition.notify()
+            self.items.append(payload)
+            self.size += item_size
+            self.messages += 1
+
+    def flush(self):
+        """Send whatever is queued now instead of waiting for the window to close"""
+        with self.condition:
+            self.flush_locked()
+
+    def flush_locked(self):
+        if not self.items:
+            return
+        datagram = encode_batch(self.items)
+        self.items = []
+        self.size = len(BATCH_PREFIX)
+        self.deadline = None
+        self.datagrams += 1
+        try:
+            self.sock.send(datagram)
+        except OSError:
+            # Lost like any other datagram
+            self.send_errors += 1
+
+    def flush_loop(self):
+        with self.condition:
+            while not self.closed:
+                if self.deadline is None:
+                    self.condition.wait()
+                    continue
+                remaining = self.deadline - time.monotonic()
+                if remaining > 0:
+                    self.condition.wait(remaining)
+                    continue
+                self.flush_locked()
+
+    def receive(self, timeout=None):
+        """Reply strings from the next datagram the server sends back"""
+        self.sock.settimeout(timeout)
+        data = self.sock.recv(65535)
+        self.reply_datagrams += 1
+        if is_batch(data):
+            replies = [str(reply, 'utf-8', 'replace') for reply in split_batch(data)]
+        else:
+            replies = [data.decode('utf-8', 'replace')]
+        self.replies += len(replies)
+        return replies
+
+    def stats(self):
+        return {
+            'messages': self.messages,
+            'datagrams': self.datagrams,
+            'messages_per_datagram': round(self.messages / self.datagrams, 2) if self.datagrams else 0.0,
+            'reply_datagrams': self.reply_datagrams,
+            'replies': self.replies,
+            'send_errors': self.send_errors,
+            'max_datagram': self.max_datagram,
+        }
+
+    def close(self):
+        with self.condition:
+            self.flush_locked()
+            self.closed = True
+            self.condition.notify()
+        self.flusher.join(timeout=1.0)
+        self.sock.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+def benchmark(host='localhost', port=12345, messages=20000, window=256):
+    """Messages and datagrams per second, one datagram per message vs batched (start the UDP server first)"""
+    payloads = [f"telemetry {i} from sensor 7".encode('utf-8') for i in range(messages)]
+
+    def unbatched():
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.connect((host, port))
+        sock.settimeout(1.0)
+        received = 0
+        try:
+            for sent, payload in enumerate(payloads, 1):
+                sock.send(payload)
+                # Keep at most window replies outstanding so the server's receive queue never overflows
+                while sent - received >= window:
+                    sock.recv(65535)
+                    received += 1
+            while received < messages:
+                sock.recv(65535)
+                received += 1
+        except socket.timeout:
+            pass
+        finally:
+            sock.close()
+        return {'messages': messages, 'datagrams': messages, 'reply_datagrams': received, 'replies': received}
+
+    def batched():
+        with BatchingUDPClient(host, port) as client:
+            try:
+                for sent, payload in enumerate(payloads, 1):
+                    client.send(payload)
+                    if sent - client.replies >= window:
+                        client.flush()
+                        while sent - client.replies >= window // 2:
+                            client.receive(1.0)
+                client.flush()
+                while client.replies < messages:
+                    client.receive(1.0)
+            except socket.timeout:
+                pass
+            return client.stats()
+
+    results = {}
+    for name, run in (('unbatched', unbatched), ('batched', batched)):
+        started = time.perf_counter()
+        stats = run()
+        seconds = time.perf_counter() - started
+        packets = stats['datagrams'] + stats['reply_datagrams']
+        results[name] = stats['replies'] / seconds
+        print(f"{name:>9}: {stats['replies'] / seconds:9.0f} messages/s, {packets / seconds:8.0f} packets/s, "
+              f"{stats['datagrams']} datagrams out, {stats['reply_datagrams']} back, "
+              f"{messages - stats['replies']} replies missing")
+    print(f"  speedup: {results['batched'] / results['unbatched']:.2f}x messages/s")
+    return results
+
+if __name__ == "__main__":
+    benchmark()
@@ -0,0 +1,143 @@
+
+# WORKER POOL WITH ADMISSION QUEUE (worker_pool.py)
+# Shared by the threaded TCP servers. A fixed set of worker threads serves
+# clients; when they are all busy, new connections wait in a bounded queue
+# for a short deadline instead of being bounced straight into a reconnect.
+import threading
+import time
+from collections import deque
+
+class AdmissionPool:
+    """Fixed worker threads fed from a bounded queue of accepted connections"""
+    def __init__(self, handler, reject, workers=10, queue_size=20, queue_timeout=5.0, admit=None):
+        self.handler = handler            # handler(client_socket, address, client_id)
+        self.reject = reject              # reject(client_socket, address) tells the client and closes it
+        self.admit = admit                # optional extra slot check, e.g. a limit shared across processes
+        self.workers = workers
+        self.queue_size = queue_size
+        self.queue_timeout = queue_timeout
+
+        self.pending = deque()
+        self.condition = threading.Condition()
+        self.stopped = False
+        self.busy_workers = 0
+        self.admitted = 0
+        self.rejected_queue_full = 0
+        self.rejected_timeout = 0
+        self.turned_away = 0
+        self.wait_count = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+
+    def start(self):
+        for worker_id in range(self.workers):
+            threading.Thread(target=self.worker_loop, name=f"pool-worker-{worker_id}", daemon=True).start()
+        # Rejects clients whose deadline passes while every worker stays busy
+        threading.Thread(target=self.sweep_loop, name="pool-sweeper", daemon=True).start()
+
+    def submit(self, client_socket, address, client_id):
+        """Queue an accepted connection; returns False (and rejects it) when the queue is full or stopped"""
+        with self.condition:
+            overdue = self.take_overdue(time.monotonic())
+            accepted = not self.stopped and len(self.pending) < self.queue_size
+            if accepted:
+                self.pending.append((client_socket, address, client_id, time.monotonic()))
+                self.condition.notify()
+            else:
+                self.rejected_queue_full += 1
+
+        self.reject_all(overdue)
+        if not accepted:
+            self.reject(client_socket, address)
+        return accepted
+
+    def stop(self, turn_away):
+        """Take no more work, e.g. once the server starts draining
+
+        Connections still queued never reach a worker: each goes to turn_away(client_socket, address).
+        Workers finish the clients they are already serving.
+        """
+        with self.condition:
+            self.stopped = True
+            queued = list(self.pending)
+            self.pending.clear()
+            self.turned_away += len(queued)
+        for client_socket, address, _, _ in queued:
+            turn_away(client_socket, address)
+
+    def take_overdue(self, now):
+        """Pop queued connections past their deadline; caller holds the condition"""
+        overdue = []
+        cutoff = now - self.queue_timeout
+        # FIFO, so the oldest entries are always at the front
+        while self.pending and self.pending[0][3] <= cutoff:
+            overdue.append(self.pending.popleft())
+        self.rejected_timeout += len(overdue)
+        return overdue
+
+    def reject_all(self, entries):
+        for client_socket, address, _, _ in entries:
+            self.reject(client_socket, address)
+
+    def sweep_loop(self):
+        interval = max(self.queue_timeout / 4, 0.05)
+        while True:
+            time.sleep(interval)
+            with self.condition:
+                overdue = self.take_overdue(time.monotonic())
+            self.reject_all(overdue)
+
+    def record_wait(self, waited):
+        # Only called with the condition held
+        self.wait_count += 1
+        self.wait_total += waited
+        if waited > self.wait_max:
+            self.wait_max = waited
+
+    def wait_for_slot(self, deadline):
+        """Poll the extra admission check until it passes or the client's deadline is reached"""
+        while not self.admit():
+            if time.monotonic() >= deadline:
+                return False
+            time.sleep(0.01)
+        return True
+
+    def worker_loop(self):
+        while True:
+            with self.condition:
+                while not self.pending:
+                    self.condition.wait()
+                client_socket, address, client_id, enqueued_at = self.pending.popleft()
+                self.busy_workers += 1
+
+            try:
+                if self.admit is not None and not self.wait_for_slot(enqueued_at + self.queue_timeout):
+                    with self.condition:
+                        self.rejected_timeout += 1
+                    self.reject(client_socket, address)
+                    continue
+
+                with self.condition:
+                    self.record_wait(time.monotonic() - enqueued_at)
+                    self.admitted += 1
+                self.handler(client_socket, address, client_id)
+            finally:
+                with self.condition:
+                    self.busy_workers -= 1
+
+    def metrics(self):
+        """Queue depth, worker usage and how long admitted clients waited"""
+        with self.condition:
+            wait_avg = self.wait_total / self.wait_count if self.wait_count else 0.0
+            return {
+                'workers': self.workers,
+                'busy_workers': self.busy_workers,
+                'queue_depth': len(self.pending),
+                'queue_size': self.queue_size,
+                'admitted': self.admitted,
+                'rejected_queue_full': self.rejected_queue_full,
+                'rejected_timeout': self.rejected_timeout,
+                'turned_away': self.turned_away,
+                'wait_avg_ms': round(wait_avg * 1000, 3),
+                'wait_max_ms': round(self.wait_max * 1000, 3),
+            }